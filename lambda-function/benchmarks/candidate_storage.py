@@ -0,0 +1,91 @@
+"""Candidate storage benchmark: item size and encode/decode cost
+
+Generates the ranked candidates of random 10 digit numbers and compares
+how they would be stored: a list of strings (vanityNumbers), gzipped JSON
+in a Binary attribute (what common.json_serial expects) and the
+candidate_codec encoding, with and without zlib. Sizes follow DynamoDB
+item size rules for the attribute values.
+
+    python benchmarks/candidate_storage.py [--count N] [--candidates K]
+
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import timeit
+
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'contacts'
+))
+
+import candidate_codec  # noqa E402
+import vanity_number  # noqa E402
+
+
+def numbers(count, seed=5233):
+    rand = random.Random(seed)
+    return [
+        '+1-%s' % ''.join(rand.choice('23456789') for _ in range(10))
+        for _ in range(count)
+    ]
+
+
+def list_size(vanity_numbers):
+    # list overhead plus one byte per element and the string lengths
+    return 3 + sum(len(v) + 1 for v in vanity_numbers)
+
+
+def gzip_json(vanity_numbers, scores):
+    return gzip.compress(json.dumps([vanity_numbers, scores]).encode())
+
+
+def gunzip_json(data):
+    return json.loads(gzip.decompress(data))
+
+
+FORMATS = (
+    ('list', lambda v, s: json.dumps(v), lambda data: json.loads(data)[:5],
+     lambda v, s, data: list_size(v)),
+    ('gzip json', gzip_json, lambda data: gunzip_json(data)[0][:5],
+     lambda v, s, data: len(data)),
+    ('codec', lambda v, s: candidate_codec.encode(v, s, compress=False),
+     lambda data: candidate_codec.decode(data)[:5],
+     lambda v, s, data: len(data)),
+    ('codec zlib', candidate_codec.encode,
+     lambda data: candidate_codec.decode(data)[:5],
+     lambda v, s, data: len(data)),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--candidates', type=int, default=100)
+    args = parser.parse_args()
+    ranked = [vanity_number.generate_ranked(number, args.candidates)
+              for number in numbers(args.count)]
+    print('%-12s %10s %10s %12s %12s' % (
+        'format', 'mean B', 'max B', 'encode us', 'top 5 us'
+    ))
+    for name, encode, decode, size in FORMATS:
+        encoded = [encode(v, s) for v, s in ranked]
+        sizes = [size(v, s, data)
+                 for (v, s), data in zip(ranked, encoded)]
+        encode_us = min(timeit.repeat(
+            lambda: [encode(v, s) for v, s in ranked], number=5, repeat=3
+        )) / 5 / len(ranked) * 1e6
+        decode_us = min(timeit.repeat(
+            lambda: [decode(data) for data in encoded], number=20, repeat=3
+        )) / 20 / len(ranked) * 1e6
+        print('%-12s %10.0f %10d %12.1f %12.1f' % (
+            name, sum(sizes) / len(sizes), max(sizes), encode_us, decode_us
+        ))
+
+
+if __name__ == '__main__':
+    main()
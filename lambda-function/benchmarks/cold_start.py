@@ -0,0 +1,79 @@
+"""Cold start benchmark: pygtrie dictionary vs compiled dictionary index
+
+Each mode runs in a fresh interpreter so load time and peak RSS reflect a
+Lambda cold start.
+
+    python benchmarks/cold_start.py [--runs N]
+
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+FUNC_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'contacts'
+)
+
+PROBE = '''
+import json, resource, sys, time
+sys.path.insert(0, %(func_dir)r)
+# Shared by both modes, so keep it out of the measurement
+import common, phonenumbers
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+if %(mode)r == 'trie':
+    from english_words import english_words_set
+    import pygtrie
+    dictionary = pygtrie.Trie()
+    for word in english_words_set:
+        if len(word) >= 3 and len(word) <= 10:
+            dictionary[word.upper()] = True
+else:
+    import vanity_number
+    dictionary = vanity_number.populate_dictionary_trie()
+load = time.perf_counter() - start
+start = time.perf_counter()
+for prefix in ('COOL', 'BED', 'MANN', 'JAD', 'QZX'):
+    prefix in dictionary
+    dictionary.has_subtrie(prefix)
+lookup = time.perf_counter() - start
+print(json.dumps({
+    'load_ms': load * 1000,
+    'lookup_us': lookup * 1e6 / 10,
+    'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline,
+}))
+'''
+
+
+def run(mode, runs):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            PROBE % {'func_dir': FUNC_DIR, 'mode': mode}
+        ])
+        samples.append(json.loads(output.decode().strip().splitlines()[-1]))
+    return {
+        key: sorted(s[key] for s in samples)[len(samples) // 2]
+        for key in samples[0]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    print('%-6s %10s %12s %10s' % ('mode', 'load ms', 'lookup us', 'rss KB'))
+    for mode in ('trie', 'index'):
+        result = run(mode, args.runs)
+        print('%-6s %10.1f %12.1f %10d' % (
+            mode, result['load_ms'], result['lookup_us'], result['rss_kb']
+        ))
+
+
+if __name__ == '__main__':
+    main()
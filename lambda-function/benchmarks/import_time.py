@@ -0,0 +1,129 @@
+"""Cold start import profile of the Lambda function
+
+Imports index in fresh interpreters under -X importtime, with INIT_PRIME
+off, then runs index.init() as the Lambda init phase would. The import
+and init times (median over the runs) are compared with a cold start
+budget, and the slowest imports of the last run are listed by cumulative
+time. AWS_LAMBDA_FUNCTION_NAME is set, so init also builds the DynamoDB
+table and client, without calling AWS. Like the deployed package, the
+function loads a compiled dictionary index, built in a temporary
+directory when there is none.
+
+    python benchmarks/import_time.py [--runs N] [--budget-ms MS] [--top N]
+
+The exit status is 1 when import plus init exceeds the budget.
+
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+
+FUNC_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'contacts'
+)
+sys.path.insert(0, FUNC_DIR)
+
+import dictionary_index  # noqa E402
+
+# Cold start target for import plus init, most of which is boto3 and
+# building the DynamoDB resource
+DEFAULT_BUDGET_MS = 800
+
+PROBE = '''
+import json, sys, time
+sys.path.insert(0, %(func_dir)r)
+start = time.perf_counter()
+import index
+imported = time.perf_counter()
+index.init()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'init_ms': (time.perf_counter() - imported) * 1000,
+}))
+'''
+
+
+def parse_importtime(stderr):
+    """Parses -X importtime output
+
+    Args:
+        stderr (str): interpreter stderr
+
+    Returns:
+        list: (module, depth, self_us, cumulative_us) in import order
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return modules
+
+
+def run(runs):
+    env = dict(os.environ, INIT_PRIME='FALSE',
+               AWS_LAMBDA_FUNCTION_NAME='import-time-benchmark')
+    env.setdefault('AWS_REGION', 'us-east-1')
+    samples = []
+    modules = []
+    for _ in range(runs):
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             PROBE % {'func_dir': FUNC_DIR}],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+            universal_newlines=True, check=True
+        )
+        samples.append(json.loads(process.stdout.strip().splitlines()[-1]))
+        modules = parse_importtime(process.stderr)
+    result = {
+        key: sorted(s[key] for s in samples)[len(samples) // 2]
+        for key in samples[0]
+    }
+    result['total_ms'] = result['import_ms'] + result['init_ms']
+    return result, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument('--top', type=int, default=15,
+                        help='slowest imports to list')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not os.path.exists(dictionary_index.DEFAULT_INDEX_PATH) and \
+                'DICTIONARY_INDEX_PATH' not in os.environ:
+            os.environ['DICTIONARY_INDEX_PATH'] = dictionary_index.write_index(
+                os.path.join(tmp_dir, 'dictionary.idx')
+            )
+        result, modules = run(args.runs)
+    # Modules imported by index itself or during init, not their children
+    top_level = sorted(
+        (m for m in modules if m[1] <= 1), key=lambda m: -m[3]
+    )[:args.top]
+    print('%-32s %10s %10s' % ('module', 'self ms', 'cumul ms'))
+    for name, depth, self_us, cumulative_us in top_level:
+        print('%-32s %10.1f %10.1f' % (
+            '  ' * depth + name, self_us / 1000, cumulative_us / 1000
+        ))
+    print()
+    print('import %.1f ms, init %.1f ms, total %.1f ms, budget %.0f ms' % (
+        result['import_ms'], result['init_ms'], result['total_ms'],
+        args.budget_ms
+    ))
+    if result['total_ms'] > args.budget_ms:
+        print('OVER BUDGET by %.1f ms' % (result['total_ms'] - args.budget_ms))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
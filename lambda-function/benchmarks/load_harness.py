@@ -0,0 +1,379 @@
+"""Load generation and replay against index.handler
+
+Replays contact flow events against the handler at a given rate and
+concurrency, with DynamoDB mocked by moto (contacts_store):
+
+    python benchmarks/load_harness.py [--events 1000] [--rate 50]
+                                   [--concurrency 4] [--repeat-ratio 0.3]
+    python benchmarks/load_harness.py --replay events.jsonl [--rate 0]
+
+Synthetic events call from seeded random numbers, a new caller or, with
+probability --repeat-ratio, one that called before. --replay sends
+recorded events (JSON lines, or a JSON list, of the event the handler
+gets) in order instead. With a rate, events arrive on schedule whether
+or not earlier ones are done (open loop) and the time waiting for a free
+worker is reported as queueing; --rate 0 sends them as fast as the
+workers take them.
+
+Workers are threads of one warm process, so the handler runs warm. Cold
+starts are measured separately, in fresh interpreters that import index
+(its init phase) and handle one event (--cold-starts). The report has
+throughput, a latency histogram, percentiles of new and repeat callers
+and of cold starts, and the DynamoDB API calls made.
+
+"""
+import argparse
+import collections
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import suite  # noqa E402
+from suite import contact_event, percentile  # noqa E402
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+COLD_START_PROBE = '''
+import contextlib, io, json, logging, sys, time
+sys.path.insert(0, %(func_dir)r)
+sys.path.insert(0, %(benchmarks_dir)r)
+import boto3
+from moto import mock_dynamodb2
+import suite
+logging.disable(logging.CRITICAL)
+with mock_dynamodb2(), contextlib.redirect_stdout(io.StringIO()):
+    boto3.resource('dynamodb', region_name='us-east-1').create_table(
+        **suite.CONTACTS_TABLE_SCHEMA)
+    start = time.perf_counter()
+    import index
+    imported = time.perf_counter()
+    index.handler(suite.contact_event(%(phone_number)r),
+                  suite.LambdaContext())
+    done = time.perf_counter()
+print(json.dumps({
+    'init_ms': (imported - start) * 1000,
+    'first_event_ms': (done - imported) * 1000,
+}))
+'''
+
+
+def synthetic_events(count, repeat_ratio, seed):
+    """Yields contact flow events of new and repeat callers
+
+    Args:
+        count (int): number of events
+        repeat_ratio (float): probability of a caller who called before
+        seed (int): random seed
+
+    Returns:
+        generator: (event, is_repeat) tuples
+
+    """
+    rand = random.Random(seed)
+    callers = []
+    for _ in range(count):
+        if callers and rand.random() < repeat_ratio:
+            yield contact_event(rand.choice(callers)), True
+            continue
+        phone_number = '+1-%s' % ''.join(
+            rand.choice('23456789') for _ in range(10)
+        )
+        callers.append(phone_number)
+        yield contact_event(phone_number), False
+
+
+def recorded_events(path):
+    """Yields recorded contact flow events
+
+    A caller is a repeat caller when an earlier event had the same
+    CustomerEndpoint address.
+
+    Args:
+        path (str): JSON lines, or a JSON list, of events
+
+    Returns:
+        generator: (event, is_repeat) tuples
+
+    """
+    with open(path) as f:
+        data = f.read()
+    if data.lstrip().startswith('['):
+        events = json.loads(data)
+    else:
+        events = (json.loads(line) for line in data.splitlines()
+                  if line.strip())
+    seen = set()
+    for event in events:
+        address = event.get('Details', {}).get('ContactData', {}).get(
+            'CustomerEndpoint', {}).get('Address')
+        yield event, address in seen
+        seen.add(address)
+
+
+class ApiCallCounter(object):
+    """Counts the botocore API calls of every client, per operation"""
+    def __init__(self):
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def patch(self):
+        from botocore.client import BaseClient
+
+        make_api_call = BaseClient._make_api_call
+        counter = self
+
+        def counting_make_api_call(client, operation_name, api_params):
+            with counter._lock:
+                counter.counts[operation_name] += 1
+            return make_api_call(client, operation_name, api_params)
+
+        BaseClient._make_api_call = counting_make_api_call
+        try:
+            yield self
+        finally:
+            BaseClient._make_api_call = make_api_call
+
+
+def run_load(events, rate, concurrency):
+    """Sends events to the handler
+
+    Args:
+        events (iterable): (event, is_repeat) tuples
+        rate (float): events per second, 0 for as fast as possible
+        concurrency (int): worker threads
+
+    Returns:
+        samples (list): (latency, queueing, is_repeat, error) per event,
+            in seconds
+        elapsed (float): wall clock seconds
+
+    """
+    import index
+
+    samples = []
+    lock = threading.Lock()
+    context = suite.LambdaContext()
+
+    def call(event, is_repeat, scheduled):
+        started = time.perf_counter()
+        error = None
+        try:
+            index.handler(event, context)
+        except Exception as e:
+            error = repr(e)
+        done = time.perf_counter()
+        with lock:
+            samples.append((done - started, started - scheduled, is_repeat,
+                            error))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        pending = []
+        for position, (event, is_repeat) in enumerate(events):
+            if rate:
+                scheduled = start + position / rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                # Closed loop: keep each worker busy, no more
+                while len(pending) >= concurrency:
+                    pending[0].result()
+                    pending.pop(0)
+                scheduled = time.perf_counter()
+            pending.append(executor.submit(call, event, is_repeat,
+                                           scheduled))
+    return samples, time.perf_counter() - start
+
+
+def cold_starts(runs, seed):
+    """Times fresh interpreters importing index and handling one event
+
+    Args:
+        runs (int): interpreters
+        seed (int): random seed of the phone numbers
+
+    Returns:
+        list: {'init_ms', 'first_event_ms'} per run
+
+    """
+    samples = []
+    env = dict(os.environ)
+    env.setdefault('AWS_LAMBDA_FUNCTION_NAME', 'load-test')
+    env.setdefault('AWS_REGION', 'us-east-1')
+    for (event, _) in synthetic_events(runs, 0, seed):
+        probe = COLD_START_PROBE % {
+            'func_dir': suite.FUNC_DIR, 'benchmarks_dir': BENCHMARKS_DIR,
+            'phone_number':
+                event['Details']['ContactData']['CustomerEndpoint']['Address']
+        }
+        output = subprocess.check_output([sys.executable, '-c', probe],
+                                         env=env)
+        samples.append(json.loads(output.decode().strip().splitlines()[-1]))
+    return samples
+
+
+def histogram(latencies_ms):
+    counts = [0] * (len(BUCKETS_MS) + 1)
+    for latency in latencies_ms:
+        for index, bound in enumerate(BUCKETS_MS):
+            if latency <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[-1] += 1
+    labels = ['<= %s ms' % bound for bound in BUCKETS_MS] + \
+        ['> %s ms' % BUCKETS_MS[-1]]
+    return list(zip(labels, counts))
+
+
+def latency_summary(latencies_ms):
+    if not latencies_ms:
+        return None
+    return {
+        'count': len(latencies_ms),
+        'p50_ms': percentile(latencies_ms, 50),
+        'p95_ms': percentile(latencies_ms, 95),
+        'p99_ms': percentile(latencies_ms, 99),
+        'max_ms': max(latencies_ms),
+    }
+
+
+def report(samples, elapsed, api_calls, cold):
+    latencies = [sample[0] * 1000 for sample in samples]
+    return {
+        'events': len(samples),
+        'errors': sum(1 for sample in samples if sample[3]),
+        'elapsed_s': elapsed,
+        'throughput_per_s': len(samples) / elapsed if elapsed else 0,
+        'latency': latency_summary(latencies),
+        'queueing': latency_summary([sample[1] * 1000
+                                     for sample in samples]),
+        'new_callers': latency_summary([sample[0] * 1000
+                                        for sample in samples
+                                        if not sample[2]]),
+        'repeat_callers': latency_summary([sample[0] * 1000
+                                           for sample in samples
+                                           if sample[2]]),
+        'cold_init': latency_summary([run['init_ms'] for run in cold]),
+        'cold_first_event': latency_summary([run['first_event_ms']
+                                             for run in cold]),
+        'histogram': histogram(latencies),
+        'dynamodb_calls': dict(sorted(api_calls.items())),
+        'dynamodb_calls_per_event': {
+            name: count / len(samples) if samples else 0
+            for name, count in sorted(api_calls.items())
+        },
+    }
+
+
+def print_report(result):
+    print('%d events in %.2f s: %.1f events/s, %d errors' % (
+        result['events'], result['elapsed_s'], result['throughput_per_s'],
+        result['errors']
+    ))
+    print()
+    print('%-18s %7s %8s %8s %8s %8s' % (
+        'case', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'
+    ))
+    for name in ('latency', 'queueing', 'new_callers', 'repeat_callers',
+                 'cold_init', 'cold_first_event'):
+        summary = result[name]
+        if summary:
+            print('%-18s %7d %8.2f %8.2f %8.2f %8.2f' % (
+                name, summary['count'], summary['p50_ms'],
+                summary['p95_ms'], summary['p99_ms'], summary['max_ms']
+            ))
+    print()
+    largest = max([count for _, count in result['histogram']] + [1])
+    for label, count in result['histogram']:
+        print('%-12s %7d %s' % (label, count, '#' * (40 * count // largest)))
+    print()
+    for name, count in result['dynamodb_calls'].items():
+        print('%-18s %7d %8.2f per event' % (
+            name, count, result['dynamodb_calls_per_event'][name]
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--events', type=int, default=500,
+                        help='synthetic events')
+    parser.add_argument('--replay', default=None,
+                        help='recorded events instead of synthetic ones')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='events per second, 0 for closed loop')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--repeat-ratio', type=float, default=0.3,
+                        help='share of synthetic repeat callers')
+    parser.add_argument('--cold-starts', type=int, default=3,
+                        help='fresh interpreters timed for cold starts')
+    parser.add_argument('--seed', type=int, default=5233)
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    args = parser.parse_args()
+
+    from moto import mock_dynamodb2
+    import boto3
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Measure the deployed package, which ships a compiled index
+        if not os.path.exists(suite.dictionary_index.DEFAULT_INDEX_PATH) \
+                and 'DICTIONARY_INDEX_PATH' not in os.environ:
+            os.environ['DICTIONARY_INDEX_PATH'] = \
+                suite.dictionary_index.write_index(
+                    os.path.join(tmp_dir, 'dictionary.idx')
+                )
+        cold = cold_starts(args.cold_starts, args.seed + 1)
+        if args.replay:
+            events = recorded_events(args.replay)
+        else:
+            events = synthetic_events(args.events, args.repeat_ratio,
+                                      args.seed)
+        # Keep the per contact logs, and the metrics lines printed when
+        # METRICS_ENABLED is set, out of the timings
+        logging.disable(logging.CRITICAL)
+        try:
+            with mock_dynamodb2(), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                import repository
+                repository.reset_dynamodb_resources()
+                boto3.resource('dynamodb', region_name='us-east-1') \
+                    .create_table(**suite.CONTACTS_TABLE_SCHEMA)
+                import index
+                index.CONTACTS_CACHE.clear()
+                # Warm up lazily created clients and code paths
+                index.handler(contact_event('+1-866-266-5233'),
+                              suite.LambdaContext())
+                with ApiCallCounter().patch() as counter:
+                    samples, elapsed = run_load(events, args.rate,
+                                                args.concurrency)
+                repository.reset_dynamodb_resources()
+        finally:
+            logging.disable(logging.NOTSET)
+    result = report(samples, elapsed, counter.counts, cold)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == '__main__':
+    main()
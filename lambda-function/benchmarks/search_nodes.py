@@ -0,0 +1,97 @@
+"""Search micro-benchmark: time, allocations and peak memory per number
+
+Runs every search strategy over the same 10 and 11 digit numbers and
+reports per number the mean time, the search nodes allocated, the memory
+blocks allocated and still held when the search returns (its results
+and cache entries, from a tracemalloc snapshot), and the mean tracemalloc
+peak, which tracks the size of the search frontier.
+
+    python benchmarks/search_nodes.py [--count N] [--strategies bfs,...]
+
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'contacts'
+))
+
+import vanity_number  # noqa E402
+
+
+def numbers(count, seed=5233):
+    rand = random.Random(seed)
+    return [
+        ''.join(rand.choice('23456789') for _ in range(rand.choice([10, 11])))
+        for _ in range(count)
+    ]
+
+
+class CountedNode(vanity_number.Node):
+    """Node counting its allocations"""
+    __slots__ = ()
+    allocated = 0
+
+    def __init__(self, *args, **kwargs):
+        CountedNode.allocated += 1
+        super(CountedNode, self).__init__(*args, **kwargs)
+
+
+def run(strategy, sample):
+    elapsed = 0.0
+    peak = 0
+    blocks = 0
+    for number in sample:
+        vanity_number.DIGIT_RUNS_CACHE.clear()
+        start = time.perf_counter()
+        vanity_number._frame_words_from_number(number, 5, strategy)
+        elapsed += time.perf_counter() - start
+    # Counted and traced separately, both slow allocations down
+    node = vanity_number.Node
+    CountedNode.allocated = 0
+    vanity_number.Node = CountedNode
+    try:
+        for number in sample:
+            vanity_number.DIGIT_RUNS_CACHE.clear()
+            vanity_number._frame_words_from_number(number, 5, strategy)
+    finally:
+        vanity_number.Node = node
+    for number in sample:
+        vanity_number.DIGIT_RUNS_CACHE.clear()
+        tracemalloc.start()
+        result = vanity_number._frame_words_from_number(number, 5, strategy)
+        peak += tracemalloc.get_traced_memory()[1]
+        blocks += sum(stat.count for stat in
+                      tracemalloc.take_snapshot().statistics('filename'))
+        tracemalloc.stop()
+        del result
+    return (elapsed / len(sample), CountedNode.allocated / len(sample),
+            blocks / len(sample), peak / len(sample))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--strategies',
+                        default=','.join(vanity_number.SEARCH_STRATEGIES))
+    args = parser.parse_args()
+    vanity_number.populate_dictionary_trie()
+    sample = numbers(args.count)
+    print('%-10s %12s %12s %12s %12s' % (
+        'strategy', 'ms/number', 'nodes', 'held blocks', 'peak KB'
+    ))
+    for strategy in args.strategies.split(','):
+        elapsed, nodes, blocks, peak = run(strategy, sample)
+        print('%-10s %12.2f %12.0f %12.0f %12.1f' % (
+            strategy, elapsed * 1000, nodes, blocks, peak / 1024
+        ))
+
+
+if __name__ == '__main__':
+    main()
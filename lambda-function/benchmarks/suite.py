@@ -0,0 +1,329 @@
+"""Benchmark suite with a stored baseline
+
+Runs offline (DynamoDB is mocked with moto) over fixed, seeded inputs:
+
+    cold_load         importing vanity_number, populate_dictionary_trie()
+                      and a first generate() in a fresh interpreter
+    generate_7_9      10 digit numbers of only 7s and 9s (four letter keys)
+    generate_0_1      10 digit numbers where half the digits are 0 or 1
+    generate_10       random 10 digit national numbers
+    generate_11_plus  random 11 and 12 digit national numbers
+    handler_new       index.handler for numbers not stored yet
+    handler_existing  index.handler for stored numbers, cache cleared
+
+Every case reports p50/p95/p99 latency, the peak RSS of the process and
+the mean peak of memory allocated per call (traced in a separate pass).
+The digit runs cache is cleared before every generate call, so search
+cases measure a cold search.
+
+    python benchmarks/suite.py [--cases a,b] [--save] [--baseline FILE]
+
+Without --save the results are compared with the baseline and the exit
+status is 1 when a case is slower or allocates more than the tolerance.
+Baselines are machine specific, save one before comparing changes.
+
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+FUNC_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'contacts'
+)
+DEFAULT_BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'baseline.json'
+)
+sys.path.insert(0, FUNC_DIR)
+
+import dictionary_index  # noqa E402
+import vanity_number  # noqa E402
+
+COLD_LOAD_PROBE = '''
+import json, resource, sys, time
+sys.path.insert(0, %(func_dir)r)
+start = time.perf_counter()
+import vanity_number
+vanity_number.populate_dictionary_trie()
+vanity_number.generate(%(phone_number)r)
+print(json.dumps({
+    'ms': (time.perf_counter() - start) * 1000,
+    'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+}))
+'''
+
+# Compared with the baseline, latency also gets an absolute slack so
+# sub-millisecond cases do not fail on timer noise
+COMPARED = ('p50_ms', 'p95_ms', 'alloc_kb')
+
+
+CONTACTS_TABLE_SCHEMA = {
+    'TableName': 'contacts_store',
+    'KeySchema': [{'AttributeName': 'phoneNumber', 'KeyType': 'HASH'}],
+    'AttributeDefinitions': [{
+        'AttributeName': 'phoneNumber', 'AttributeType': 'S'
+    }],
+    'ProvisionedThroughput': {
+        'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1
+    },
+}
+
+
+class LambdaContext(object):
+    aws_request_id = 'benchmark'
+
+
+def percentile(samples, percent):
+    ordered = sorted(samples)
+    index = max(0, int(round(percent / 100.0 * len(ordered))) - 1)
+    return ordered[index]
+
+
+def numbers(count, digits, lengths, seed):
+    rand = random.Random(seed)
+    return [
+        '+1-%s' % ''.join(
+            rand.choice(digits(position))
+            for position in range(rand.choice(lengths))
+        )
+        for _ in range(count)
+    ]
+
+
+def generate_sets(count):
+    return {
+        'generate_7_9': numbers(count, lambda _: '79', [10], 79),
+        'generate_0_1': numbers(
+            count, lambda p: '01' if p % 2 else '23456789', [10], 1
+        ),
+        'generate_10': numbers(count, lambda _: '23456789', [10], 10),
+        'generate_11_plus': numbers(
+            count, lambda _: '23456789', [11, 12], 11
+        ),
+    }
+
+
+def contact_event(phone_number):
+    return {
+        'Details': {
+            'ContactData': {
+                'CustomerEndpoint': {
+                    'Address': phone_number, 'Type': 'TELEPHONE_NUMBER'
+                }
+            }
+        }
+    }
+
+
+def summarize(samples, alloc_kb):
+    return {
+        'calls': len(samples),
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p95_ms': percentile(samples, 95) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'alloc_kb': alloc_kb,
+    }
+
+
+def measure(func, inputs, setup=None):
+    """Times func over inputs, then traces its allocations in a second pass
+
+    Args:
+        func (function): benchmarked call taking one input
+        inputs (list): inputs
+        setup (function, optional): called before every call, not timed
+
+    Returns:
+        dict: case results
+
+    """
+    # Warm up lazily created clients and code paths
+    if setup:
+        setup(inputs[0])
+    func(inputs[0])
+    samples = []
+    for value in inputs:
+        if setup:
+            setup(value)
+        start = time.perf_counter()
+        func(value)
+        samples.append(time.perf_counter() - start)
+    peak = 0
+    for value in inputs:
+        if setup:
+            setup(value)
+        tracemalloc.start()
+        func(value)
+        peak += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return summarize(samples, peak / len(inputs) / 1024)
+
+
+def cold_load(runs):
+    samples = []
+    rss_kb = 0
+    for _ in range(runs):
+        output = subprocess.check_output([
+            sys.executable, '-c', COLD_LOAD_PROBE % {
+                'func_dir': FUNC_DIR, 'phone_number': '+1-866-266-5233'
+            }
+        ])
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        samples.append(result['ms'] / 1000)
+        rss_kb = max(rss_kb, result['rss_kb'])
+    result = summarize(samples, 0)
+    result['peak_rss_kb'] = rss_kb
+    return result
+
+
+def handler_cases(count):
+    from moto import mock_dynamodb2
+
+    import boto3
+    import index
+    import repository
+
+    new_numbers = numbers(count, lambda _: '23456789', [10], 100)
+    results = {}
+    with mock_dynamodb2():
+        repository.reset_dynamodb_resources()
+        boto3.resource('dynamodb', region_name='us-east-1').create_table(
+            **CONTACTS_TABLE_SCHEMA
+        )
+
+        def new_contact(phone_number):
+            index.CONTACTS_CACHE.clear()
+            vanity_number.DIGIT_RUNS_CACHE.clear()
+            repository.get_dynamodb_table('contacts_store').delete_item(
+                Key={'phoneNumber': phone_number}
+            )
+
+        def existing_contact(phone_number):
+            index.CONTACTS_CACHE.clear()
+
+        def call(phone_number):
+            index.handler(contact_event(phone_number), LambdaContext())
+
+        # Keep the per contact logs, and the metrics lines printed when
+        # METRICS_ENABLED is set, out of the timings
+        logging.disable(logging.CRITICAL)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results['handler_new'] = measure(call, new_numbers,
+                                                 new_contact)
+                results['handler_existing'] = measure(call, new_numbers,
+                                                      existing_contact)
+        finally:
+            logging.disable(logging.NOTSET)
+        repository.reset_dynamodb_resources()
+    return results
+
+
+def run(cases, count, runs):
+    results = {}
+    if 'cold_load' in cases:
+        results['cold_load'] = cold_load(runs)
+    vanity_number.populate_dictionary_trie()
+    for name, inputs in generate_sets(count).items():
+        if name in cases:
+            results[name] = measure(
+                vanity_number.generate, inputs,
+                lambda _: vanity_number.DIGIT_RUNS_CACHE.clear()
+            )
+    if 'handler_new' in cases or 'handler_existing' in cases:
+        for name, result in handler_cases(count).items():
+            if name in cases:
+                results[name] = result
+    return results
+
+
+def regressions(results, baseline, tolerance, slack_ms):
+    found = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for key in COMPARED:
+            expected = baseline[name].get(key)
+            if expected is None:
+                continue
+            limit = expected * (1 + tolerance)
+            if key.endswith('_ms'):
+                limit += slack_ms
+            if result[key] > limit:
+                found.append('%s %s %.2f > %.2f (baseline %.2f)' % (
+                    name, key, result[key], limit, expected
+                ))
+    return found
+
+
+CASES = ('cold_load', 'generate_7_9', 'generate_0_1', 'generate_10',
+         'generate_11_plus', 'handler_new', 'handler_existing')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--cases', default=','.join(CASES))
+    parser.add_argument('--count', type=int, default=50,
+                        help='numbers per case')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='fresh interpreters for cold_load')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed relative increase')
+    parser.add_argument('--slack-ms', type=float, default=1.0,
+                        help='allowed absolute latency increase')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Measure the deployed package, which ships a compiled index
+        if not os.path.exists(dictionary_index.DEFAULT_INDEX_PATH) and \
+                'DICTIONARY_INDEX_PATH' not in os.environ:
+            os.environ['DICTIONARY_INDEX_PATH'] = dictionary_index.write_index(
+                os.path.join(tmp_dir, 'dictionary.idx')
+            )
+        results = run(args.cases.split(','), args.count, args.runs)
+    print('%-18s %8s %8s %8s %12s %10s' % (
+        'case', 'p50 ms', 'p95 ms', 'p99 ms', 'peak RSS KB', 'alloc KB'
+    ))
+    for name in CASES:
+        if name in results:
+            result = results[name]
+            print('%-18s %8.2f %8.2f %8.2f %12d %10.1f' % (
+                name, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                result['peak_rss_kb'], result['alloc_kb']
+            ))
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('baseline saved to %s' % args.baseline)
+        return
+    if not os.path.exists(args.baseline):
+        print('no baseline at %s, run with --save' % args.baseline)
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    found = regressions(results, baseline, args.tolerance, args.slack_ms)
+    for regression in found:
+        print('REGRESSION %s' % regression)
+    if found:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
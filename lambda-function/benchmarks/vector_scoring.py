@@ -0,0 +1,72 @@
+"""Scoring throughput: evaluate_word vs NumPy batch scoring
+
+Builds a frontier of candidates for each of N random numbers (every
+digit spelled by one of its letters or kept) and scores them one at a
+time with vanity_number.evaluate_word and in batches with
+vector_scoring.evaluate_words, per number frontier and all at once.
+
+    python benchmarks/vector_scoring.py [--count N] [--frontier K]
+
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'contacts'
+))
+
+import vanity_number  # noqa E402
+import vector_scoring  # noqa E402
+
+
+def frontiers(count, size, seed=5233):
+    rand = random.Random(seed)
+    result = []
+    for _ in range(count):
+        number = ''.join(rand.choice('23456789')
+                         for _ in range(rand.choice([10, 11])))
+        result.append([
+            ''.join(rand.choice(vanity_number.DIGIT_TO_CHARS[digit] +
+                                [digit]) for digit in number)
+            for _ in range(size)
+        ])
+    return result
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--frontier', type=int, default=16)
+    args = parser.parse_args()
+    vanity_number.populate_dictionary_trie()
+    vector_scoring.dictionary_keys()
+    sample = frontiers(args.count, args.frontier)
+    words = [word for frontier in sample for word in frontier]
+    results = (
+        ('evaluate_word', timed(
+            lambda: [vanity_number.evaluate_word(word) for word in words]
+        )),
+        ('per frontier', timed(
+            lambda: [vector_scoring.evaluate_words(frontier)
+                     for frontier in sample]
+        )),
+        ('one batch', timed(lambda: vector_scoring.evaluate_words(words))),
+    )
+    print('%-14s %10s %14s' % ('scoring', 'seconds', 'candidates/s'))
+    for name, elapsed in results:
+        print('%-14s %10.2f %14.0f' % (name, elapsed, len(words) / elapsed))
+
+
+if __name__ == '__main__':
+    main()
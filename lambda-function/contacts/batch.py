@@ -0,0 +1,88 @@
+"""Bulk vanity number generation
+
+Reads one phone number per line and writes one JSON object per line with
+the phoneNumber and its vanityNumbers (or an error). With --table the
+vanity numbers are also stored in DynamoDB with batch writes.
+
+    python batch.py [-i numbers.txt] [-o vanity.jsonl] [-w WORKERS]
+                    [--table contacts_store] [-d DICTIONARY]
+
+"""
+import argparse
+import json
+import sys
+
+from repository import Repository
+import vanity_number
+
+# Results stored per Repository.write_many call
+STORE_CHUNK_SIZE = 1000
+
+
+def read_numbers(lines):
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+
+def store_results(results, table, dictionary=None):
+    """Stores vanity numbers while passing the results through
+
+    Args:
+        results (iterable): generate_batch results
+        table (str): dynamodb table
+        dictionary (str, optional): dictionary the results come from,
+            stored unless it is the default one
+
+    Returns:
+        generator: the results
+
+    """
+    contact_repository = Repository(table, 'phoneNumber')
+    dictionary = vanity_number.dictionary_name(dictionary)
+    pending = {}
+    for result in results:
+        if 'vanityNumbers' in result:
+            vals = {'vanityNumbers': result['vanityNumbers']}
+            if dictionary:
+                vals['dictionary'] = dictionary
+            pending[result['phoneNumber']] = vals
+            if len(pending) >= STORE_CHUNK_SIZE:
+                contact_repository.write_many(pending)
+                pending = {}
+        yield result
+    if pending:
+        contact_repository.write_many(pending)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-i', '--input', type=argparse.FileType('r'),
+                        default=sys.stdin, help='phone numbers (stdin)')
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'),
+                        default=sys.stdout, help='JSON lines (stdout)')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='worker processes (CPU count)')
+    parser.add_argument('-n', '--max-results', type=int, default=5)
+    parser.add_argument('-s', '--strategy', default=None,
+                        choices=vanity_number.SEARCH_STRATEGIES)
+    parser.add_argument('-t', '--table', default=None,
+                        help='also store vanity numbers in this table')
+    parser.add_argument('-d', '--dictionary', default=None,
+                        help='dictionary of the dictionary store (default)')
+    args = parser.parse_args(argv)
+    results = vanity_number.generate_batch(
+        read_numbers(args.input), workers=args.workers,
+        max_results=args.max_results, strategy=args.strategy,
+        dictionary=args.dictionary
+    )
+    if args.table:
+        results = store_results(results, args.table, args.dictionary)
+    for result in results:
+        args.output.write(json.dumps(result) + '\n')
+    args.output.flush()
+
+
+if __name__ == '__main__':
+    main()
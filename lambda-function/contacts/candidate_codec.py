@@ -0,0 +1,244 @@
+"""Compact binary encoding of ranked vanity number candidates
+
+Every candidate of a phone number spells the same digits, so a candidate
+is stored as the choice made at each digit (the digit itself or one of
+its keypad letters, 3 bits) followed by its rank. Records have a fixed
+width and are decoded on demand.
+
+    header   version, flags, country code, number of national digits
+    payload  national digits (4 bits each), candidate count,
+             records of rank (3 x 5 bits) and choices (3 bits a digit)
+
+The payload is zlib compressed when that makes it smaller.
+
+"""
+import struct
+import zlib
+
+from dictionary_index import CHAR_TO_DIGIT
+from dictionary_index import KEYPAD
+
+
+VERSION = 1
+FLAG_ZLIB = 1
+FLAG_SCORES = 2
+
+# version, flags, country code, number of national digits
+HEADER = struct.Struct('<BBHB')
+COUNT = struct.Struct('<H')
+SCORES = struct.Struct('<H')
+SCORE_BITS = 5
+MAX_SCORE = (1 << SCORE_BITS) - 1
+CHOICE_BITS = 3
+
+# choice 0 keeps the digit, choice n is the nth keypad letter
+CHOICES = {
+    digit: digit + KEYPAD.get(digit, '') for digit in '0123456789'
+}
+CHOICE_OF = {
+    digit: {char: choice for choice, char in enumerate(chars)}
+    for digit, chars in CHOICES.items()
+}
+CHOICE_MASK = (1 << CHOICE_BITS) - 1
+
+
+def _split(vanity_number):
+    country_code, sep, chars = vanity_number.partition('-')
+    if not sep or not country_code.isdigit():
+        raise ValueError('invalid vanity number %s' % vanity_number)
+    return int(country_code), chars
+
+
+def _digits(chars):
+    digits = []
+    for char in chars:
+        if char in CHOICES:
+            digits.append(char)
+        elif char in CHAR_TO_DIGIT:
+            digits.append(CHAR_TO_DIGIT[char])
+        else:
+            raise ValueError('invalid vanity number character %s' % char)
+    return ''.join(digits)
+
+
+def _pack_digits(digits):
+    nibbles = [int(digit) for digit in digits]
+    if len(nibbles) % 2:
+        nibbles.append(0)
+    return bytes((nibbles[i] << 4) | nibbles[i + 1]
+                 for i in range(0, len(nibbles), 2))
+
+
+def _unpack_digits(data, length):
+    digits = []
+    for byte in data:
+        digits.append(str(byte >> 4))
+        digits.append(str(byte & 15))
+    return ''.join(digits[:length])
+
+
+def encode(vanity_numbers, scores=None, compress=True):
+    """Encodes ranked vanity numbers of one phone number
+
+    Args:
+        vanity_numbers (list): vanity numbers, e.g. 1-866COOLBED, in rank
+            order
+        scores (list, optional): (max_len_substring, max_continous_chars,
+            number_of_chars_in_word) of each vanity number
+        compress (bool, optional): zlib compress the payload when smaller
+
+    Returns:
+        bytes: encoded candidates
+
+    Raises:
+        ValueError: when the vanity numbers do not spell the same number
+
+    """
+    country_code, digits = 0, ''
+    if vanity_numbers:
+        country_code, chars = _split(vanity_numbers[0])
+        digits = _digits(chars)
+    if country_code > 0xffff or len(digits) > 0xff:
+        raise ValueError('phone number too long to encode')
+    if len(vanity_numbers) > 0xffff:
+        raise ValueError('too many vanity numbers to encode')
+    if scores is not None and len(scores) != len(vanity_numbers):
+        raise ValueError('scores and vanity numbers differ in length')
+    choice_bytes = (len(digits) * CHOICE_BITS + 7) // 8
+    records = []
+    for index, vanity_number in enumerate(vanity_numbers):
+        code, chars = _split(vanity_number)
+        if code != country_code or len(chars) != len(digits):
+            raise ValueError('vanity number %s does not spell %s-%s' % (
+                vanity_number, country_code, digits
+            ))
+        if scores is not None:
+            packed = 0
+            for score in scores[index]:
+                if not 0 <= score <= MAX_SCORE:
+                    raise ValueError('score %s out of range' % score)
+                packed = (packed << SCORE_BITS) | score
+            records.append(SCORES.pack(packed))
+        choices = 0
+        shift = 0
+        try:
+            for digit, char in zip(digits, chars):
+                choices |= CHOICE_OF[digit][char] << shift
+                shift += CHOICE_BITS
+        except KeyError:
+            raise ValueError('vanity number %s does not spell %s-%s' % (
+                vanity_number, country_code, digits
+            ))
+        records.append(choices.to_bytes(choice_bytes, 'little'))
+    flags = FLAG_SCORES if scores is not None else 0
+    payload = b''.join([
+        _pack_digits(digits), COUNT.pack(len(vanity_numbers))
+    ] + records)
+    if compress:
+        compressed = zlib.compress(payload, 9)
+        if len(compressed) < len(payload):
+            flags |= FLAG_ZLIB
+            payload = compressed
+    return HEADER.pack(VERSION, flags, country_code, len(digits)) + payload
+
+
+class CandidateList(object):
+    def __init__(self, data):
+        """Ranked vanity numbers decoded from encode() output on access
+
+        Args:
+            data (bytes): encoded candidates
+
+        Raises:
+            ValueError: when the data is not a compatible encoding
+
+        """
+        if len(data) < HEADER.size:
+            raise ValueError('candidate list is truncated')
+        version, flags, country_code, length = HEADER.unpack_from(data, 0)
+        if version != VERSION:
+            raise ValueError('unsupported candidate list v%s' % version)
+        payload = bytes(data[HEADER.size:])
+        if flags & FLAG_ZLIB:
+            try:
+                payload = zlib.decompress(payload)
+            except zlib.error as e:
+                raise ValueError('invalid candidate list: %s' % e)
+        digits_size = (length + 1) // 2
+        if len(payload) < digits_size + COUNT.size:
+            raise ValueError('candidate list is truncated')
+        self.country_code = country_code
+        self.digits = _unpack_digits(payload[:digits_size], length)
+        self._choices = [
+            (CHOICES[digit], position * CHOICE_BITS)
+            for position, digit in enumerate(self.digits)
+        ]
+        self.has_scores = bool(flags & FLAG_SCORES)
+        self.count, = COUNT.unpack_from(payload, digits_size)
+        self.choice_size = (length * CHOICE_BITS + 7) // 8
+        self.record_size = self.choice_size + (
+            SCORES.size if self.has_scores else 0
+        )
+        self.offset = digits_size + COUNT.size
+        if len(payload) < self.offset + self.record_size * self.count:
+            raise ValueError('candidate list is truncated')
+        self.payload = payload
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('candidate index out of range')
+        start = self.offset + index * self.record_size + (
+            self.record_size - self.choice_size
+        )
+        choices = int.from_bytes(
+            self.payload[start:start + self.choice_size], 'little'
+        )
+        return '%s-%s' % (self.country_code, ''.join([
+            chars[(choices >> shift) & CHOICE_MASK]
+            for chars, shift in self._choices
+        ]))
+
+    def score(self, index):
+        """Returns the rank of a candidate
+
+        Args:
+            index (int): candidate position
+
+        Returns:
+            tuple: (max_len_substring, max_continous_chars,
+                number_of_chars_in_word) or None when not encoded
+
+        """
+        if not self.has_scores:
+            return None
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('candidate index out of range')
+        packed, = SCORES.unpack_from(
+            self.payload, self.offset + index * self.record_size
+        )
+        mask = MAX_SCORE
+        return (packed >> (2 * SCORE_BITS) & mask,
+                packed >> SCORE_BITS & mask,
+                packed & mask)
+
+
+def decode(data):
+    """Decodes the header of encoded candidates
+
+    Args:
+        data (bytes): encoded candidates
+
+    Returns:
+        CandidateList: candidates, decoded one at a time on access
+
+    """
+    return CandidateList(data)
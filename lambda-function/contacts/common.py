@@ -1,23 +1,152 @@
 from collections import Mapping
 from collections import OrderedDict
 from datetime import datetime
-import dateutil
-import gzip
-from io import BytesIO
+from decimal import Decimal
 import json
 import logging
 import os
 import sys
+import threading
 import time
 
-from boto3.dynamodb.types import Binary
-from boto3.dynamodb.types import Decimal
 
+# First bytes of gzip data, other binary values are returned as bytes
+GZIP_MAGIC = b'\x1f\x8b'
 
 is_dictionary_trie_populated = False
 DICTIONARY_TRIE = None
 
 
+class LRUCache(object):
+    def __init__(self, maxsize=1024, ttl=None):
+        """Least recently used cache with hit/miss counters
+
+        Args:
+            maxsize (int): maximum number of items, 0 disables caching
+            ttl (float, optional): seconds an item stays fresh, no expiry
+                by default
+
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= time.monotonic():
+                del self._items[key]
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._items[key] = (expires, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                return self._items.pop(key)[1]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {
+            'size': len(self._items),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+class _Flight(object):
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+    def __init__(self):
+        """Runs a function once for concurrent callers of the same key
+
+        Callers arriving while the function runs for their key wait for
+        it and share its result, or its exception, instead of running it
+        again. Nothing is kept once it returns.
+
+        """
+        self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._flights)
+
+    def do(self, key, func):
+        """Runs func, or waits for the call running for key
+
+        Args:
+            key (hashable): key of the call
+            func (callable): function without arguments
+
+        Returns:
+            value: func result
+            shared (bool): True when another caller ran func
+
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.shared += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, True
+        try:
+            flight.value = func()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.value, False
+
+
 def info(msg, extra=None):
     if extra is not None:
         logging.info(msg, extra)
@@ -72,7 +201,10 @@ def debug(msg, level=1):
 
 
 def add_utc_tz(x):
-    return x.replace(tzinfo=dateutil.tz.gettz("UTC"))
+    # Loaded by botocore in the function, deferred for tools that only
+    # generate vanity numbers
+    from dateutil import tz
+    return x.replace(tzinfo=tz.gettz("UTC"))
 
 
 def now_dt():
@@ -123,6 +255,9 @@ def gunzip_data(gz_body):
         str: uncompressed string
 
     """
+    # Only gzipped attributes need these, keep them off cold starts
+    import gzip
+    from io import BytesIO
     gzf = gz_body if isinstance(gz_body, BytesIO) else BytesIO(gz_body)
     txt = gzip.GzipFile(fileobj=gzf).read()
     return txt
@@ -141,8 +276,87 @@ def json_serial(obj):
         else:
             return int(obj)
         return float(obj)
+    # Binary values come from boto3, which is imported by then
+    from boto3.dynamodb.types import Binary
     if isinstance(obj, Binary):
-        return json.loads(gunzip_data(obj.value))
+        return _from_dynamodb_binary(obj.value, True)
     if isinstance(obj, set):
         return list(obj)
     raise TypeError('type not serializable')
+
+
+def _from_dynamodb_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        number = Decimal(value)
+        if number == number.to_integral_value():
+            return int(number)
+        return float(number)
+
+
+def _from_dynamodb_binary(data, decompress):
+    # Only gzipped JSON is decompressed, e.g. candidate_codec blobs are not
+    if decompress and bytes(data[:2]) == GZIP_MAGIC:
+        return json.loads(gunzip_data(data))
+    return bytes(data)
+
+
+def from_dynamodb_value(value, decompress=True):
+    """Converts a DynamoDB attribute value to plain python types
+
+    Numbers become int or float and sets become lists, as json_serial
+    would make them, in a single pass over the low level format.
+
+    Args:
+        value (dict): attribute value, e.g. {'N': '42'}
+        decompress (bool, optional): gunzip and parse gzipped binary
+            values, otherwise they are returned as bytes; binary values
+            that are not gzipped are always returned as bytes
+
+    Returns:
+        python value
+
+    """
+    (type_, data), = value.items()
+    if type_ == 'S' or type_ == 'BOOL':
+        return data
+    if type_ == 'N':
+        return _from_dynamodb_number(data)
+    if type_ == 'L':
+        return [from_dynamodb_value(v, decompress) for v in data]
+    if type_ == 'M':
+        return {k: from_dynamodb_value(v, decompress)
+                for k, v in data.items()}
+    if type_ == 'NULL':
+        return None
+    if type_ == 'SS':
+        return list(data)
+    if type_ == 'NS':
+        return [_from_dynamodb_number(v) for v in data]
+    if type_ == 'B':
+        return _from_dynamodb_binary(data, decompress)
+    if type_ == 'BS':
+        return [_from_dynamodb_binary(v, decompress) for v in data]
+    raise TypeError('unknown dynamodb type %s' % type_)
+
+
+def from_dynamodb_item(item, decompress=True):
+    """Converts a low level DynamoDB item to a dict of plain python types
+
+    Args:
+        item (dict): attribute values by name
+        decompress (bool or iterable, optional): True to gunzip and parse
+            every gzipped binary attribute, or the names of the attributes
+            to decompress; other binary attributes are returned as bytes
+
+    Returns:
+        dict: item
+
+    """
+    if decompress is True or decompress is False:
+        return {k: from_dynamodb_value(v, decompress)
+                for k, v in item.items()}
+    decompress = frozenset(decompress)
+    return {k: from_dynamodb_value(v, k in decompress)
+            for k, v in item.items()}
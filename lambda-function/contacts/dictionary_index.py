@@ -0,0 +1,792 @@
+import bisect
+import mmap
+import os
+import struct
+import sys
+
+import common
+
+
+MAGIC = b'VNIX'
+VERSION = 3
+MIN_WORD_LENGTH = 3
+MAX_WORD_LENGTH = 10
+DEFAULT_DICTIONARY = 'english'
+MAX_NAME_LENGTH = 16
+MAX_WEIGHT = 0xffff
+
+# Telephone keypad letters (ITU E.161)
+KEYPAD = {
+    '2': 'ABC',
+    '3': 'DEF',
+    '4': 'GHI',
+    '5': 'JKL',
+    '6': 'MNO',
+    '7': 'PQRS',
+    '8': 'TUV',
+    '9': 'WXYZ',
+}
+CHAR_TO_DIGIT = {
+    char: digit for digit, chars in KEYPAD.items() for char in chars
+}
+
+
+class Keypad(object):
+    def __init__(self, name, letters):
+        """Letters of a telephone keypad, compiled into lookup tables
+
+        Args:
+            name (str): keypad name
+            letters (dict): letters by digit
+
+        """
+        self.name = name
+        self.letters = letters
+        self.digit_to_chars = {
+            digit: list(letters.get(digit, '')) for digit in '0123456789'
+        }
+        self.char_to_digit = {
+            char: digit for digit, chars in letters.items() for char in chars
+        }
+
+    def digits(self, word):
+        """Returns the digits spelling a word
+
+        Args:
+            word (str): upper case word
+
+        Returns:
+            str: digits, None when a letter is not on the keypad
+
+        """
+        char_to_digit = self.char_to_digit
+        if not all(char in char_to_digit for char in word):
+            return None
+        return ''.join(char_to_digit[char] for char in word)
+
+
+# Keypads regions can spell words with, see regions.py. Dictionary stores
+# index the digits of DEFAULT_KEYPAD.
+KEYPADS = {
+    keypad.name: keypad for keypad in (
+        Keypad('E.161', KEYPAD),
+        # Classic North American dial, without Q and Z
+        Keypad('bell', {
+            digit: chars.replace('Q', '').replace('Z', '')
+            for digit, chars in KEYPAD.items()
+        }),
+    )
+}
+DEFAULT_KEYPAD = KEYPADS['E.161']
+
+# magic, version, record width, number of words, number of digit keys,
+# number of dictionaries
+HEADER = struct.Struct('<4sHHIII')
+# word record index of a digit key, or of a dictionary word
+POSITION = struct.Struct('<I')
+WEIGHT = struct.Struct('<H')
+# name, number of words, offset of word positions (0 for the primary
+# dictionary, whose words are the first records), offset of weights, the
+# weight of every word when they are all equal (0 otherwise)
+DICTIONARY = struct.Struct('<16sIIIH')
+
+DEFAULT_INDEX_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'dictionary.idx'
+)
+
+
+class _Records(object):
+    """Fixed width records of a buffer exposed as a sorted sequence
+
+    Slicing a record is the only allocation per probe, so bisect can run
+    directly against the memory-mapped file.
+
+    """
+    def __init__(self, buffer, offset, width, count):
+        self.buffer = buffer
+        self.offset = offset
+        self.width = width
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        start = self.offset + index * self.width
+        return self.buffer[start:start + self.width]
+
+
+class _Values(object):
+    """Fixed size struct values of a buffer exposed as a sequence"""
+    def __init__(self, buffer, offset, item, count):
+        self.buffer = buffer
+        self.offset = offset
+        self.item = item
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.item.unpack_from(
+            self.buffer, self.offset + index * self.item.size
+        )[0]
+
+
+class _MemberRecords(object):
+    """Records of the words of a dictionary, in alphabetical order"""
+    def __init__(self, records, positions):
+        self.records = records
+        self.positions = positions
+        self.count = len(positions)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.records[self.positions[index]]
+
+
+class DictionaryStore(object):
+    def __init__(self, buffer):
+        """Dictionaries compiled into one buffer
+
+        Word records and their keypad digit keys are stored once for all
+        dictionaries. The words of the primary dictionary (the default
+        one) come first. Any other dictionary adds the positions of its
+        words, and every dictionary a weight per word, so several
+        dictionaries cost little more memory than the largest one.
+
+        Args:
+            buffer (bytes or mmap): compiled store
+
+        Raises:
+            ValueError: when the buffer is not a compatible store
+
+        """
+        if len(buffer) < HEADER.size:
+            raise ValueError('dictionary index is truncated')
+        magic, version, width, count, digit_count, dictionary_count = \
+            HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(
+                'unsupported dictionary index %s v%s' % (magic, version)
+            )
+        digits_offset = HEADER.size + width * count
+        positions_offset = digits_offset + width * digit_count
+        table_offset = positions_offset + POSITION.size * digit_count
+        if len(buffer) < table_offset + DICTIONARY.size * dictionary_count:
+            raise ValueError('dictionary index is truncated')
+        self.buffer = buffer
+        self.width = width
+        self.records = _Records(buffer, HEADER.size, width, count)
+        self.digits = _Records(buffer, digits_offset, width, digit_count)
+        self.digit_positions = _Values(buffer, positions_offset, POSITION,
+                                       digit_count)
+        self.entries = {}
+        for index in range(dictionary_count):
+            name, words, words_offset, weights_offset, uniform_weight = \
+                DICTIONARY.unpack_from(
+                    buffer, table_offset + index * DICTIONARY.size
+                )
+            end = max(words_offset + POSITION.size * words,
+                      weights_offset + WEIGHT.size * words)
+            if len(buffer) < end:
+                raise ValueError('dictionary index is truncated')
+            self.entries[name.rstrip(b'\x00').decode('ascii')] = \
+                (words, words_offset, weights_offset, uniform_weight)
+        self._dictionaries = {}
+
+    def names(self):
+        return sorted(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def get(self, name=DEFAULT_DICTIONARY):
+        """Returns a dictionary of the store
+
+        Args:
+            name (str, optional): dictionary name
+
+        Returns:
+            DictionaryIndex: dictionary
+
+        Raises:
+            KeyError: when the store has no such dictionary
+
+        """
+        dictionary = self._dictionaries.get(name)
+        if dictionary is None:
+            dictionary = self._dictionaries[name] = DictionaryIndex(
+                self, name, *self.entries[name]
+            )
+        return dictionary
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+
+class DictionaryIndex(object):
+    def __init__(self, store, name, count, words_offset, weights_offset,
+                 uniform_weight=0):
+        """Read only dictionary of a dictionary store
+
+        Supports the subset of the pygtrie.Trie interface used by
+        vanity_number (membership and has_subtrie), lookup of the words
+        spelled by a keypad digit sequence and word weights.
+
+        Args:
+            store (DictionaryStore): store holding the dictionary
+            name (str): dictionary name
+            count (int): number of words
+            words_offset (int): offset of the word positions, 0 when the
+                words are the first records of the store
+            weights_offset (int): offset of the word weights
+            uniform_weight (int, optional): weight of every word when
+                they are all equal, which spares looking them up
+
+        """
+        self.store = store
+        self.name = name
+        self.buffer = store.buffer
+        self.width = store.width
+        if words_offset:
+            self.positions = _Values(store.buffer, words_offset, POSITION,
+                                     count)
+            self.words = _MemberRecords(store.records, self.positions)
+        else:
+            self.positions = None
+            self.words = _Records(store.buffer, store.records.offset,
+                                  store.width, count)
+        self.weights = _Values(store.buffer, weights_offset, WEIGHT, count)
+        self.uniform_weight = uniform_weight
+        self.keypad = DEFAULT_KEYPAD
+        # Digit keys of every dictionary of the store, sorted
+        self.digit_keys = store.digits
+        self._keypads = {}
+        self._automaton = None
+
+    def __len__(self):
+        return len(self.words)
+
+    def _key(self, word):
+        try:
+            key = word.encode('ascii')
+        except UnicodeEncodeError:
+            return None
+        if len(key) > self.width:
+            return None
+        return key.ljust(self.width, b'\x00')
+
+    def __contains__(self, word):
+        key = self._key(word)
+        if key is None:
+            return False
+        index = bisect.bisect_left(self.words, key)
+        return index < len(self.words) and self.words[index] == key
+
+    def weight(self, word):
+        """Returns the weight of a word
+
+        Args:
+            word (str): string of chars
+
+        Returns:
+            int: weight, 0 when the word is not in the dictionary
+
+        """
+        key = self._key(word)
+        if key is None:
+            return 0
+        index = bisect.bisect_left(self.words, key)
+        if index == len(self.words) or self.words[index] != key:
+            return 0
+        return self.uniform_weight or self.weights[index]
+
+    def has_subtrie(self, prefix):
+        """Returns True if prefix is a strict prefix of a dictionary word
+
+        Args:
+            prefix (str): string of chars
+
+        Returns:
+            has_subtrie (boolean): True/False
+
+        """
+        key = self._key(prefix)
+        if key is None or len(prefix) >= self.width:
+            return False
+        # Padded records sort before any longer word sharing the prefix
+        index = bisect.bisect_right(self.words, key)
+        return (index < len(self.words) and
+                self.words[index].startswith(key[:len(prefix)]))
+
+    def words_for_digits(self, digits):
+        """Returns dictionary words spelled by a keypad digit sequence
+
+        Args:
+            digits (str): string of numbers
+
+        Returns:
+            words (list): words in alphabetical order
+
+        """
+        key = self._key(digits)
+        if key is None:
+            return []
+        store = self.store
+        start = bisect.bisect_left(store.digits, key)
+        end = bisect.bisect_right(store.digits, key, start)
+        words = []
+        for index in range(start, end):
+            position = store.digit_positions[index]
+            if self.positions is None and position >= len(self.words):
+                continue
+            word = store.records[position].rstrip(b'\x00').decode('ascii')
+            if self.positions is None or word in self:
+                words.append(word)
+        # Digit keys with the same digits are in record order
+        if self.positions is not None:
+            words.sort()
+        return words
+
+    def with_keypad(self, keypad):
+        """Returns the dictionary spelled on a keypad
+
+        Args:
+            keypad (Keypad): keypad
+
+        Returns:
+            DictionaryIndex or KeypadDictionary: this dictionary for
+                DEFAULT_KEYPAD, a cached KeypadDictionary otherwise
+
+        """
+        if keypad is self.keypad:
+            return self
+        dictionary = self._keypads.get(keypad.name)
+        if dictionary is None:
+            dictionary = self._keypads[keypad.name] = \
+                KeypadDictionary(self, keypad)
+        return dictionary
+
+    def digit_automaton(self):
+        """Returns the DigitAutomaton of the dictionary, built on first use"""
+        if self._automaton is None:
+            self._automaton = DigitAutomaton(self)
+        return self._automaton
+
+    def close(self):
+        self.store.close()
+
+
+class KeypadDictionary(object):
+    def __init__(self, dictionary, keypad):
+        """Dictionary spelled on another keypad than DEFAULT_KEYPAD
+
+        The store only indexes DEFAULT_KEYPAD digits, so the digits of
+        the words on this keypad are compiled here, once. Everything else
+        is the dictionary's.
+
+        Args:
+            dictionary (DictionaryIndex): dictionary
+            keypad (Keypad): keypad
+
+        """
+        self.dictionary = dictionary
+        self.keypad = keypad
+        words_by_digits = {}
+        words = dictionary.words
+        for index in range(len(words)):
+            word = words[index].rstrip(b'\x00').decode('ascii')
+            digits = keypad.digits(word)
+            if digits is not None:
+                words_by_digits.setdefault(digits, []).append(word)
+        self.words_by_digits = words_by_digits
+        self.digit_keys = sorted(
+            digits.encode('ascii').ljust(dictionary.width, b'\x00')
+            for digits in words_by_digits
+        )
+        self._automaton = None
+
+    def __getattr__(self, name):
+        return getattr(self.dictionary, name)
+
+    def __len__(self):
+        return len(self.dictionary)
+
+    def __contains__(self, word):
+        return word in self.dictionary
+
+    def words_for_digits(self, digits):
+        """Returns dictionary words spelled by a keypad digit sequence
+
+        Args:
+            digits (str): string of numbers
+
+        Returns:
+            words (list): words in alphabetical order
+
+        """
+        return list(self.words_by_digits.get(digits, ()))
+
+    def digit_automaton(self):
+        """Returns the DigitAutomaton of the dictionary, built on first use"""
+        if self._automaton is None:
+            self._automaton = DigitAutomaton(self)
+        return self._automaton
+
+    def with_keypad(self, keypad):
+        return self.dictionary.with_keypad(keypad)
+
+
+class DigitAutomaton(object):
+    def __init__(self, dictionary):
+        """Aho-Corasick automaton over the keypad digits of the words
+
+        Reports the words spelled by every span of a digit string in a
+        single pass over it. A state is the longest suffix of the digits
+        read that starts the digits of a word. Rather than compiling
+        every word into a trie up front, states, transitions, failure
+        links and outputs are found in the sorted digit keys the first
+        time a digit string reaches them and then kept, so a warm search
+        only follows dicts and cold starts build nothing.
+
+        Args:
+            dictionary (DictionaryIndex or KeypadDictionary): dictionary
+
+        """
+        self.dictionary = dictionary
+        self.keys = dictionary.digit_keys
+        self.width = dictionary.width
+        # state + digit -> next state
+        self._transitions = {}
+        self._failures = {'': ''}
+        # state -> lengths of the words spelled by its suffixes
+        self._outputs = {'': ()}
+
+    def __len__(self):
+        """Number of states found so far"""
+        return len(self._failures)
+
+    def _starts_key(self, digits):
+        if len(digits) > self.width:
+            return False
+        key = digits.encode('ascii')
+        index = bisect.bisect_left(self.keys, key)
+        return index < len(self.keys) and self.keys[index].startswith(key)
+
+    def step(self, state, digit):
+        """Returns the state reached from a state by reading a digit"""
+        digits = state + digit
+        next_state = self._transitions.get(digits)
+        if next_state is None:
+            if self._starts_key(digits):
+                next_state = digits
+            elif state:
+                next_state = self.step(self.failure(state), digit)
+            else:
+                next_state = ''
+            self._transitions[digits] = next_state
+        return next_state
+
+    def failure(self, state):
+        """Returns the longest proper suffix of a state that is a state"""
+        failure = self._failures.get(state)
+        if failure is None:
+            failure = ''
+            if len(state) > 1:
+                failure = self.step(self.failure(state[:-1]), state[-1])
+            self._failures[state] = failure
+        return failure
+
+    def output(self, state):
+        """Returns the lengths of the words ending a state, longest first
+
+        Keys are shared by the dictionaries of a store, so a key only
+        counts when it spells words of this dictionary.
+
+        """
+        output = self._outputs.get(state)
+        if output is None:
+            output = self.output(self.failure(state))
+            if self.dictionary.words_for_digits(state):
+                output = (len(state),) + output
+            self._outputs[state] = output
+        return output
+
+    def match(self, digits):
+        """Finds the words spelled by the spans of a digit string
+
+        Args:
+            digits (str): string of numbers
+
+        Returns:
+            word_ends (list): per start index, the end indexes of the
+                spans spelling words, in increasing order
+            state (str): longest suffix of digits starting a word
+
+        """
+        word_ends = [[] for _ in digits]
+        state = ''
+        for end, digit in enumerate(digits, 1):
+            state = self.step(state, digit)
+            for length in self.output(state):
+                word_ends[end - length].append(end)
+        return word_ends, state
+
+
+def _normalize_words(words, min_len, max_len):
+    """Upper cases words and keeps the highest weight of each
+
+    Args:
+        words (iterable or dict): words, or weight by word
+        min_len (int): minimum word length
+        max_len (int): maximum word length
+
+    Returns:
+        dict: weight by ASCII word record
+
+    """
+    if not isinstance(words, dict):
+        words = dict.fromkeys(words, 1)
+    normalized = {}
+    for word, weight in words.items():
+        if min_len <= len(word) <= max_len:
+            try:
+                record = word.upper().encode('ascii')
+            except UnicodeEncodeError:
+                continue
+            weight = min(max(int(weight), 1), MAX_WEIGHT)
+            normalized[record] = max(weight, normalized.get(record, 0))
+    return normalized
+
+
+def english_words():
+    from english_words import english_words_set
+    return english_words_set
+
+
+def compile_store(dictionaries=None, min_len=MIN_WORD_LENGTH,
+                  max_len=MAX_WORD_LENGTH):
+    """Compiles word lists into a dictionary store
+
+    Args:
+        dictionaries (dict, optional): words, or weight by word, by
+            dictionary name; english_words_set as DEFAULT_DICTIONARY by
+            default
+        min_len (int, optional): minimum word length
+        max_len (int, optional): maximum word length
+
+    Returns:
+        bytes: compiled store
+
+    """
+    if dictionaries is None:
+        dictionaries = {DEFAULT_DICTIONARY: english_words()}
+    members = {
+        name: _normalize_words(words, min_len, max_len)
+        for name, words in dictionaries.items()
+    }
+    # The words of the default (or largest) dictionary come first, so it
+    # reads the records directly; other words follow, sorted too
+    primary = DEFAULT_DICTIONARY if DEFAULT_DICTIONARY in members else \
+        max(members, key=lambda name: len(members[name]), default=None)
+    records = sorted(members.get(primary, ()))
+    records += sorted(set().union(*members.values()) - set(records))
+    positions = {record: position for position, record in enumerate(records)}
+    # Only words made of keypad letters can be spelled by a number
+    digit_keys = []
+    for position, record in enumerate(records):
+        digits = DEFAULT_KEYPAD.digits(record.decode('ascii'))
+        if digits is not None:
+            digit_keys.append((digits.encode('ascii'), position))
+    digit_keys.sort()
+    names = sorted(members)
+    offset = (HEADER.size + max_len * (len(records) + len(digit_keys)) +
+              POSITION.size * len(digit_keys) + DICTIONARY.size * len(names))
+    table = []
+    sections = []
+    for name in names:
+        words = sorted(members[name])
+        key = name.encode('ascii')
+        if len(key) > MAX_NAME_LENGTH:
+            raise ValueError('dictionary name too long: %s' % name)
+        words_offset = 0
+        if name != primary:
+            words_offset = offset
+            sections.append(b''.join(
+                POSITION.pack(positions[word]) for word in words
+            ))
+            offset += POSITION.size * len(words)
+        weights = set(members[name].values())
+        table.append(DICTIONARY.pack(
+            key, len(words), words_offset, offset,
+            weights.pop() if len(weights) == 1 else 0
+        ))
+        sections.append(b''.join(
+            WEIGHT.pack(members[name][word]) for word in words
+        ))
+        offset += WEIGHT.size * len(words)
+    return b''.join([
+        HEADER.pack(MAGIC, VERSION, max_len, len(records), len(digit_keys),
+                    len(names)),
+        b''.join(record.ljust(max_len, b'\x00') for record in records),
+        b''.join(digits.ljust(max_len, b'\x00') for digits, _ in digit_keys),
+        b''.join(POSITION.pack(position) for _, position in digit_keys),
+    ] + table + sections)
+
+
+def compile_index(words=None, min_len=MIN_WORD_LENGTH,
+                  max_len=MAX_WORD_LENGTH):
+    """Compiles a word list into a store holding DEFAULT_DICTIONARY
+
+    Args:
+        words (iterable, optional): words, english_words_set by default
+        min_len (int, optional): minimum word length
+        max_len (int, optional): maximum word length
+
+    Returns:
+        bytes: compiled store
+
+    """
+    if words is None:
+        words = english_words()
+    return compile_store({DEFAULT_DICTIONARY: words}, min_len, max_len)
+
+
+def read_word_list(path):
+    """Reads a word list file
+
+    One word per line, optionally followed by its weight (1 by default).
+    Empty lines and lines starting with # are skipped.
+
+    Args:
+        path (str): word list file
+
+    Returns:
+        dict: weight by word
+
+    """
+    words = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            weight = int(fields[1]) if len(fields) > 1 else 1
+            words[fields[0]] = max(weight, words.get(fields[0], 0))
+    return words
+
+
+def parse_dictionary(spec):
+    """Builds a dictionary from a name=source[,source...] specification
+
+    A source is english (english_words_set), a word list file, or a word
+    list file prefixed with - whose words are left out (a blocklist).
+    Words in several sources keep their highest weight.
+
+    Args:
+        spec (str): dictionary specification, e.g.
+            english=english,-blocklist.txt or brands=brands.txt
+
+    Returns:
+        name (str): dictionary name
+        words (dict): weight by upper case word
+
+    """
+    name, _, sources = spec.partition('=')
+    words = {}
+    blocked = set()
+    for source in sources.split(','):
+        if source.startswith('-'):
+            blocked.update(word.upper() for word in read_word_list(source[1:]))
+            continue
+        if source == 'english':
+            source_words = dict.fromkeys(english_words(), 1)
+        else:
+            source_words = read_word_list(source)
+        for word, weight in source_words.items():
+            word = word.upper()
+            words[word] = max(weight, words.get(word, 0))
+    return name, {
+        word: weight for word, weight in words.items() if word not in blocked
+    }
+
+
+def write_index(path=None, words=None, dictionaries=None):
+    """Compiles word lists and writes the store file
+
+    Args:
+        path (str, optional): output file
+        words (iterable, optional): words of DEFAULT_DICTIONARY,
+            english_words_set by default
+        dictionaries (dict, optional): words, or weight by word, by
+            dictionary name, instead of words
+
+    Returns:
+        str: output file
+
+    """
+    path = path or DEFAULT_INDEX_PATH
+    if dictionaries is None:
+        data = compile_index(words)
+    else:
+        data = compile_store(dictionaries)
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_store(path=None):
+    """Memory maps the dictionary store
+
+    Falls back to compiling english_words_set in memory when the store
+    file is missing or was built by an incompatible version.
+
+    Args:
+        path (str, optional): store file, DICTIONARY_INDEX_PATH by default
+
+    Returns:
+        DictionaryStore: dictionary store
+
+    """
+    path = path or common.get_envvar('DICTIONARY_INDEX_PATH',
+                                     DEFAULT_INDEX_PATH)
+    try:
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as e:
+        common.info('Compiling dictionary index in memory: %s' % e)
+        return DictionaryStore(compile_index())
+    try:
+        return DictionaryStore(buffer)
+    except ValueError as e:
+        buffer.close()
+        common.info('Compiling dictionary index in memory: %s' % e)
+        return DictionaryStore(compile_index())
+
+
+def load(path=None, name=DEFAULT_DICTIONARY):
+    """Memory maps the dictionary store and returns one of its dictionaries
+
+    Args:
+        path (str, optional): store file, DICTIONARY_INDEX_PATH by default
+        name (str, optional): dictionary name
+
+    Returns:
+        DictionaryIndex: dictionary index
+
+    """
+    return load_store(path).get(name)
+
+
+if __name__ == '__main__':
+    # dictionary_index.py [output] [name=source[,source...] ...]
+    args = sys.argv[1:]
+    path = args.pop(0) if args and '=' not in args[0] else None
+    dictionaries = dict(parse_dictionary(spec) for spec in args) or None
+    print(write_index(path, dictionaries=dictionaries))
@@ -1,13 +1,370 @@
 from collections import Mapping
+import os
+import time
+import uuid
+
 import jmespath
 
+import candidate_codec
 import common
+import metrics
+import repository
 from repository import Repository
 import vanity_number
+import vanity_table
+
+
+# Stored contact attributes by phone number, kept across invocations of a
+# warm container
+CONTACTS_CACHE = common.LRUCache(
+    common.get_envvar('CONTACTS_CACHE_SIZE', 10000),
+    ttl=common.get_envvar('CONTACTS_CACHE_TTL', 300)
+)
+# How a repeat caller is written back: update (rewrite vanityNumbers),
+# touch (lastModified only) or skip. Contacts read from the repository
+# are touched in the same call unless skipped
+WRITE_BACK_MODES = ('update', 'touch', 'skip')
+# How vanity numbers are stored: list (top vanityNumbers) or binary (the
+# ranked candidates encoded by candidate_codec)
+STORAGE_FORMATS = ('list', 'binary')
+MAX_RESULTS = 5
+CONTACTS_TABLE = 'contacts_store'
+# Contacts being read or generated by a thread of this container, by phone
+# number and dictionary
+CONTACT_FLIGHTS = common.SingleFlight()
+
+
+def init():
+    """Loads what every invocation needs, run once in the init phase
+
+    Primes the dictionary and phone number metadata (VANITY_REGIONS),
+    maps the precomputed vanity tables (VANITY_TABLE_PATHS) and, when
+    running in Lambda, builds the shared DynamoDB client, so
+    the first contact does not wait for them. Set INIT_PRIME to FALSE to
+    load everything on first use instead.
+
+    Returns:
+        float: init time in milliseconds
+
+    """
+    start = time.perf_counter()
+    vanity_number.prime()
+    vanity_table.load_tables()
+    if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+        repository.get_dynamodb_client()
+    elapsed = (time.perf_counter() - start) * 1000
+    common.debug('init %.1f ms' % elapsed)
+    return elapsed
+
+
+def requested_dictionary(event):
+    """Returns the dictionary a contact flow asks for
+
+    Read from the dictionary parameter of the Invoke AWS Lambda function
+    block, or else the dictionary contact attribute.
+
+    Args:
+        event (dict): Amazon Connect contact flow event
+
+    Returns:
+        str: dictionary name, None for the default dictionary
+
+    """
+    return vanity_number.dictionary_name(
+        jmespath.search('Details.Parameters.dictionary', event) or
+        jmespath.search('Details.ContactData.Attributes.dictionary', event)
+    )
+
+
+def stored_vals(phone_number, dictionary=None):
+    """Generates the contact attributes to store for a new caller
+
+    Numbers of a precomputed vanity table are looked up instead.
+
+    Args:
+        phone_number (str): phone number
+        dictionary (str, optional): dictionary name, stored with the
+            vanity numbers unless it is the default one
+
+    Returns:
+        dict: vanityNumbers, or candidates with CONTACTS_STORED_CANDIDATES
+            ranked vanity numbers in binary format
+
+    """
+    vals = {'dictionary': dictionary} if dictionary else {}
+    storage_format = common.get_envvar('CONTACTS_STORAGE_FORMAT', 'list')
+    dictionary_name = vanity_number.get_dictionary(dictionary).name
+    if storage_format == 'binary':
+        stored_candidates = common.get_envvar('CONTACTS_STORED_CANDIDATES',
+                                              100)
+        candidates = vanity_table.lookup(phone_number, dictionary_name,
+                                         stored_candidates)
+        if candidates is not None:
+            metrics.set_property('path', 'table')
+            vals['candidates'] = candidate_codec.encode(
+                *precomputed_candidates(candidates, stored_candidates)
+            )
+            return vals
+        vanity_numbers, scores = vanity_number.generate_ranked(
+            phone_number, stored_candidates, dictionary=dictionary
+        )
+        vals['candidates'] = candidate_codec.encode(vanity_numbers, scores)
+        return vals
+    if storage_format not in STORAGE_FORMATS:
+        common.error('Unknown storage format %s, using list' % storage_format)
+    candidates = vanity_table.lookup(phone_number, dictionary_name,
+                                     MAX_RESULTS)
+    if candidates is not None:
+        metrics.set_property('path', 'table')
+        vals['vanityNumbers'] = precomputed_candidates(candidates,
+                                                       MAX_RESULTS)[0]
+        return vals
+    vals['vanityNumbers'] = vanity_number.generate(phone_number, MAX_RESULTS,
+                                                   dictionary=dictionary)
+    return vals
+
+
+def precomputed_candidates(data, max_results):
+    """Decodes the best candidates of a vanity table
+
+    Args:
+        data (bytes): candidate_codec encoded candidates
+        max_results (int): maximum number of candidates
+
+    Returns:
+        vanity_numbers (list): list of vanity numbers
+        scores (list): their ranks
+
+    """
+    candidates = candidate_codec.decode(data)
+    count = min(len(candidates), max_results)
+    return (candidates[:count],
+            [candidates.score(index) for index in range(count)])
+
+
+def vanity_numbers_from(contact):
+    """Returns the vanity numbers to announce from stored attributes
+
+    Binary candidates are decoded only as far as needed.
+
+    Args:
+        contact (dict): stored contact attributes
+
+    Returns:
+        vanity_numbers (list): list of vanity numbers
+
+    """
+    if 'candidates' in contact:
+        return candidate_codec.decode(contact['candidates'])[:MAX_RESULTS]
+    return contact.get('vanityNumbers')
+
+
+def write_back_mode():
+    mode = common.get_envvar('CONTACTS_WRITE_BACK', 'touch')
+    if mode not in WRITE_BACK_MODES:
+        common.error('Unknown write back mode %s, using update' % mode)
+        mode = 'update'
+    return mode
+
+
+def write_back(contact_repository, phone_number, vals):
+    """Records a repeat caller according to CONTACTS_WRITE_BACK
+
+    Args:
+        contact_repository (Repository): contacts repository
+        phone_number (str): phone number
+        vals (dict): stored vanityNumbers or candidates, and dictionary
+
+    """
+    mode = write_back_mode()
+    if mode == 'skip':
+        return
+    update_vals = {'lastModified': common.timestamp()}
+    if mode == 'update':
+        update_vals.update(vals)
+    contact_repository.write(phone_number, vals=update_vals, update=True)
+
+
+def contact_vals(contact, dictionary=None):
+    """Returns the stored vals of a contact item
+
+    Args:
+        contact (dict): contacts repository item, or False
+        dictionary (str, optional): dictionary name
+
+    Returns:
+        dict: vanityNumbers or candidates, and dictionary, None when no
+            vanity numbers of the dictionary are stored
+
+    """
+    if not isinstance(contact, Mapping) or \
+            contact.get('dictionary') != dictionary or \
+            not ('vanityNumbers' in contact or 'candidates' in contact):
+        return None
+    return {
+        k: v for k, v in contact.items()
+        if k in ('vanityNumbers', 'candidates', 'dictionary')
+    }
+
+
+def lease_held(contact):
+    """Returns True when a contact item is being generated by a holder
+
+    That is an item without vanity numbers holding an unexpired lease, or
+    no lease at all when it was just created by touch(create=True).
+
+    Args:
+        contact (dict): contacts repository item, or False
+
+    Returns:
+        bool: True or False
+
+    """
+    if not isinstance(contact, Mapping) or \
+            'vanityNumbers' in contact or 'candidates' in contact:
+        return False
+    expires = contact.get('leaseExpires')
+    return expires is None or expires >= time.time() * 1000
+
+
+def wait_for_lease(contact_repository, phone_number, dictionary=None,
+                   seconds=5, contact=False):
+    """Takes the generation lease of a contact, or waits for its result
+
+    The lease lets one container generate a new contact while the others
+    poll the repository (every CONTACTS_LEASE_POLL_MS) for what it
+    writes. They take the lease over when it expires or is released,
+    and stop waiting after seconds.
+
+    Args:
+        contact_repository (Repository): contacts repository
+        phone_number (str): phone number
+        dictionary (str, optional): dictionary name
+        seconds (int, optional): lease duration, CONTACTS_LEASE_SECONDS
+        contact (dict, optional): item as last read, False when missing
+
+    Returns:
+        owner (str): lease owner, None when the lease is not held
+        created (bool): True when taking the lease created the item
+        vals (dict): vals written by the lease holder, None otherwise
+
+    """
+    owner = uuid.uuid4().hex
+    deadline = None
+    while True:
+        previous = None
+        if not lease_held(contact):
+            previous = contact_repository.acquire_lease(phone_number, owner,
+                                                        seconds)
+        if previous is not None:
+            vals = contact_vals(previous, dictionary)
+            if vals is None:
+                return owner, not previous, None
+            # Written by a holder between the read and the lease
+            contact_repository.release_lease(phone_number, owner)
+            return None, False, vals
+        # Contested, wait for the holder
+        if deadline is None:
+            poll = common.get_envvar('CONTACTS_LEASE_POLL_MS', 50) / 1000.0
+            deadline = time.monotonic() + seconds
+        while True:
+            if time.monotonic() >= deadline:
+                common.error('Lease of %s not released' % phone_number)
+                return None, False, None
+            time.sleep(poll)
+            contact = contact_repository.exists(phone_number,
+                                                decompress=False,
+                                                consistent=True)
+            vals = contact_vals(contact, dictionary)
+            if vals is not None:
+                return None, False, vals
+            if not lease_held(contact):
+                break
+
+
+def load_contact(contact_repository, phone_number, dictionary=None,
+                 generate_vals=None):
+    """Reads the stored vals of a contact, generating them when missing
+
+    A new contact is generated and written by the container holding its
+    generation lease (see wait_for_lease), CONTACTS_LEASE_SECONDS set to
+    0 generates without one. The touch reading a new contact creates its
+    item, which holds the lease for that container without another call.
+
+    Args:
+        contact_repository (Repository): contacts repository
+        phone_number (str): phone number
+        dictionary (str, optional): dictionary name
+        generate_vals (callable, optional): stored_vals replacement
+
+    Returns:
+        dict: stored vals
+
+    """
+    seconds = common.get_envvar('CONTACTS_LEASE_SECONDS', 5)
+    # Binary candidates are decoded by the caller, not by the repository
+    if write_back_mode() == 'skip':
+        contact = contact_repository.exists(phone_number, decompress=False)
+    else:
+        # Reads the contact and writes a repeat caller back in one call,
+        # vanityNumbers are already stored as they were read. With the
+        # lease, a new caller's touch creates the item that is its lease
+        contact = contact_repository.touch(phone_number, decompress=False,
+                                           create=seconds > 0)
+    vals = contact_vals(contact, dictionary)
+    if vals is not None:
+        common.info('Contact exists: %s' % phone_number)
+        metrics.set_property('path', 'repository')
+        return vals
+    owner, created = None, contact == {}
+    if seconds > 0 and not created:
+        owner, created, vals = wait_for_lease(contact_repository,
+                                              phone_number, dictionary,
+                                              seconds, contact)
+        if vals is not None:
+            common.info('Contact written meanwhile: %s' % phone_number)
+            metrics.set_property('path', 'lease')
+            return vals
+    common.info('Creating new contact: %s' % phone_number)
+    metrics.set_property('path', 'generated')
+    try:
+        vals = (generate_vals or stored_vals)(phone_number, dictionary)
+        # Putting the whole item drops the lease
+        contact_repository.write(phone_number, vals=dict(vals))
+    except Exception:
+        # Leave no item behind that holds only the lease
+        if owner is not None:
+            contact_repository.release_lease(phone_number, owner,
+                                             delete=created)
+        elif created:
+            contact_repository.delete(phone_number, absent=(
+                'vanityNumbers', 'candidates', 'leaseOwner'
+            ))
+        raise
+    return vals
 
 
 def handler(event, context):
+    metrics.start(requestId=getattr(context, 'aws_request_id', None))
+    try:
+        with metrics.span('handler'):
+            return process_contact(event)
+    finally:
+        metrics.flush()
+
+
+def process_contact(event, generate_vals=None):
+    """Announces the vanity numbers of the contact's phone number
 
+    Args:
+        event (dict): Amazon Connect contact flow event
+        generate_vals (callable, optional): stored_vals replacement, e.g.
+            running it in another process
+
+    Returns:
+        dict: result to speak
+
+    """
     vanity_numbers = []
     result = 'Unable to generate vanity numbers. Please contact administrator.'
     customer = jmespath.search('Details.ContactData.CustomerEndpoint', event)
@@ -16,20 +373,28 @@ def handler(event, context):
         contact_type = customer.get('Type')
         if contact_type == 'TELEPHONE_NUMBER':
             phone_number = customer.get('Address')
-            contact_repository = Repository('contacts_store', 'phoneNumber')
-            contact = contact_repository.exists(phone_number)
-            if isinstance(contact, Mapping):
-                common.info('Contact exists: %s' % phone_number)
-                vanity_numbers = contact.get('vanityNumbers')
-                contact_repository.write(phone_number, vals={
-                    'vanityNumbers': vanity_numbers
-                }, update=True)
+            metrics.set_property('phoneNumber', phone_number)
+            contact_repository = Repository(CONTACTS_TABLE, 'phoneNumber')
+            dictionary = requested_dictionary(event)
+            vals = CONTACTS_CACHE.get(phone_number)
+            # Vanity numbers of another dictionary are generated again
+            if vals is not None and vals.get('dictionary') == dictionary:
+                common.info('Contact cached: %s' % phone_number)
+                metrics.set_property('path', 'cache')
+                write_back(contact_repository, phone_number, vals)
             else:
-                common.info('Creating new contact: %s' % phone_number)
-                vanity_numbers = vanity_number.generate(phone_number)
-                contact_repository.write(phone_number, vals={
-                    'vanityNumbers': vanity_numbers
-                })
+                # Concurrent callers of the number share one read, and
+                # generation, of the contact
+                vals, shared = CONTACT_FLIGHTS.do(
+                    (phone_number, dictionary),
+                    lambda: load_contact(contact_repository, phone_number,
+                                         dictionary, generate_vals)
+                )
+                if shared:
+                    common.info('Contact coalesced: %s' % phone_number)
+                    metrics.set_property('path', 'coalesced')
+                CONTACTS_CACHE.put(phone_number, vals)
+            vanity_numbers = vanity_numbers_from(vals)
         else:
             result = 'Unsupported customer type'
     else:
@@ -41,3 +406,7 @@ def handler(event, context):
     return {
         "result": result
     }
+
+
+if common.get_envvar('INIT_PRIME', 'TRUE') == 'TRUE':
+    init()
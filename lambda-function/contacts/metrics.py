@@ -0,0 +1,149 @@
+"""Per invocation timings and counters in CloudWatch embedded metric format
+
+Spans and counters are recorded between start() and flush(), which
+prints them as one JSON line that CloudWatch turns into metrics. Unless
+METRICS_ENABLED is TRUE, start() records nothing and span() and count()
+return straight away.
+
+    metrics.start(requestId=context.aws_request_id)
+    with metrics.span('search'):
+        ...
+    metrics.count('nodes_expanded', expanded)
+    metrics.flush()
+
+"""
+import json
+import os
+import time
+
+import common
+
+
+NAMESPACE = 'VanityNumberGenerator'
+
+_recorder = None
+
+
+class _Recorder(object):
+    def __init__(self, properties):
+        self.timings = {}
+        self.counts = {}
+        self.properties = properties
+
+
+class _Span(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        recorder = _recorder
+        if recorder is not None:
+            elapsed = (time.perf_counter() - self.start) * 1000
+            recorder.timings[self.name] = \
+                recorder.timings.get(self.name, 0) + elapsed
+        return False
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def start(**properties):
+    """Starts recording an invocation when METRICS_ENABLED is TRUE
+
+    Args:
+        properties: values logged with the metrics, e.g. requestId
+
+    Returns:
+        boolean: True when recording
+
+    """
+    global _recorder
+    if common.get_envvar('METRICS_ENABLED', 'FALSE') != 'TRUE':
+        _recorder = None
+        return False
+    _recorder = _Recorder(properties)
+    return True
+
+
+def enabled():
+    return _recorder is not None
+
+
+def span(name):
+    """Times a block, adding up repeated spans of the same name
+
+    Args:
+        name (str): metric name
+
+    Returns:
+        context manager
+
+    """
+    if _recorder is None:
+        return _NO_SPAN
+    return _Span(name)
+
+
+def count(name, value=1):
+    recorder = _recorder
+    if recorder is not None:
+        recorder.counts[name] = recorder.counts.get(name, 0) + value
+
+
+def set_property(name, value):
+    recorder = _recorder
+    if recorder is not None:
+        recorder.properties[name] = value
+
+
+def flush():
+    """Prints the recorded invocation as one EMF JSON line and stops
+
+    Returns:
+        dict: the logged document, None when not recording
+
+    """
+    global _recorder
+    recorder = _recorder
+    _recorder = None
+    if recorder is None:
+        return None
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+    document = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [['FunctionName']],
+                'Metrics': [
+                    {'Name': name, 'Unit': 'Milliseconds'}
+                    for name in sorted(recorder.timings)
+                ] + [
+                    {'Name': name, 'Unit': 'Count'}
+                    for name in sorted(recorder.counts)
+                ]
+            }]
+        },
+        'FunctionName': function_name
+    }
+    document.update(recorder.properties)
+    document.update(
+        (name, round(value, 3)) for name, value in recorder.timings.items()
+    )
+    document.update(recorder.counts)
+    print(json.dumps(document, sort_keys=True))
+    return document
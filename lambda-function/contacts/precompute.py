@@ -0,0 +1,286 @@
+"""Offline vanity numbers of every number of a range
+
+Computes the ranked candidates of every national number of a range, e.g.
+an NPA-NXX block, and writes them in number order as a vanity table (see
+vanity_table.py) or as a DynamoDB import file (gzip compressed DynamoDB
+JSON lines).
+
+    python precompute.py +1-866-266-XXXX -o 866266.vtb [-w WORKERS]
+    python precompute.py +18662660000:+18662669999 -o 866266.json.gz \\
+                         -f dynamodb [-n CANDIDATES] [-d DICTIONARY]
+
+Worker processes compute whole pages of consecutive numbers, so the
+runs of letters of the digits neighbours share come from each worker's
+DIGIT_RUNS_CACHE, and compress them. Pages are appended as they complete
+and a checkpoint is saved every few pages; running the same command
+again resumes from it. Memory stays flat whatever the range size.
+
+"""
+import argparse
+import json
+import os
+import re
+import sys
+
+import candidate_codec
+import common
+import vanity_number
+import vanity_table
+
+OUTPUT_FORMATS = ('table', 'dynamodb')
+# Pages written between checkpoints
+CHECKPOINT_PAGES = 16
+
+
+def parse_range(number_range):
+    """Parses a phone number range
+
+    Args:
+        number_range (str): first:last phone numbers, or a phone number
+            ending in X wildcards, e.g. +1-866-266-XXXX
+
+    Returns:
+        country_code (int): country calling code
+        digits (int): number of national digits
+        first (int): first national number
+        last (int): last national number
+
+    Raises:
+        ValueError: when the range is invalid
+
+    """
+    if ':' in number_range:
+        first, _, last = number_range.partition(':')
+    else:
+        pattern = re.sub(r'[^0-9X+]', '', number_range.upper())
+        if not re.match(r'^\+[0-9]+X*$', pattern):
+            raise ValueError('invalid number range %s' % number_range)
+        first, last = pattern.replace('X', '0'), pattern.replace('X', '9')
+    first_country_code, first_prefix, first_number, _ = \
+        vanity_number.parse_number(first)
+    last_country_code, last_prefix, last_number, _ = \
+        vanity_number.parse_number(last)
+    first_number = first_prefix + first_number
+    last_number = last_prefix + last_number
+    if first_country_code != last_country_code or \
+            len(first_number) != len(last_number) or \
+            int(first_number) > int(last_number):
+        raise ValueError('invalid number range %s' % number_range)
+    return (first_country_code, len(first_number), int(first_number),
+            int(last_number))
+
+
+def compute_page(task):
+    """Computes the candidates of consecutive numbers
+
+    Args:
+        task (tuple): country code, national digits, first national
+            number, count, candidates per number, strategy, dictionary
+            and output format
+
+    Returns:
+        bytes: vanity table page, or gzip member of DynamoDB JSON lines
+
+    """
+    (country_code, digits, first, count, max_results, strategy, dictionary,
+     output_format) = task
+    name = vanity_number.dictionary_name(dictionary)
+    timestamp = common.timestamp()
+    records = []
+    for number in range(first, first + count):
+        phone_number = '+%s%s' % (country_code, str(number).zfill(digits))
+        try:
+            vanity_numbers, ranks = vanity_number.generate_ranked(
+                phone_number, max_results, strategy, dictionary
+            )
+        except Exception as e:
+            common.error('Unable to generate %s: %s' % (phone_number, e))
+            vanity_numbers, ranks = [], []
+        if output_format == 'table':
+            records.append(candidate_codec.encode(vanity_numbers, ranks,
+                                                  compress=False))
+            continue
+        item = {
+            'phoneNumber': {'S': phone_number},
+            'vanityNumbers': {'L': [{'S': v} for v in vanity_numbers]},
+            'lastModified': {'S': timestamp}
+        }
+        if name:
+            item['dictionary'] = {'S': name}
+        records.append(json.dumps({'Item': item}).encode('utf-8') + b'\n')
+    if output_format == 'table':
+        return vanity_table.pack_page(records)
+    import gzip
+    return gzip.compress(b''.join(records))
+
+
+def _save_checkpoint(path, checkpoint):
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def run(number_range, output, output_format='table', workers=None,
+        max_results=5, strategy=None, dictionary=None,
+        page_size=vanity_table.PAGE_SIZE, checkpoint_pages=CHECKPOINT_PAGES):
+    """Computes the candidates of a range and writes them to a file
+
+    The output is written to output.partial, with the start of every page
+    in output.pages, until it is complete. output.checkpoint records how
+    far both are valid, so an interrupted run resumes from there.
+
+    Args:
+        number_range (str): phone number range, see parse_range
+        output (str): output file
+        output_format (str, optional): one of OUTPUT_FORMATS
+        workers (int, optional): worker processes, defaults to CPU count;
+            1 computes in the calling process
+        max_results (int, optional): candidates per number
+        strategy (str, optional): one of SEARCH_STRATEGIES
+        dictionary (str, optional): dictionary name, see get_dictionary
+        page_size (int, optional): numbers per page
+        checkpoint_pages (int, optional): pages between checkpoints
+
+    Returns:
+        dict: numbers, pages and bytes written, and pages resumed
+
+    Raises:
+        ValueError: when the range or output format is invalid, or the
+            checkpoint belongs to another job
+
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('unknown output format %s' % output_format)
+    country_code, digits, first, last = parse_range(number_range)
+    count = last - first + 1
+    pages = -(-count // page_size)
+    dictionary_name = vanity_number.get_dictionary(dictionary).name
+    job = {
+        'countryCode': country_code, 'digits': digits, 'first': first,
+        'count': count, 'format': output_format, 'candidates': max_results,
+        'strategy': strategy, 'dictionary': dictionary_name,
+        'pageSize': page_size
+    }
+    partial_path = '%s.partial' % output
+    pages_path = '%s.pages' % output
+    checkpoint_path = '%s.checkpoint' % output
+    checkpoint = None
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if checkpoint['job'] != job:
+            raise ValueError('%s belongs to another job' % checkpoint_path)
+        common.info('Resuming %s at page %s of %s' % (
+            output, checkpoint['pages'], pages
+        ))
+    else:
+        header = b''
+        if output_format == 'table':
+            header = vanity_table.pack_header(
+                country_code, digits, first, count, page_size, max_results,
+                dictionary_name
+            )
+        with open(partial_path, 'wb') as f:
+            f.write(header)
+        open(pages_path, 'wb').close()
+        checkpoint = {'job': job, 'pages': 0, 'size': len(header)}
+        _save_checkpoint(checkpoint_path, checkpoint)
+    resumed = checkpoint['pages']
+
+    tasks = (
+        (country_code, digits, first + page * page_size,
+         min(page_size, count - page * page_size), max_results, strategy,
+         dictionary, output_format)
+        for page in range(resumed, pages)
+    )
+    with open(partial_path, 'r+b') as data_file, \
+            open(pages_path, 'r+b') as pages_file:
+        # Drops whatever was written after the checkpoint
+        data_file.truncate(checkpoint['size'])
+        data_file.seek(checkpoint['size'])
+        pages_file.truncate(vanity_table.OFFSET.size * checkpoint['pages'])
+        pages_file.seek(0, os.SEEK_END)
+        size = checkpoint['size']
+        done = checkpoint['pages']
+        for data in _compute_pages(tasks, workers):
+            pages_file.write(vanity_table.OFFSET.pack(size))
+            data_file.write(data)
+            size += len(data)
+            done += 1
+            if done % checkpoint_pages == 0 or done == pages:
+                _sync(data_file)
+                _sync(pages_file)
+                checkpoint.update(pages=done, size=size)
+                _save_checkpoint(checkpoint_path, checkpoint)
+                common.info('Precomputed %s of %s pages' % (done, pages))
+        if output_format == 'table':
+            # The page index is copied rather than held in memory
+            pages_file.seek(0)
+            for chunk in iter(lambda: pages_file.read(1 << 20), b''):
+                data_file.write(chunk)
+            data_file.write(vanity_table.pack_index([size]))
+            size = data_file.tell()
+        _sync(data_file)
+    os.replace(partial_path, output)
+    os.remove(pages_path)
+    os.remove(checkpoint_path)
+    return {'numbers': count, 'pages': pages, 'bytes': size,
+            'resumed': resumed}
+
+
+def _compute_pages(tasks, workers):
+    # Pages in range order, computed by worker processes
+    import multiprocessing  # only batch jobs fork workers
+    vanity_number.populate_dictionary_trie()
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        for task in tasks:
+            yield compute_page(task)
+        return
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    initializer = vanity_number.populate_dictionary_trie
+    with context.Pool(workers, initializer=initializer) as pool:
+        for data in pool.imap(compute_page, tasks):
+            yield data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('range', help='e.g. +1-866-266-XXXX or first:last')
+    parser.add_argument('-o', '--output', required=True)
+    parser.add_argument('-f', '--format', default='table',
+                        choices=OUTPUT_FORMATS)
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='worker processes (CPU count)')
+    parser.add_argument('-n', '--max-results', type=int, default=5)
+    parser.add_argument('-s', '--strategy', default=None,
+                        choices=vanity_number.SEARCH_STRATEGIES)
+    parser.add_argument('-d', '--dictionary', default=None,
+                        help='dictionary of the dictionary store (default)')
+    parser.add_argument('--page-size', type=int,
+                        default=vanity_table.PAGE_SIZE)
+    args = parser.parse_args(argv)
+    try:
+        stats = run(args.range, args.output, args.format, args.workers,
+                    args.max_results, args.strategy, args.dictionary,
+                    args.page_size)
+    except ValueError as e:
+        parser.error(str(e))
+    json.dump(stats, sys.stdout)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
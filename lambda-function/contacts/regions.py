@@ -0,0 +1,139 @@
+"""Region settings of vanity number generation
+
+Each region (ISO 3166 code, as phonenumbers names them) spells words on
+a keypad of dictionary_index.KEYPADS, and may keep a fixed prefix of its
+national numbers as digits, e.g. the area code, so only the digits after
+it are searched. Both are compiled into REGIONS once, at import, from
+
+    VANITY_KEYPADS       region=keypad, e.g. XX=bell
+    VANITY_FIXED_PREFIX  region=length, e.g. US=3,GB=area
+
+comma separated, where region * sets the default of the other regions.
+A length is a number of digits, area (the geographic area code, none for
+mobile numbers) or ndc (the national destination code). By default every
+region uses the E.161 keypad and no fixed prefix.
+
+"""
+import common
+import dictionary_index
+
+
+DEFAULT_REGION = '*'
+# Fixed prefix lengths looked up in the number's metadata
+PREFIX_LENGTHS = ('area', 'ndc')
+
+
+class Region(object):
+    __slots__ = ('code', 'keypad', 'fixed_prefix')
+
+    def __init__(self, code, keypad=dictionary_index.DEFAULT_KEYPAD,
+                 fixed_prefix=0):
+        """Settings of a region
+
+        Args:
+            code (str): region code, DEFAULT_REGION for the default
+            keypad (dictionary_index.Keypad, optional): keypad
+            fixed_prefix (int or str, optional): number of leading
+                national digits kept as is, or one of PREFIX_LENGTHS
+
+        """
+        self.code = code
+        self.keypad = keypad
+        self.fixed_prefix = fixed_prefix
+
+    def fixed_prefix_length(self, parsed_number):
+        """Returns the number of leading national digits kept as is
+
+        Args:
+            parsed_number (phonenumbers.PhoneNumber): phone number
+
+        Returns:
+            int: fixed prefix length
+
+        """
+        if self.fixed_prefix == 'area':
+            import phonenumbers
+            return phonenumbers.length_of_geographical_area_code(
+                parsed_number)
+        if self.fixed_prefix == 'ndc':
+            import phonenumbers
+            return phonenumbers.length_of_national_destination_code(
+                parsed_number)
+        return self.fixed_prefix
+
+
+def parse_settings(settings):
+    """Parses comma separated region=value settings
+
+    Args:
+        settings (str): e.g. US=3,GB=area
+
+    Returns:
+        dict: value by upper case region code
+
+    """
+    parsed = {}
+    for setting in settings.split(','):
+        if not setting.strip():
+            continue
+        region, sep, value = setting.partition('=')
+        if not sep or not region.strip() or not value.strip():
+            common.error('Invalid region setting %s' % setting)
+            continue
+        parsed[region.strip().upper()] = value.strip()
+    return parsed
+
+
+def compile_regions(keypads='', fixed_prefixes=''):
+    """Compiles region settings
+
+    Args:
+        keypads (str, optional): region=keypad settings
+        fixed_prefixes (str, optional): region=length settings
+
+    Returns:
+        dict: Region by region code, DEFAULT_REGION included
+
+    """
+    keypads = parse_settings(keypads)
+    fixed_prefixes = parse_settings(fixed_prefixes)
+    for region, name in list(keypads.items()):
+        if name not in dictionary_index.KEYPADS:
+            common.error('Unknown keypad %s for %s' % (name, region))
+            del keypads[region]
+    for region, length in list(fixed_prefixes.items()):
+        if length in PREFIX_LENGTHS:
+            continue
+        if length.isdigit():
+            fixed_prefixes[region] = int(length)
+        else:
+            common.error('Invalid fixed prefix %s for %s' % (length, region))
+            del fixed_prefixes[region]
+    default_keypad = keypads.get(DEFAULT_REGION,
+                                 dictionary_index.DEFAULT_KEYPAD.name)
+    default_fixed_prefix = fixed_prefixes.get(DEFAULT_REGION, 0)
+    return {
+        region: Region(
+            region,
+            dictionary_index.KEYPADS[keypads.get(region, default_keypad)],
+            fixed_prefixes.get(region, default_fixed_prefix)
+        )
+        for region in set(keypads) | set(fixed_prefixes) | {DEFAULT_REGION}
+    }
+
+
+def get_region(code):
+    """Returns the settings of a region
+
+    Args:
+        code (str): region code, None when unknown
+
+    Returns:
+        Region: region settings, the default ones for other regions
+
+    """
+    return REGIONS.get(code) or REGIONS[DEFAULT_REGION]
+
+
+REGIONS = compile_regions(common.get_envvar('VANITY_KEYPADS', ''),
+                          common.get_envvar('VANITY_FIXED_PREFIX', ''))
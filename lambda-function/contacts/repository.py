@@ -1,15 +1,135 @@
 from collections import Mapping
-import json
+from concurrent.futures import ThreadPoolExecutor
 import os
+import random
+import threading
+import time
 
 import boto3
+from boto3.dynamodb.types import TypeSerializer
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 import common
+import metrics
 from exceptions import ItemNotFoundException
 from exceptions import RepositoryException
 
 
+# boto3 resources and clients by region and tables by (region, name), built
+# once per container so the session, endpoint and connection pool are reused
+DYNAMODB_RESOURCES = {}
+DYNAMODB_CLIENTS = {}
+DYNAMODB_TABLES = {}
+_registry_lock = threading.Lock()
+
+# DynamoDB limits on keys per BatchGetItem and items per BatchWriteItem
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+
+_serializer = TypeSerializer()
+
+
+def _get_or_build(registry, key, build):
+    value = registry.get(key)
+    if value is not None:
+        return value
+    with _registry_lock:
+        value = registry.get(key)
+        if value is None:
+            value = registry[key] = build()
+    return value
+
+
+def _dynamodb_config():
+    options = {
+        'max_pool_connections': common.get_envvar(
+            'DYNAMODB_MAX_POOL_CONNECTIONS', 10
+        )
+    }
+    # Not an option of the botocore pinned for python 3.6 and 3.7
+    if 'tcp_keepalive' in Config.OPTION_DEFAULTS:
+        options['tcp_keepalive'] = common.get_envvar(
+            'DYNAMODB_TCP_KEEPALIVE', 'TRUE'
+        ) == 'TRUE'
+    return Config(**options)
+
+
+def get_dynamodb_resource(region_name=None):
+    """Returns the shared dynamodb resource for a region
+
+    The pool size and keep-alive come from DYNAMODB_MAX_POOL_CONNECTIONS
+    (default 10) and DYNAMODB_TCP_KEEPALIVE (default TRUE), the latter only
+    with a botocore that supports it.
+
+    Args:
+        region_name (str, optional): AWS region, AWS_REGION by default
+
+    Returns:
+        dynamodb service resource
+
+    """
+    region_name = region_name or os.environ.get('AWS_REGION', 'us-east-1')
+    # The default session is not thread safe, use a private one
+    return _get_or_build(
+        DYNAMODB_RESOURCES, region_name,
+        lambda: boto3.session.Session().resource(
+            'dynamodb', region_name=region_name, config=_dynamodb_config()
+        )
+    )
+
+
+def get_dynamodb_client(region_name=None):
+    """Returns the shared low level dynamodb client for a region
+
+    Unlike resource.meta.client, it sends and returns attribute values in
+    the low level format, without boto3 type conversion.
+
+    Args:
+        region_name (str, optional): AWS region, AWS_REGION by default
+
+    Returns:
+        dynamodb client
+
+    """
+    region_name = region_name or os.environ.get('AWS_REGION', 'us-east-1')
+    return _get_or_build(
+        DYNAMODB_CLIENTS, region_name,
+        lambda: boto3.session.Session().client(
+            'dynamodb', region_name=region_name, config=_dynamodb_config()
+        )
+    )
+
+
+def get_dynamodb_table(name, region_name=None):
+    """Returns the shared dynamodb table
+
+    Args:
+        name (str): dynamodb table
+        region_name (str, optional): AWS region, AWS_REGION by default
+
+    Returns:
+        dynamodb Table resource
+
+    """
+    region_name = region_name or os.environ.get('AWS_REGION', 'us-east-1')
+    key = (region_name, name)
+    table = DYNAMODB_TABLES.get(key)
+    if table is None:
+        table = get_dynamodb_resource(region_name).Table(name)
+        with _registry_lock:
+            table = DYNAMODB_TABLES.setdefault(key, table)
+    return table
+
+
+def reset_dynamodb_resources():
+    """Drops the shared resources, e.g. after credentials change"""
+    with _registry_lock:
+        DYNAMODB_RESOURCES.clear()
+        DYNAMODB_CLIENTS.clear()
+        DYNAMODB_TABLES.clear()
+
+
 class Repository(object):
     entity = None
     repository = None
@@ -26,11 +146,14 @@ class Repository(object):
         self.hk_attr = hk
         self.repository = 'dynamodb'
 
-    def get(self, hk):
+    def get(self, hk, decompress=True, consistent=False):
         """Get respository item
 
         Args:
             hk (str): hash key
+            decompress (bool or iterable, optional): binary attributes to
+                gunzip and parse, True for all; others are left as bytes
+            consistent (bool, optional): strongly consistent read
 
         Returns:
             dict: repository item
@@ -39,20 +162,25 @@ class Repository(object):
             ItemNotFoundException: when repository item doesnt exist
 
         """
-        return self._call('get', hk)
+        return self._call('get', hk, decompress=decompress,
+                          consistent=consistent)
 
-    def exists(self, hk, must_exist=False):
+    def exists(self, hk, must_exist=False, decompress=True,
+               consistent=False):
         """Return True if respository item exists otherwise False
 
         Args:
             hk (str): hash key / tenant ID
+            decompress (bool or iterable, optional): as for get()
+            consistent (bool, optional): as for get()
 
         Returns:
             boolean: True or False
 
         """
         try:
-            item = self._call('get', hk)
+            item = self._call('get', hk, decompress=decompress,
+                              consistent=consistent)
         except ItemNotFoundException:
             if must_exist is True:
                 raise ItemNotFoundException(
@@ -85,8 +213,137 @@ class Repository(object):
             vals['lastModified'] = common.timestamp()
         return self._call('write', hk, vals=vals, update=update)
 
-    def _call(self, operation, hk, **kwargs):
-        suffix = 'item'
+    def touch(self, hk, decompress=True, create=False):
+        """Set lastModified of a respository item and get it
+
+        One UpdateItem both records the access and reads the item back,
+        where exists() and write() would take two calls. Missing items
+        are left missing unless create is set.
+
+        Args:
+            hk (str): hash key
+            decompress (bool or iterable, optional): as for get()
+            create (bool, optional): create a missing item holding only
+                its hash key and lastModified
+
+        Returns:
+            dict: repository item as it was before the update, {} when
+                it was created, False when it does not exist
+
+        Raises:
+            RepositoryException: when the item can not be updated
+
+        """
+        return self._call('touch', hk, decompress=decompress, create=create)
+
+    def delete(self, hk, absent=()):
+        """Delete a respository item
+
+        Args:
+            hk (str): hash key
+            absent (iterable, optional): attributes the item must not
+                have to be deleted
+
+        Returns:
+            bool: False when the item was kept
+
+        Raises:
+            RepositoryException: when the item can not be deleted
+
+        """
+        return self._call('delete', hk, absent=absent)
+
+    def acquire_lease(self, hk, owner, seconds):
+        """Take the lease of a respository item
+
+        The lease is held in the leaseOwner and leaseExpires (epoch
+        milliseconds) attributes of the item, created if need be, and is
+        taken only when no unexpired lease is held. Writing the whole item
+        with write() drops it.
+
+        Args:
+            hk (str): hash key
+            owner (str): unique lease owner
+            seconds (float): lease duration
+
+        Returns:
+            dict: the item as it was before, empty when it did not exist,
+                None when another owner holds the lease
+
+        Raises:
+            RepositoryException: when the lease can not be written
+
+        """
+        return self._call('acquire', hk, suffix='lease', owner=owner,
+                          seconds=seconds)
+
+    def release_lease(self, hk, owner, delete=False):
+        """Release a lease taken with acquire_lease()
+
+        Args:
+            hk (str): hash key
+            owner (str): lease owner
+            delete (bool, optional): delete the item along with the lease,
+                e.g. when acquire_lease() created it
+
+        Returns:
+            bool: False when the lease was no longer held by owner
+
+        Raises:
+            RepositoryException: when the lease can not be written
+
+        """
+        return self._call('release', hk, suffix='lease', owner=owner,
+                          delete=delete)
+
+    def get_many(self, hks, decompress=True):
+        """Get respository items in batches
+
+        Args:
+            hks (iterable): hash keys
+            decompress (bool or iterable, optional): as for get()
+
+        Returns:
+            dict: repository items by hash key, missing items are left out
+
+        Raises:
+            RepositoryException: when a batch can not be read
+
+        """
+        return self._call('get', hks, suffix='items', decompress=decompress)
+
+    def write_many(self, items):
+        """Write respository items in batches
+
+        Items are put whole, as by write() without update.
+
+        Args:
+            items (dict): dictionary of values to write by hash key
+
+        Returns:
+            int: number of items written
+
+        Raises:
+            RepositoryException: when a batch can not be written
+
+        """
+        if not isinstance(items, Mapping):
+            raise RepositoryException(
+                'unable to write to repository',
+                'items must be a dict'
+            )
+        timestamp = common.timestamp()
+        for hk, vals in items.items():
+            if not isinstance(vals, Mapping) or len(vals) == 0:
+                raise RepositoryException(
+                    'unable to write to repository',
+                    'vals for %s must be non empty dict' % hk
+                )
+            if 'lastModified' not in vals:
+                vals['lastModified'] = timestamp
+        return self._call('write', items, suffix='items')
+
+    def _call(self, operation, hk, suffix='item', **kwargs):
         method_name = '_%s_%s_%s' % (
             operation, self.repository, suffix
         )
@@ -96,20 +353,21 @@ class Repository(object):
             ), 2
         )
         method = getattr(self, method_name)
-        return method(hk, **kwargs)
+        with metrics.span('%s_%s_%s' % (self.repository, operation, suffix)):
+            return method(hk, **kwargs)
 
     def _get_dynamodb_table(self):
-        kwargs = {
-            'region_name': os.environ.get('AWS_REGION', 'us-east-1')
-        }
-        return boto3.resource('dynamodb', **kwargs).Table(self.entity)
+        return get_dynamodb_table(self.entity)
 
     def _get_dynamodb_key(self, hk):
         key = {}
         key[self.hk_attr] = hk
         return key
 
-    def _get_dynamodb_item(self, hk):
+    def _get_dynamodb_client_key(self, hk):
+        return {self.hk_attr: _serializer.serialize(hk)}
+
+    def _get_dynamodb_item(self, hk, decompress=True, consistent=False):
         title = '%s not found' % self.entity
         detail = '%s not found' % (self.entity)
         dbgmsg = 'unable to get dynamodb item %s [%s]' % (
@@ -117,8 +375,11 @@ class Repository(object):
         )
         response = None
         try:
-            response = self._get_dynamodb_table().get_item(
-                Key=self._get_dynamodb_key(hk)
+            # The low level client skips the resource's TypeDeserializer
+            response = get_dynamodb_client().get_item(
+                TableName=self.entity,
+                Key=self._get_dynamodb_client_key(hk),
+                ConsistentRead=consistent
             )
         except ClientError as e:
             code = e.response['Error']['Code']
@@ -138,28 +399,263 @@ class Repository(object):
                 detail
             )
         try:
-            item = json.loads(json.dumps(
-                response['Item'], default=common.json_serial
-            ))
-            return item
+            return common.from_dynamodb_item(response['Item'], decompress)
         except Exception as e:
             raise RepositoryException(
                 title,
                 '%s: %s' % (detail, e)
             )
 
+    def _touch_dynamodb_item(self, hk, decompress=True, create=False):
+        title = 'unable to update %s' % self.entity
+        detail = 'unable to touch dynamodb item %s [%s]' % (self.entity, hk)
+        kwargs = {} if create else {
+            'ConditionExpression': 'attribute_exists(#hk)'
+        }
+        names = {'#modified': 'lastModified'}
+        if not create:
+            names['#hk'] = self.hk_attr
+        try:
+            response = get_dynamodb_client().update_item(
+                TableName=self.entity,
+                Key=self._get_dynamodb_client_key(hk),
+                UpdateExpression='SET #modified = :modified',
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues={
+                    ':modified': {'S': common.timestamp()}
+                },
+                ReturnValues='ALL_OLD',
+                **kwargs
+            )
+            return common.from_dynamodb_item(response.get('Attributes', {}),
+                                             decompress)
+        except ClientError as e:
+            if e.response['Error']['Code'] == \
+                    'ConditionalCheckFailedException':
+                return False
+            raise RepositoryException(
+                title,
+                '%s: %s' % (detail, e.response['Error']['Code'])
+            )
+        except Exception as e:
+            raise RepositoryException(
+                title,
+                '%s: %s' % (detail, e)
+            )
+
+    def _delete_dynamodb_item(self, hk, absent=()):
+        names = {'#a%s' % i: name for i, name in enumerate(absent)}
+        kwargs = {}
+        if names:
+            kwargs['ConditionExpression'] = ' AND '.join(
+                'attribute_not_exists(%s)' % alias for alias in sorted(names)
+            )
+            kwargs['ExpressionAttributeNames'] = names
+        try:
+            get_dynamodb_client().delete_item(
+                TableName=self.entity,
+                Key=self._get_dynamodb_client_key(hk),
+                **kwargs
+            )
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'ConditionalCheckFailedException':
+                return False
+            raise RepositoryException(
+                'unable to delete %s' % self.entity,
+                'unable to delete dynamodb item %s [%s]: %s' % (
+                    self.entity, hk, code
+                )
+            )
+        except Exception as e:
+            raise RepositoryException(
+                'unable to delete %s' % self.entity,
+                'unable to delete dynamodb item %s [%s]: %s' % (
+                    self.entity, hk, e
+                )
+            )
+        return True
+
+    def _update_dynamodb_lease(self, hk, delete=False, **kwargs):
+        # Conditional update, or delete, of the lease attributes, None
+        # when the condition fails
+        client = get_dynamodb_client()
+        names = {'#owner': 'leaseOwner'}
+        if not delete:
+            names['#expires'] = 'leaseExpires'
+        try:
+            response = (client.delete_item if delete else client.update_item)(
+                TableName=self.entity,
+                Key=self._get_dynamodb_client_key(hk),
+                ExpressionAttributeNames=names,
+                **kwargs
+            )
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'ConditionalCheckFailedException':
+                return None
+            raise RepositoryException(
+                'unable to lease %s' % self.entity,
+                'unable to lease dynamodb item %s [%s]: %s' % (
+                    self.entity, hk, code
+                )
+            )
+        except Exception as e:
+            raise RepositoryException(
+                'unable to lease %s' % self.entity,
+                'unable to lease dynamodb item %s [%s]: %s' % (
+                    self.entity, hk, e
+                )
+            )
+        return response.get('Attributes', {})
+
+    def _acquire_dynamodb_lease(self, hk, owner, seconds):
+        now = int(time.time() * 1000)
+        item = self._update_dynamodb_lease(
+            hk,
+            UpdateExpression='SET #owner = :owner, #expires = :expires',
+            ConditionExpression='attribute_not_exists(#expires) OR '
+                                '#expires < :now',
+            ExpressionAttributeValues={
+                ':owner': {'S': owner},
+                ':expires': {'N': str(now + int(seconds * 1000))},
+                ':now': {'N': str(now)}
+            },
+            ReturnValues='ALL_OLD'
+        )
+        if item is None:
+            return None
+        return common.from_dynamodb_item(item, decompress=False)
+
+    def _release_dynamodb_lease(self, hk, owner, delete=False):
+        kwargs = {} if delete else {
+            'UpdateExpression': 'REMOVE #owner, #expires'
+        }
+        return self._update_dynamodb_lease(
+            hk,
+            delete=delete,
+            ConditionExpression='#owner = :owner',
+            ExpressionAttributeValues={':owner': {'S': owner}},
+            **kwargs
+        ) is not None
+
+    def _run_dynamodb_batches(self, batch, chunks):
+        workers = common.get_envvar('DYNAMODB_BATCH_WORKERS', 4)
+        if workers <= 1 or len(chunks) <= 1:
+            return [batch(chunk) for chunk in chunks]
+        with ThreadPoolExecutor(min(workers, len(chunks))) as executor:
+            return list(executor.map(batch, chunks))
+
+    def _retry_dynamodb_batch(self, request, unprocessed_key, call):
+        """Calls a batch operation until nothing is left unprocessed
+
+        Unprocessed keys or items are resent after an exponential backoff
+        with full jitter.
+
+        Args:
+            request (dict): RequestItems of the first call
+            unprocessed_key (str): UnprocessedKeys or UnprocessedItems
+            call (function): batch operation taking RequestItems
+
+        Returns:
+            list: responses of every call
+
+        Raises:
+            RepositoryException: when items are left after the retries
+
+        """
+        retries = common.get_envvar('DYNAMODB_BATCH_RETRIES', 8)
+        responses = []
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                time.sleep(random.uniform(0, min(2.0, 0.05 * 2 ** attempt)))
+            response = call(RequestItems=request)
+            responses.append(response)
+            request = response.get(unprocessed_key)
+            if not request:
+                return responses
+        raise RepositoryException(
+            'unable to process %s batch' % self.entity,
+            '%s left after %s retries' % (unprocessed_key, retries)
+        )
+
+    def _get_dynamodb_items(self, hks, decompress=True):
+        title = 'unable to get %s items' % self.entity
+        hks = list(dict.fromkeys(hks))
+        chunks = [hks[i:i + BATCH_GET_SIZE]
+                  for i in range(0, len(hks), BATCH_GET_SIZE)]
+        client = get_dynamodb_client()
+
+        def batch(chunk):
+            request = {self.entity: {
+                'Keys': [self._get_dynamodb_client_key(hk) for hk in chunk]
+            }}
+            responses = self._retry_dynamodb_batch(
+                request, 'UnprocessedKeys', client.batch_get_item
+            )
+            return [item for response in responses
+                    for item in response['Responses'].get(self.entity, [])]
+
+        try:
+            items = {}
+            for result in self._run_dynamodb_batches(batch, chunks):
+                for item in result:
+                    item = common.from_dynamodb_item(item, decompress)
+                    items[item[self.hk_attr]] = item
+            return items
+        except RepositoryException:
+            raise
+        except Exception as e:
+            raise RepositoryException(
+                title,
+                'unable to get dynamodb items %s: %s' % (self.entity, e)
+            )
+
+    def _write_dynamodb_items(self, items):
+        title = 'unable to write %s items' % self.entity
+        # The low level client is thread safe, unlike the resource
+        client = get_dynamodb_client()
+
+        def batch(chunk):
+            self._retry_dynamodb_batch(
+                {self.entity: chunk}, 'UnprocessedItems',
+                client.batch_write_item
+            )
+            return len(chunk)
+
+        try:
+            requests = []
+            for hk, vals in items.items():
+                item = dict(vals)
+                item.update(self._get_dynamodb_key(hk))
+                requests.append({'PutRequest': {'Item': {
+                    k: _serializer.serialize(v) for k, v in item.items()
+                }}})
+            chunks = [requests[i:i + BATCH_WRITE_SIZE]
+                      for i in range(0, len(requests), BATCH_WRITE_SIZE)]
+            return sum(self._run_dynamodb_batches(batch, chunks))
+        except RepositoryException:
+            raise
+        except Exception as e:
+            raise RepositoryException(
+                title,
+                'unable to write dynamodb items %s: %s' % (self.entity, e)
+            )
+
     def _write_dynamodb_item(self, hk, vals, update=False):
         title = 'unable to %s %s' % (
             'update' if update is True else 'create',
             self.entity
         )
         try:
-            table = self._get_dynamodb_table()
+            # The low level client is thread safe, unlike the resource
+            client = get_dynamodb_client()
             key = self._get_dynamodb_key(hk)
             vals.pop(self.hk_attr, None)
             if update is True:
                 kwargs = {
-                    'Key': key,
+                    'TableName': self.entity,
+                    'Key': self._get_dynamodb_client_key(hk),
                     'ReturnValues': 'ALL_NEW'
                 }
                 exp = []
@@ -170,19 +666,23 @@ class Repository(object):
                         v = None
                     aliases['#%s' % k] = k
                     exp.append('#%s = :%s' % (k, k))
-                    _vals[':%s' % k] = v
+                    _vals[':%s' % k] = _serializer.serialize(v)
                 if len(_vals):
                     kwargs['ExpressionAttributeValues'] = _vals
                     kwargs['UpdateExpression'] = 'set %s' % ', '.join(exp)
                 if len(aliases):
                     kwargs['ExpressionAttributeNames'] = aliases
-                    print(kwargs)
-                    response = table.update_item(**kwargs)
-                    vals.update(response.get('Attributes'))
+                    common.debug('update_item %s' % kwargs, 2)
+                    response = client.update_item(**kwargs)
+                    vals.update(common.from_dynamodb_item(
+                        response.get('Attributes', {}), decompress=False
+                    ))
             else:
                 vals.update(key)
-                print(vals)
-                table.put_item(Item=vals)
+                common.debug('put_item %s' % vals, 2)
+                client.put_item(TableName=self.entity, Item={
+                    k: _serializer.serialize(v) for k, v in vals.items()
+                })
             return vals
         except Exception as e:
             raise RepositoryException(
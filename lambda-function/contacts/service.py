@@ -0,0 +1,311 @@
+"""HTTP service answering contact flow events outside of Lambda
+
+Serves the Lambda function from a long running process, e.g. for an
+on-premises IVR. POST / takes the Amazon Connect contact flow event JSON
+the Lambda function gets and returns its result; GET /health returns the
+queue depth and counters.
+
+    python service.py [--host 0.0.0.0] [--port 8080] [-w WORKERS]
+                      [--threads N] [--max-pending N]
+
+The dictionary, phone number metadata, vanity tables and DynamoDB
+resources are loaded once, when index is imported (see index.init), and
+kept warm. Contacts are processed on a thread pool, which waits on
+DynamoDB, while their vanity numbers are searched on a process pool
+forked after init, so workers share the dictionary pages. At most
+max-pending contacts are admitted at a time; others get 503 with
+Retry-After straight away instead of waiting behind a backlog. EMF
+metrics are only recorded by index.handler.
+
+"""
+import argparse
+import asyncio
+import functools
+import json
+import signal
+
+import common
+import index
+import vanity_number
+
+
+MAX_BODY_SIZE = 64 * 1024
+MAX_HEADERS = 100
+# Seconds a rejected client is asked to wait
+RETRY_AFTER = 1
+REASONS = {
+    200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+    405: 'Method Not Allowed', 413: 'Payload Too Large',
+    500: 'Internal Server Error', 503: 'Service Unavailable',
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message=None, headers=None):
+        super(HttpError, self).__init__(message or REASONS[status])
+        self.status = status
+        self.headers = headers or {}
+
+
+class VanityService(object):
+    def __init__(self, workers=None, threads=None, max_pending=None):
+        """Contact processing with bounded pools and admission control
+
+        Args:
+            workers (int, optional): search processes, SERVICE_WORKERS
+                or the CPU count by default; 0 searches on the threads
+            threads (int, optional): contact threads, SERVICE_THREADS or
+                4 per worker by default
+            max_pending (int, optional): contacts admitted at a time,
+                SERVICE_MAX_PENDING or 2 per thread by default
+
+        """
+        import multiprocessing
+        from concurrent.futures import ThreadPoolExecutor
+
+        if workers is None:
+            workers = common.get_envvar('SERVICE_WORKERS',
+                                        multiprocessing.cpu_count())
+        if threads is None:
+            threads = common.get_envvar('SERVICE_THREADS',
+                                        4 * max(workers, 1))
+        if max_pending is None:
+            max_pending = common.get_envvar('SERVICE_MAX_PENDING',
+                                            2 * threads)
+        self.workers = workers
+        self.threads = threads
+        self.max_pending = max_pending
+        self.pending = 0
+        self.served = 0
+        self.rejected = 0
+        self.errors = 0
+        self.process_pool = None
+        if workers > 0:
+            # Forked before any thread starts, sharing the loaded dictionary
+            vanity_number.populate_dictionary_trie()
+            if 'fork' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('fork')
+            else:
+                context = multiprocessing.get_context()
+            self.process_pool = context.Pool(
+                workers, initializer=vanity_number.populate_dictionary_trie
+            )
+        self.thread_pool = ThreadPoolExecutor(threads)
+
+    def generate_vals(self, phone_number, dictionary=None):
+        """index.stored_vals on the process pool, from a contact thread"""
+        if self.process_pool is None:
+            return index.stored_vals(phone_number, dictionary)
+        return self.process_pool.apply(index.stored_vals,
+                                       (phone_number, dictionary))
+
+    def status(self):
+        return {
+            'status': 'ok', 'pending': self.pending,
+            'maxPending': self.max_pending, 'served': self.served,
+            'rejected': self.rejected, 'errors': self.errors,
+            'workers': self.workers, 'threads': self.threads,
+        }
+
+    async def process(self, event):
+        """Processes a contact flow event on the pools
+
+        Args:
+            event (dict): Amazon Connect contact flow event
+
+        Returns:
+            dict: index.process_contact result
+
+        Raises:
+            HttpError: 503 when max_pending contacts are being processed
+
+        """
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HttpError(503, 'Overloaded, %s contacts pending' %
+                            self.pending, {'Retry-After': str(RETRY_AFTER)})
+        self.pending += 1
+        try:
+            result = await asyncio.get_event_loop().run_in_executor(
+                self.thread_pool, functools.partial(
+                    index.process_contact, event, self.generate_vals
+                )
+            )
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.pending -= 1
+        self.served += 1
+        return result
+
+    async def respond(self, method, path, body):
+        """Returns the status and JSON document answering a request"""
+        if path == '/health':
+            if method != 'GET':
+                raise HttpError(405)
+            return 200, self.status()
+        if path != '/':
+            raise HttpError(404)
+        if method != 'POST':
+            raise HttpError(405)
+        try:
+            event = json.loads(body.decode('utf-8'))
+        except ValueError as e:
+            raise HttpError(400, 'Invalid JSON: %s' % e)
+        return 200, await self.process(event)
+
+    async def handle_connection(self, reader, writer):
+        """Serves the HTTP/1.1 requests of a connection"""
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                response_headers = {}
+                try:
+                    status, document = await self.respond(method, path,
+                                                          body)
+                except HttpError as e:
+                    status, document = e.status, {'error': str(e)}
+                    response_headers.update(e.headers)
+                except Exception as e:
+                    common.error('Unable to process request: %s' % e)
+                    status, document = 500, {'error': REASONS[500]}
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                write_response(writer, status, document, response_headers,
+                               keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except HttpError as e:
+            write_response(writer, e.status, {'error': str(e)}, e.headers,
+                           False)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='0.0.0.0', port=8080):
+        """Starts listening
+
+        Args:
+            host (str, optional): interface
+            port (int, optional): port, 0 for any free one
+
+        Returns:
+            asyncio.Server: server
+
+        """
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    def close(self):
+        self.thread_pool.shutdown(wait=True)
+        if self.process_pool is not None:
+            self.process_pool.terminate()
+            self.process_pool.join()
+
+
+async def read_request(reader):
+    """Reads an HTTP/1.1 request
+
+    Args:
+        reader (asyncio.StreamReader): connection
+
+    Returns:
+        tuple: (method, path, headers, body), None when the client closed
+            the connection
+
+    Raises:
+        HttpError: on malformed or too large requests
+
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    parts = line.decode('latin-1').split()
+    if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+        raise HttpError(400, 'Invalid request line')
+    method, target, _ = parts
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise HttpError(400, 'Too many headers')
+        name, sep, value = line.decode('latin-1').partition(':')
+        if not sep:
+            raise HttpError(400, 'Invalid header')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HttpError(400, 'Invalid Content-Length')
+    if length > MAX_BODY_SIZE:
+        raise HttpError(413)
+    body = await reader.readexactly(length) if length > 0 else b''
+    return method, target.split('?', 1)[0], headers, body
+
+
+def write_response(writer, status, document, headers=None, keep_alive=True):
+    """Writes a JSON HTTP/1.1 response
+
+    Args:
+        writer (asyncio.StreamWriter): connection
+        status (int): HTTP status
+        document (dict): JSON body
+        headers (dict, optional): extra headers
+        keep_alive (bool, optional): keep the connection open
+
+    """
+    body = json.dumps(document).encode('utf-8')
+    lines = ['HTTP/1.1 %s %s' % (status, REASONS.get(status, '')),
+             'Content-Type: application/json',
+             'Content-Length: %s' % len(body),
+             'Connection: %s' % ('keep-alive' if keep_alive else 'close')]
+    lines.extend('%s: %s' % item for item in (headers or {}).items())
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+
+
+async def serve(host, port, workers=None, threads=None, max_pending=None):
+    """Runs the service until SIGINT or SIGTERM"""
+    service = VanityService(workers, threads, max_pending)
+    server = await service.start(host, port)
+    common.info('Serving on %s' % ', '.join(
+        '%s:%s' % sock.getsockname()[:2] for sock in server.sockets
+    ))
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        service.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='search processes (CPU count)')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='contact threads (4 per worker)')
+    parser.add_argument('--max-pending', type=int, default=None,
+                        help='contacts admitted at a time (2 per thread)')
+    args = parser.parse_args(argv)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(serve(args.host, args.port, args.workers,
+                                  args.threads, args.max_pending))
+
+
+if __name__ == '__main__':
+    main()
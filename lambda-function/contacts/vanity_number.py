@@ -1,46 +1,103 @@
 from collections import deque
-from english_words import english_words_set
 import heapq
-import phonenumbers
-import pygtrie as trie
+import itertools
+import time
+
+import common
+import dictionary_index
+import metrics
+import regions
 
 
 is_dictionary_trie_populated = False
+DICTIONARY_STORE = None
+# Default dictionary of the store, see get_dictionary() for the others
 DICTIONARY_TRIE = None
+# (dictionary, keypad, digit substring) -> runs of letters spelling it,
+# shared across numbers
+DIGIT_RUNS_CACHE = common.LRUCache(
+    common.get_envvar('VANITY_CACHE_SIZE', 100000)
+)
+
+# Letters of the default keypad, see regions for the others
+DIGIT_TO_CHARS = dictionary_index.DEFAULT_KEYPAD.digit_to_chars
+
+SEARCH_STRATEGIES = ('segment', 'best_first', 'bfs')
+DEFAULT_SEARCH_STRATEGY = 'segment'
+# Regions whose phone number metadata prime() loads, comma separated
+DEFAULT_REGIONS = 'US'
 
 
 class Node(object):
+    """Search node
+
+    A node created with a parent only stores the chars it appends to the
+    parent's word, and the full word is rebuilt when wordified_so_far is
+    read. Slots and the shared prefix keep frontier nodes to a single
+    allocation each. The weight of a node, the highest weight of the
+    dictionary words scored so far, breaks ties between equal ranks.
+
+    """
+    __slots__ = ('chars', 'index_so_far', 'number_of_chars_in_word',
+                 'max_len_substring', 'max_continous_chars', 'parent',
+                 'run_start', 'weight')
+
     def __init__(self, wordified_so_far, index_so_far,
                  number_of_chars_in_word, max_len_substring,
-                 max_continous_chars):
-        self.wordified_so_far = wordified_so_far
+                 max_continous_chars, parent=None, run_start=None, weight=0):
+        self.chars = wordified_so_far
         self.index_so_far = index_so_far
         self.number_of_chars_in_word = number_of_chars_in_word
         self.max_continous_chars = max_continous_chars
         self.max_len_substring = max_len_substring
+        self.parent = parent
+        # Start of the open run of letters, index_so_far when there is none
+        self.run_start = index_so_far if run_start is None else run_start
+        self.weight = weight
+
+    @property
+    def rank(self):
+        """Heap key: max length of substrings; max continuous chars; number
+        of chars"""
+        return (self.max_len_substring, self.max_continous_chars,
+                self.number_of_chars_in_word)
+
+    @property
+    def run(self):
+        """Open run of letters ending at index_so_far"""
+        chars = []
+        node = self
+        while node.parent is not None and node.index_so_far > self.run_start:
+            chars.append(node.chars)
+            node = node.parent
+        chars.reverse()
+        return ''.join(chars)
+
+    @property
+    def wordified_so_far(self):
+        chars = []
+        node = self
+        while node.parent is not None:
+            chars.append(node.chars)
+            node = node.parent
+        chars.reverse()
+        # The root holds the whole number, digits not replaced yet included
+        return (node.chars[:node.index_so_far] + ''.join(chars) +
+                node.chars[self.index_so_far:])
 
     # Comparator functions:
     # Compare max length of substrings; max continuous chars; number of chars
+    def __lt__(self, other):
+        return self.rank < other.rank
+
     def __le__(self, other):
-        return ((self.max_len_substring < other.max_len_substring) or
-                ((self.max_len_substring == other.max_len_substring) and
-                (self.max_continous_chars < other.max_continous_chars)) or
-                ((self.max_len_substring == other.max_len_substring) and
-                (self.max_continous_chars == other.max_continous_chars) and
-                (self.number_of_chars_in_word < other.number_of_chars_in_word)))  # noqa: E501
+        return self.rank < other.rank
 
     def __eq__(self, other):
-        return ((self.max_len_substring == other.max_len_substring) and
-                (self.max_continous_chars == other.max_continous_chars) and
-                (self.number_of_chars_in_word == other.number_of_chars_in_word))  # noqa: E501
+        return self.rank == other.rank
 
     def __gt__(self, other):
-        return ((self.max_len_substring > other.max_len_substring) or
-                ((self.max_len_substring == other.max_len_substring) and
-                (self.max_continous_chars > other.max_continous_chars)) or
-                ((self.max_len_substring == other.max_len_substring) and
-                (self.max_continous_chars == other.max_continous_chars) and
-                (self.number_of_chars_in_word > other.number_of_chars_in_word)))  # noqa: E501
+        return self.rank > other.rank
 
 
 def replace_string_with_char_at_index(str, index, char):
@@ -50,22 +107,125 @@ def replace_string_with_char_at_index(str, index, char):
 
 def populate_dictionary_trie():
     global is_dictionary_trie_populated
+    global DICTIONARY_STORE
     global DICTIONARY_TRIE
 
     if is_dictionary_trie_populated and DICTIONARY_TRIE is not None:
         # To avoid re-populating the Trie
         return DICTIONARY_TRIE
 
-    DICTIONARY_TRIE = trie.Trie()
-
-    for word in english_words_set:
-        if len(word) >= 3 and len(word) <= 10:
-            DICTIONARY_TRIE[word.upper()] = True
+    # Memory mapped, compiled at build time by dictionary_index.py
+    with metrics.span('dictionary_load'):
+        DICTIONARY_STORE = dictionary_index.load_store()
+    name = common.get_envvar('VANITY_DICTIONARY',
+                             dictionary_index.DEFAULT_DICTIONARY)
+    if name not in DICTIONARY_STORE:
+        common.error('Unknown dictionary %s' % name)
+        name = DICTIONARY_STORE.names()[0]
+    DICTIONARY_TRIE = DICTIONARY_STORE.get(name)
 
     is_dictionary_trie_populated = True
     return DICTIONARY_TRIE
 
 
+def get_dictionary(name=None):
+    """Returns a dictionary of the dictionary store
+
+    Args:
+        name (str, optional): dictionary name, VANITY_DICTIONARY (english)
+            by default
+
+    Returns:
+        DictionaryIndex: dictionary, the default one when the store has
+            no such dictionary
+
+    """
+    default = populate_dictionary_trie()
+    if name is None or name == default.name:
+        return default
+    if name not in DICTIONARY_STORE:
+        common.error('Unknown dictionary %s, using %s' % (name, default.name))
+        return default
+    return DICTIONARY_STORE.get(name)
+
+
+def dictionary_name(name=None):
+    """Returns the name to record for a dictionary
+
+    Args:
+        name (str, optional): dictionary name
+
+    Returns:
+        str: name of the dictionary get_dictionary returns, None for the
+            default one
+
+    """
+    if not name:
+        return None
+    name = get_dictionary(name).name
+    return None if name == DICTIONARY_TRIE.name else name
+
+
+def parse_number(phone_number):
+    """Splits an international phone number
+
+    phonenumbers is imported on first use and loads the metadata of a
+    region only when a number of that region is parsed.
+
+    Args:
+        phone_number (str): phone number with country code
+
+    Returns:
+        country_code (int): country calling code
+        fixed_prefix (str): leading national digits kept as is, see
+            regions
+        national_number (str): remaining national significant digits
+        region (regions.Region): settings of the number's region
+
+    """
+    import phonenumbers
+    parsed_number = phonenumbers.parse(phone_number, None)
+    # Keeps leading zeros, e.g. of Italian numbers
+    national_number = phonenumbers.national_significant_number(parsed_number)
+    region = regions.get_region(
+        phonenumbers.region_code_for_number(parsed_number) or
+        phonenumbers.region_code_for_country_code(parsed_number.country_code)
+    )
+    length = region.fixed_prefix_length(parsed_number)
+    return (parsed_number.country_code, national_number[:length],
+            national_number[length:], region)
+
+
+def prime(region_codes=None):
+    """Loads the dictionary, phone number metadata and keypad tables
+    ahead of requests
+
+    Meant for the Lambda init phase, so the first invocation does not pay
+    for them.
+
+    Args:
+        region_codes (str, optional): comma separated region codes, from
+            VANITY_REGIONS by default
+
+    Returns:
+        list: primed region codes
+
+    """
+    import phonenumbers
+    dictionary = populate_dictionary_trie()
+    if region_codes is None:
+        region_codes = common.get_envvar('VANITY_REGIONS', DEFAULT_REGIONS)
+    primed = []
+    for region in region_codes.split(','):
+        region = region.strip().upper()
+        if phonenumbers.PhoneMetadata.metadata_for_region(region) is None:
+            common.error('Unknown region %s' % region)
+            continue
+        dictionary.with_keypad(regions.get_region(region).keypad)
+        primed.append(region)
+    return primed
+
+
 def find_char_prefix(word, index):
     """Returns substring of continuous chars in a word until given index
 
@@ -84,64 +244,120 @@ def find_char_prefix(word, index):
     return char_prefix
 
 
-def is_valid_word(char_prefix):
+def is_valid_word(char_prefix, dictionary=None):
     """Checks if the given string is a valid word or contains valid substrings
 
     Args:
         word (str): string of chars
+        dictionary (DictionaryIndex, optional): the default one by default
 
     Returns:
         is_valid (boolean): True/False
 
     """
-    valid_word_substrings = find_valid_word_substrings(char_prefix)
+    valid_word_substrings = find_valid_word_substrings(char_prefix,
+                                                       dictionary)
     return len(valid_word_substrings) > 0
 
 
-def find_valid_word_substrings(word):
+def match_words(word, dictionary=None):
+    """Returns the dictionary words that split a string of chars
+
+    The chars are read as keypad digits by the DigitAutomaton of the
+    dictionary, in one pass. Spans spelling words by their digits are
+    then checked by their letters, only where earlier words reach.
+
+    Args:
+        word (str): string of chars
+        dictionary (DictionaryIndex, optional): the default one by default
+
+    Returns:
+        word_ends (list): per start index, end indexes of the dictionary
+            words starting there, empty where no words reach
+        reachable (list): per index, whether the chars before it are
+            a sequence of dictionary words
+        prefix_start (int): start of the longest suffix whose digits
+            start the digits of a word
+
+    """
+    if dictionary is None:
+        dictionary = populate_dictionary_trie()
+    char_to_digit = dictionary.keypad.char_to_digit
+    # 0 spells no word
+    digits = ''.join(char_to_digit.get(char, '0') for char in word)
+    word_ends, state = dictionary.digit_automaton().match(digits)
+    reachable = [False] * (len(word) + 1)
+    reachable[0] = True
+    for start, ends in enumerate(word_ends):
+        if not reachable[start]:
+            ends[:] = ()
+            continue
+        ends[:] = [end for end in ends if word[start:end] in dictionary]
+        for end in ends:
+            reachable[end] = True
+    return word_ends, reachable, len(word) - len(state)
+
+
+def find_valid_word_substrings(word, dictionary=None):
     """Returns valid words present in a given string
 
+    A string is valid when it is a dictionary word, or splits into a
+    sequence of dictionary words, of any length.
+
     Args:
         word (str): string of chars
+        dictionary (DictionaryIndex, optional): the default one by default
 
     Returns:
-        all_substrings (list): all valid substrings in a word
+        all_substrings (list): the word itself when it is in the
+            dictionary, otherwise the words of every way to split it,
+            in order; empty when it does not split into words
 
     """
-    global DICTIONARY_TRIE
-    populate_dictionary_trie()
+    if dictionary is None:
+        dictionary = populate_dictionary_trie()
 
-    if word in DICTIONARY_TRIE:
+    if word in dictionary:
         return [word]
-    # Some combination of continous words should exist
-    for index, _ in enumerate(word):
-        if word[:index + 1] in DICTIONARY_TRIE and \
-                word[index + 1:] in DICTIONARY_TRIE:
-            return [word[:index + 1], word[index + 1:]]
-
-    return []
+    word_ends, reachable, _ = match_words(word, dictionary)
+    if not reachable[len(word)]:
+        return []
+    # Words that the rest of the string follows with more words
+    completes = [False] * len(word) + [True]
+    for start in range(len(word) - 1, -1, -1):
+        completes[start] = any(completes[end] for end in word_ends[start])
+    return [word[start:end]
+            for start in range(len(word)) if reachable[start]
+            for end in word_ends[start] if completes[end]]
 
 
-def is_valid_word_or_prefix(char_prefix):
+def is_valid_word_or_prefix(char_prefix, dictionary=None):
     """Checks if a given string is a valid word or prefix
 
+    That is a sequence of dictionary words, possibly followed by the
+    start of another.
+
     Args:
         word (str): string of chars
+        dictionary (DictionaryIndex, optional): the default one by default
 
     Returns:
         is_valid (boolean): True/False
 
     """
-    global DICTIONARY_TRIE
-    populate_dictionary_trie()
+    if dictionary is None:
+        dictionary = populate_dictionary_trie()
 
-    if (char_prefix in DICTIONARY_TRIE or
-            DICTIONARY_TRIE.has_subtrie(char_prefix)):
+    if (char_prefix in dictionary or
+            dictionary.has_subtrie(char_prefix)):
+        return True
+    word_ends, reachable, prefix_start = match_words(char_prefix,
+                                                     dictionary)
+    if reachable[len(char_prefix)]:
         return True
-    # Some combination of continous words should exist
-    for index, _ in enumerate(char_prefix):
-        if char_prefix[:index + 1] in DICTIONARY_TRIE and \
-                DICTIONARY_TRIE.has_subtrie(char_prefix[index + 1:]):
+    # Only suffixes the automaton ended in can start a word
+    for start in range(max(prefix_start, 1), len(char_prefix)):
+        if reachable[start] and dictionary.has_subtrie(char_prefix[start:]):
             return True
     return False
 
@@ -170,11 +386,12 @@ def find_all_substrings(word):
     return all_substrings
 
 
-def evaluate_word(word):
+def evaluate_word(word, dictionary=None):
     """Check the validity of the word and the substrings
 
     Args:
         word (str): string of chars
+        dictionary (DictionaryIndex, optional): the default one by default
 
     Returns:
         is_valid (boolean): validity of the word
@@ -183,6 +400,7 @@ def evaluate_word(word):
 
     """
 
+    metrics.count('evaluate_word')
     is_valid = True
     max_len_substring = 0
     max_continous_chars = 0
@@ -194,7 +412,8 @@ def evaluate_word(word):
     else:
         for substring in all_valid_word_substrings:
             max_continous_chars = max(len(substring), max_continous_chars)
-            valid_word_substrings = find_valid_word_substrings(substring)
+            valid_word_substrings = find_valid_word_substrings(substring,
+                                                               dictionary)
             for valid_substring in valid_word_substrings:
                 max_len_substring = max(len(valid_substring),
                                         max_len_substring)
@@ -202,108 +421,822 @@ def evaluate_word(word):
     return (is_valid, max_continous_chars, max_len_substring)
 
 
-def _frame_words_from_number(number: str, max_results: int):
+def word_weight(word, dictionary=None):
+    """Returns the highest weight of the dictionary words of a word
+
+    Words are found as evaluate_word finds them, so this is the weight
+    the searches break ties with.
+
+    Args:
+        word (str): string of chars
+        dictionary (DictionaryIndex, optional): the default one by default
+
+    Returns:
+        int: weight, 0 without dictionary words
+
+    """
+    if dictionary is None:
+        dictionary = populate_dictionary_trie()
+    return max([
+        dictionary.weight(valid_substring)
+        for substring in find_all_substrings(word)
+        for valid_substring in find_valid_word_substrings(substring,
+                                                          dictionary)
+    ], default=0)
+
+
+class _Memo(dict):
+    """Caches a single argument function for the duration of a search"""
+    def __init__(self, func):
+        self.func = func
+
+    def __missing__(self, key):
+        value = self[key] = self.func(key)
+        return value
+
+
+def _substring_score(substring, dictionary=None):
+    # max_len_substring and weight of a run of letters
+    metrics.count('substring_scores')
+    valid_word_substrings = find_valid_word_substrings(substring, dictionary)
+    if len(valid_word_substrings) == 0:
+        return (0, 0)
+    if dictionary is None:
+        dictionary = populate_dictionary_trie()
+    # The words are in the dictionary, only varying weights need a lookup
+    return (max(len(valid_substring)
+                for valid_substring in valid_word_substrings),
+            dictionary.uniform_weight or
+            max(dictionary.weight(valid_substring)
+                for valid_substring in valid_word_substrings))
+
+
+def _dictionary_memos(dictionary):
+    # is_valid_word, is_valid_word_or_prefix and _substring_score of a
+    # dictionary, cached for the duration of a search
+    return (_Memo(lambda word: is_valid_word(word, dictionary)),
+            _Memo(lambda word: is_valid_word_or_prefix(word, dictionary)),
+            _Memo(lambda word: _substring_score(word, dictionary)))
+
+
+def _push_candidate(priority_queue, node, max_results):
+    # Ranks compare in C; Node.__eq__ is only reached between equal ranks
+    # and weights, which keeps ties in the same heap positions as
+    # comparing nodes
+    heapq.heappush(priority_queue, (node.max_len_substring,
+                                    node.max_continous_chars,
+                                    node.number_of_chars_in_word,
+                                    node.weight, node))
+    while len(priority_queue) > max_results:
+        heapq.heappop(priority_queue)
+
+
+def _top_candidates(priority_queue, max_results):
+    nlargest_ = heapq.nlargest(max_results, priority_queue)
+    return [item[-1].wordified_so_far for item in nlargest_]
+
+
+def _bfs_words_from_number(number: str, max_results: int, dictionary=None):
     """Frame words from number
 
-       Uses Breadth First Search(BFS) and Priority Queue
+       Uses Breadth First Search(BFS) and Priority Queue. Nodes carry
+       their open run of letters and its score so far, so an expansion
+       only scores the run it extends instead of running evaluate_word
+       over the whole string
 
     Args:
         number (str): string of numbers
         max_results (str): maximum number of words
+        dictionary (DictionaryIndex, optional): the default one by default
 
     Returns:
         words_from_numbers_result (list): list of words from numbers
 
     """
 
-    digit_to_chars = {
-        '1': [],
-        '2': ['A', 'B', 'C'],
-        '3': ['D', 'E', 'F'],
-        '4': ['G', 'H', 'I'],
-        '5': ['J', 'K', 'L'],
-        '6': ['M', 'N', 'O'],
-        '7': ['P', 'Q', 'R', 'S'],
-        '8': ['T', 'U', 'V'],
-        '9': ['W', 'X', 'Y', 'Z'],
-        '0': [],
-    }
+    if dictionary is None:
+        dictionary = populate_dictionary_trie()
+    digit_to_chars = dictionary.keypad.digit_to_chars
     number_of_digits = len(number)
     queue = deque([])
     queue.append(Node(number, 0, 0, 0, 0))
     priority_queue = []
+    valid_words, valid_words_or_prefixes, substring_scores = \
+        _dictionary_memos(dictionary)
+    expanded = 0
+    pushed = 0
 
     while(queue):
         current_node = queue.popleft()
-        current_word = current_node.wordified_so_far
         current_index = current_node.index_so_far
 
         # If the search reached the end, then validate and push to heap
         if current_index == number_of_digits:
-            (is_valid, max_continous_chars, max_len_substring) = \
-                evaluate_word(current_word)
-            if not is_valid:
+            if current_node.number_of_chars_in_word == 0:
                 continue
-            current_node.max_continous_chars = max_continous_chars
-            current_node.max_len_substring = max_len_substring
-            heapq.heappush(priority_queue, current_node)
-            while len(priority_queue) > max_results:
-                heapq.heappop(priority_queue)
+            _push_candidate(priority_queue, current_node, max_results)
+            pushed += 1
             continue
+        expanded += 1
 
         current_digit = number[current_index]
         current_number_of_chars_in_word = current_node.number_of_chars_in_word
+        current_max_len_substring = current_node.max_len_substring
+        current_max_continous_chars = current_node.max_continous_chars
+        current_weight = current_node.weight
 
-        # Find partial words so far
-        char_prefix = find_char_prefix(current_word, current_index - 1)
+        # Partial words so far
+        char_prefix = current_node.run
         len_char_prefix = len(char_prefix)
+        is_last_index = current_index == number_of_digits - 1
 
         for char in (digit_to_chars[current_digit] + [current_digit]):
+            run = char_prefix + char
 
-            if ((char.isdigit() and (len_char_prefix == 0 or is_valid_word(char_prefix))) or  # noqa: E501
-                    (char.isalpha() and (current_index != number_of_digits - 1 and is_valid_word_or_prefix(char_prefix+char))) or  # noqa: E501
-                    (char.isalpha() and (current_index == number_of_digits - 1 and is_valid_word(char_prefix+char)))):  # noqa: E501
+            if ((char.isdigit() and (len_char_prefix == 0 or valid_words[char_prefix])) or  # noqa: E501
+                    (char.isalpha() and (not is_last_index and valid_words_or_prefixes[run])) or  # noqa: E501
+                    (char.isalpha() and (is_last_index and valid_words[run]))):  # noqa: E501
 
-                next_word = replace_string_with_char_at_index(
-                    current_word, current_index, char)
                 next_number_of_chars_in_word = current_number_of_chars_in_word + (1 if char.isalpha() else 0)  # noqa: E501
-                (is_valid, max_continous_chars, max_len_substring) = \
-                    evaluate_word(next_word)
-
-                queue.append(Node(next_word, current_index + 1,
+                max_len_substring = current_max_len_substring
+                max_continous_chars = current_max_continous_chars
+                weight = current_weight
+
+                if char.isdigit():
+                    # evaluate_word never scores a run followed by a digit
+                    run_start = current_index + 1
+                else:
+                    run_start = current_node.run_start
+                    # Followed by a letter, the run so far is a substring
+                    if len_char_prefix > 0:
+                        (substring_len,
+                         substring_weight) = substring_scores[char_prefix]
+                        max_len_substring = max(max_len_substring,
+                                                substring_len)
+                        weight = max(weight, substring_weight)
+                        max_continous_chars = max(max_continous_chars,
+                                                  len_char_prefix)
+                    # as is a run reaching the end
+                    if is_last_index:
+                        substring_len, substring_weight = substring_scores[run]
+                        max_len_substring = max(max_len_substring,
+                                                substring_len)
+                        weight = max(weight, substring_weight)
+                        max_continous_chars = max(max_continous_chars,
+                                                  len(run))
+
+                queue.append(Node(char, current_index + 1,
                              next_number_of_chars_in_word, max_len_substring,
-                             max_continous_chars))
+                             max_continous_chars, current_node, run_start,
+                             weight))
 
+    metrics.count('nodes_expanded', expanded)
+    metrics.count('heap_pushes', pushed)
     # Picking the first max_results largest from priority queue
     if len(priority_queue) > 0:
-        words_from_numbers_result = []
-
-        nlargest_ = heapq.nlargest(max_results, priority_queue)
-
-        for wordified in nlargest_:
-            words_from_numbers_result.append(wordified.wordified_so_far)
-        print(words_from_numbers_result)
-        return words_from_numbers_result[:max_results]
+        words_from_numbers_result = _top_candidates(priority_queue,
+                                                    max_results)
+        common.debug('bfs candidates %s' % words_from_numbers_result, 2)
+        return words_from_numbers_result
     else:
         return []
 
 
-def generate(phone_number, max_results=5):
+def _run_substring_scores(run, substring_scores, dictionary):
+    # Fills substring_scores for every prefix of the run from a single
+    # match_words of the run: a prefix splits into the same words as the
+    # run does up to its end, so its spans are checked by letters once
+    missing = [length for length in range(1, len(run) + 1)
+               if run[:length] not in substring_scores]
+    if not missing:
+        return
+    word_ends, reachable, _ = match_words(run, dictionary)
+    for length in missing:
+        metrics.count('substring_scores')
+        if length in word_ends[0]:
+            valid_words = [run[:length]]
+        elif not reachable[length]:
+            substring_scores[run[:length]] = (0, 0)
+            continue
+        else:
+            # As find_valid_word_substrings does for the prefix
+            completes = [False] * length + [True]
+            for start in range(length - 1, -1, -1):
+                completes[start] = any(completes[end]
+                                       for end in word_ends[start]
+                                       if end <= length)
+            valid_words = [run[start:end]
+                           for start in range(length) if reachable[start]
+                           for end in word_ends[start]
+                           if end <= length and completes[end]]
+        substring_scores[run[:length]] = (
+            max(len(word) for word in valid_words),
+            dictionary.uniform_weight or
+            max(dictionary.weight(word) for word in valid_words)
+        )
+
+
+def _prefix_scores(run, substring_scores, dictionary):
+    # max_len_substring and weight of the run as evaluate_word scores it
+    # when a digit follows (every strict prefix) and when it ends the number
+    _run_substring_scores(run, substring_scores, dictionary)
+    max_len_substring = 0
+    weight = 0
+    for length in range(1, len(run)):
+        substring_len, substring_weight = substring_scores[run[:length]]
+        max_len_substring = max(max_len_substring, substring_len)
+        weight = max(weight, substring_weight)
+    substring_len, substring_weight = substring_scores[run]
+    return (max_len_substring, max(max_len_substring, substring_len),
+            weight, max(weight, substring_weight))
+
+
+def find_digit_runs(digits, substring_scores=None, dictionary=None):
+    """Returns the runs of letters spelling a digit substring
+
+    A run is a dictionary word, or a sequence of words. Results only
+    depend on the digits, the dictionary and its keypad, so they are
+    cached in DIGIT_RUNS_CACHE and reused by every number containing the
+    substring.
+
+    Args:
+        digits (str): string of numbers
+        substring_scores (dict, optional): substring scores memoised by
+            the caller
+        dictionary (DictionaryIndex, optional): the default one by default
+
+    Returns:
+        digit_runs (tuple): (run, max_len_substring before a digit,
+            max_len_substring at the end, weight before a digit, weight
+            at the end) tuples
+
+    """
+    if dictionary is None:
+        dictionary = populate_dictionary_trie()
+    cache_key = (dictionary.name, dictionary.keypad.name, digits)
+    digit_runs = DIGIT_RUNS_CACHE.get(cache_key)
+    if digit_runs is not None:
+        return digit_runs
+    if substring_scores is None:
+        substring_scores = _Memo(
+            lambda substring: _substring_score(substring, dictionary))
+
+    runs = {}
+    word_ends, _ = dictionary.digit_automaton().match(digits)
+    for end in word_ends[0] if digits else ():
+        words = dictionary.words_for_digits(digits[:end])
+        if end == len(digits):
+            runs.update(dict.fromkeys(words))
+            continue
+        # The rest is a substring the number is segmented on anyway, so
+        # it usually comes from the cache
+        next_runs = [digit_run[0] for digit_run in find_digit_runs(
+            digits[end:], substring_scores, dictionary)]
+        for word in words:
+            runs.update(dict.fromkeys(word + next_run
+                                      for next_run in next_runs))
+
+    digit_runs = tuple(
+        (run,) + _prefix_scores(run, substring_scores, dictionary)
+        for run in runs
+    )
+    DIGIT_RUNS_CACHE.put(cache_key, digit_runs)
+    return digit_runs
+
+
+def cache_info():
+    """Returns size and hit/miss counters of DIGIT_RUNS_CACHE"""
+    return DIGIT_RUNS_CACHE.info()
+
+
+def _reachable(word_ends, start=0):
+    # reachable[index]: the digits from start to index spell words
+    reachable = [False] * (len(word_ends) + 1)
+    reachable[start] = True
+    for index in range(start, len(word_ends)):
+        if reachable[index]:
+            for end in word_ends[index]:
+                reachable[end] = True
+    return reachable
+
+
+def find_word_runs(number, dictionary=None):
+    """Returns the runs of letters that can replace digits of a number
+
+    The words spelled by every span of the number come from one pass of
+    the dictionary's DigitAutomaton, and only spans that split into
+    words are looked up in DIGIT_RUNS_CACHE.
+
+    Args:
+        number (str): string of numbers
+        dictionary (DictionaryIndex, optional): the default one by default
+
+    Returns:
+        word_runs (list): per start index, (order key, run, end index,
+            max_continous_chars, max_len_substring, weight) tuples in
+            search order
+
+    """
+    if dictionary is None:
+        dictionary = populate_dictionary_trie()
+    number_of_digits = len(number)
+    max_run_length = 2 * dictionary_index.MAX_WORD_LENGTH
+    substring_scores = _Memo(
+        lambda substring: _substring_score(substring, dictionary))
+    word_ends, _ = dictionary.digit_automaton().match(number)
+    word_runs = []
+    for start in range(number_of_digits):
+        ordered_runs = []
+        reachable = _reachable(word_ends, start)
+        for end in range(start + 1, min(number_of_digits,
+                                        start + max_run_length) + 1):
+            if not reachable[end]:
+                continue
+            for (run, max_len_before_digit, max_len_at_end,
+                 weight_before_digit, weight_at_end) in find_digit_runs(
+                     number[start:end], substring_scores, dictionary):
+                # Score the run exactly as evaluate_word does in place,
+                # the whole run only counts when no digit follows it
+                if end < number_of_digits:
+                    max_continous_chars = len(run) - 1
+                    max_len_substring = max_len_before_digit
+                    weight = weight_before_digit
+                else:
+                    max_continous_chars = len(run)
+                    max_len_substring = max_len_at_end
+                    weight = weight_at_end
+                # A letter orders before the digit that ends a shorter run
+                ordered_runs.append((run + '~', run, end, max_continous_chars,
+                                     max_len_substring, weight))
+        word_runs.append(sorted(ordered_runs))
+    return word_runs
+
+
+def _segment_words_from_number(number: str, max_results: int,
+                               dictionary=None):
+    """Frame words from number
+
+       Segments the number into word runs separated by digits, visiting
+       candidates in the same order as the BFS so ties rank identically
+
+    Args:
+        number (str): string of numbers
+        max_results (str): maximum number of words
+        dictionary (DictionaryIndex, optional): the default one by default
+
+    Returns:
+        words_from_numbers_result (list): list of words from numbers
+
+    """
+
+    number_of_digits = len(number)
+    word_runs = find_word_runs(number, dictionary)
+    priority_queue = []
+    # Depth first, so options are pushed in reverse of visiting order
+    stack = [Node(number, 0, 0, 0, 0)]
+    expanded = 0
+    pushed = 0
+
+    while stack:
+        current_node = stack.pop()
+        current_index = current_node.index_so_far
+        number_of_chars_in_word = current_node.number_of_chars_in_word
+
+        if current_index == number_of_digits:
+            if number_of_chars_in_word > 0:
+                _push_candidate(priority_queue, current_node, max_results)
+                pushed += 1
+            continue
+        expanded += 1
+
+        max_len_substring = current_node.max_len_substring
+        max_continous_chars = current_node.max_continous_chars
+        weight = current_node.weight
+        stack.append(Node(number[current_index], current_index + 1,
+                          number_of_chars_in_word, max_len_substring,
+                          max_continous_chars, current_node, weight=weight))
+
+        for (_, run, end, run_max_continous_chars, run_max_len_substring,
+             run_weight) in reversed(word_runs[current_index]):
+            chars = run
+            if end < number_of_digits:
+                # A run is always followed by a digit
+                chars += number[end]
+                end += 1
+            stack.append(Node(chars, end,
+                              number_of_chars_in_word + len(run),
+                              max(max_len_substring, run_max_len_substring),
+                              max(max_continous_chars,
+                                  run_max_continous_chars),
+                              current_node, weight=max(weight, run_weight)))
+
+    metrics.count('nodes_expanded', expanded)
+    metrics.count('heap_pushes', pushed)
+    return _top_candidates(priority_queue, max_results)
+
+
+def find_score_bounds(number, word_runs):
+    """Returns upper bounds of the score still reachable from each index
+
+    Args:
+        number (str): string of numbers
+        word_runs (list): runs per start index, see find_word_runs
+
+    Returns:
+        score_bounds (list): (max_len_substring, max_continous_chars,
+            number_of_chars_in_word, weight) bound per index, including
+            the end
+
+    """
+    number_of_digits = len(number)
+    score_bounds = [(0, 0, 0, 0)] * (number_of_digits + 1)
+    for index in range(number_of_digits - 1, -1, -1):
+        (max_len_substring, max_continous_chars,
+         number_of_chars_in_word, weight) = score_bounds[index + 1]
+        for (_, run, end, run_max_continous_chars, run_max_len_substring,
+             run_weight) in word_runs[index]:
+            max_len_substring = max(max_len_substring,
+                                    run_max_len_substring)
+            max_continous_chars = max(max_continous_chars,
+                                      run_max_continous_chars)
+            weight = max(weight, run_weight)
+            # A run ending before the last digit is followed by a digit
+            chars_after_run = score_bounds[min(end + 1,
+                                               number_of_digits)][2]
+            number_of_chars_in_word = max(number_of_chars_in_word,
+                                          len(run) + chars_after_run)
+        score_bounds[index] = (max_len_substring, max_continous_chars,
+                               number_of_chars_in_word, weight)
+    return score_bounds
+
+
+def _best_first_candidates(number: str, beam_width=None, deadline=None,
+                           dictionary=None):
+    """Yields candidate nodes of a number in ranking order
+
+       Expands the partial candidate with the best score upper bound
+       first, so candidates complete in ranking order and the caller can
+       stop as soon as it has enough. Candidates with equal scores may
+       rank in a different order than with the exhaustive strategies.
+
+    Args:
+        number (str): string of numbers
+        beam_width (int, optional): maximum frontier size; the lowest
+            bounds are dropped beyond it, trading exactness for speed
+        deadline (float, optional): time.monotonic() after which the
+            frontier is completed with the remaining digits as is, and
+            yielded in ranking order
+        dictionary (DictionaryIndex, optional): the default one by default
+
+    Returns:
+        generator: complete Node objects
+
+    """
+
+    number_of_digits = len(number)
+    word_runs = find_word_runs(number, dictionary)
+    score_bounds = find_score_bounds(number, word_runs)
+    # Ties are expanded in insertion order
+    sequence = itertools.count()
+    # Bounds are negated, heapq being a min-heap
+    (bound_len, bound_continous, bound_chars, bound_weight) = score_bounds[0]
+    frontier = [(-bound_len, -bound_continous, -bound_chars, -bound_weight,
+                 next(sequence), Node(number, 0, 0, 0, 0))]
+    found_words = False
+
+    expanded = 0
+    try:
+        while frontier:
+            current_node = heapq.heappop(frontier)[5]
+            current_index = current_node.index_so_far
+            number_of_chars_in_word = current_node.number_of_chars_in_word
+
+            # Bounds of a complete candidate are its score, nothing left on
+            # the frontier can beat it
+            if current_index == number_of_digits:
+                if number_of_chars_in_word > 0:
+                    yield current_node
+                continue
+            expanded += 1
+
+            max_len_substring = current_node.max_len_substring
+            max_continous_chars = current_node.max_continous_chars
+            weight = current_node.weight
+            children = [(number[current_index], current_index + 1,
+                         number_of_chars_in_word, max_len_substring,
+                         max_continous_chars, weight)]
+            for (_, run, end, run_max_continous_chars, run_max_len_substring,
+                 run_weight) in word_runs[current_index]:
+                chars = run
+                if end < number_of_digits:
+                    # A run is always followed by a digit
+                    chars += number[end]
+                    end += 1
+                children.append((chars, end,
+                                 number_of_chars_in_word + len(run),
+                                 max(max_len_substring, run_max_len_substring),
+                                 max(max_continous_chars,
+                                     run_max_continous_chars),
+                                 max(weight, run_weight)))
+                found_words = True
+
+            for child in children:
+                (bound_len, bound_continous, bound_chars,
+                 bound_weight) = score_bounds[child[1]]
+                heapq.heappush(frontier, (
+                    -max(child[3], bound_len),
+                    -max(child[4], bound_continous),
+                    -(child[2] + bound_chars),
+                    -max(child[5], bound_weight),
+                    next(sequence),
+                    Node(*child[:5], parent=current_node, weight=child[5])
+                ))
+
+            if beam_width and len(frontier) > beam_width:
+                # nsmallest returns a sorted list, which is a valid heap
+                frontier = heapq.nsmallest(beam_width, frontier)
+
+            if (deadline is not None and found_words and
+                    time.monotonic() > deadline):
+                # Out of time, once the frontier holds words: every partial
+                # candidate ends in a digit, so appending the remaining digits
+                # keeps its score. Scores are below the bounds the frontier
+                # is ordered by, so the completed candidates are ranked again
+                seen = set()
+                completed = []
+                for item in sorted(frontier):
+                    node = item[5]
+                    if node.number_of_chars_in_word == 0:
+                        continue
+                    if node.index_so_far < number_of_digits:
+                        node = Node(number[node.index_so_far:],
+                                    number_of_digits,
+                                    node.number_of_chars_in_word,
+                                    node.max_len_substring,
+                                    node.max_continous_chars, node,
+                                    weight=node.weight)
+                    word = node.wordified_so_far
+                    if word not in seen:
+                        seen.add(word)
+                        completed.append(node)
+                # Stable, ties stay in order of their bounds
+                completed.sort(key=lambda node: node.rank + (node.weight,),
+                               reverse=True)
+                for node in completed:
+                    yield node
+                return
+    finally:
+        # Also reached when the caller stops early and the generator closes
+        metrics.count('nodes_expanded', expanded)
+        metrics.count('heap_pushes', next(sequence) - 1)
+
+
+def _best_first_words_from_number(number: str, max_results: int,
+                                  beam_width=None, time_budget_ms=None,
+                                  dictionary=None):
+    """Frame words from number
+
+       Best first search, see _best_first_candidates
+
+    Args:
+        number (str): string of numbers
+        max_results (str): maximum number of words
+        beam_width (int, optional): maximum frontier size; the lowest
+            bounds are dropped beyond it, trading exactness for speed
+        time_budget_ms (int, optional): wall clock budget, the best
+            candidates found so far are returned when it runs out
+        dictionary (DictionaryIndex, optional): the default one by default
+
+    Returns:
+        words_from_numbers_result (list): list of words from numbers
+
+    """
+    deadline = None
+    if time_budget_ms:
+        deadline = time.monotonic() + time_budget_ms / 1000.0
+    candidates = _best_first_candidates(number, beam_width, deadline,
+                                        dictionary)
+    return [node.wordified_so_far
+            for node in itertools.islice(candidates, max_results)]
+
+
+def _frame_words_from_number(number: str, max_results: int, strategy=None,
+                             beam_width=None, time_budget_ms=None,
+                             dictionary=None):
+    """Frame words from number
+
+    Args:
+        number (str): string of numbers
+        max_results (str): maximum number of words
+        strategy (str, optional): one of SEARCH_STRATEGIES, defaults to
+            VANITY_SEARCH_STRATEGY environment variable
+        beam_width (int, optional): best_first frontier size, defaults to
+            VANITY_BEAM_WIDTH environment variable (unbounded)
+        time_budget_ms (int, optional): best_first wall clock budget,
+            defaults to VANITY_TIME_BUDGET_MS environment variable (none)
+        dictionary (DictionaryIndex, optional): the default one by default
+
+    Returns:
+        words_from_numbers_result (list): list of words from numbers
+
+    """
+    if strategy is None:
+        strategy = common.get_envvar('VANITY_SEARCH_STRATEGY',
+                                     DEFAULT_SEARCH_STRATEGY)
+    metrics.set_property('strategy', strategy)
+    if strategy == 'segment':
+        return _segment_words_from_number(number, max_results, dictionary)
+    if strategy == 'best_first':
+        if beam_width is None:
+            beam_width = common.get_envvar('VANITY_BEAM_WIDTH', 0)
+        if time_budget_ms is None:
+            time_budget_ms = common.get_envvar('VANITY_TIME_BUDGET_MS', 0)
+        return _best_first_words_from_number(number, max_results,
+                                             beam_width, time_budget_ms,
+                                             dictionary)
+    if strategy == 'bfs':
+        return _bfs_words_from_number(number, max_results, dictionary)
+    raise ValueError('unknown search strategy %s' % strategy)
+
+
+def generate(phone_number, max_results=5, strategy=None, beam_width=None,
+             time_budget_ms=None, dictionary=None):
     """generate words from phone number
 
     Args:
         phone_number (str): string of numbers
         max_results (str): maximum number of words
+        strategy (str, optional): one of SEARCH_STRATEGIES
+        beam_width (int, optional): best_first frontier size
+        time_budget_ms (int, optional): best_first wall clock budget
+        dictionary (str, optional): dictionary name, see get_dictionary
 
     Returns:
         vanity_numbers (list): list of vanity numbers
 
     """
 
-    populate_dictionary_trie()
-    parsed_number = phonenumbers.parse(phone_number, None)
-    country_code = parsed_number.country_code
-    national_number = parsed_number.national_number
-    words = _frame_words_from_number(str(national_number), max_results)
-    vanity_numbers = [str(country_code) + '-' + word for word in words]
+    dictionary = get_dictionary(dictionary)
+    country_code, fixed_prefix, national_number, region = \
+        parse_number(phone_number)
+    dictionary = dictionary.with_keypad(region.keypad)
+    metrics.set_property('digits', len(national_number))
+    metrics.set_property('dictionary', dictionary.name)
+    with metrics.span('search'):
+        words = _frame_words_from_number(national_number, max_results,
+                                         strategy, beam_width,
+                                         time_budget_ms, dictionary)
+    vanity_numbers = [str(country_code) + '-' + fixed_prefix + word
+                      for word in words]
     return vanity_numbers
+
+
+def generate_ranked(phone_number, max_results=100, strategy=None,
+                    dictionary=None):
+    """generate words from phone number with their ranks
+
+    Args:
+        phone_number (str): string of numbers
+        max_results (str): maximum number of words
+        strategy (str, optional): one of SEARCH_STRATEGIES
+        dictionary (str, optional): dictionary name, see get_dictionary
+
+    Returns:
+        vanity_numbers (list): list of vanity numbers, best first
+        ranks (list): (max_len_substring, max_continous_chars,
+            number_of_chars_in_word) of each vanity number
+
+    """
+    vanity_numbers = generate(phone_number, max_results, strategy,
+                              dictionary=dictionary)
+    dictionary = get_dictionary(dictionary)
+    ranks = []
+    for vanity_number in vanity_numbers:
+        word = vanity_number.partition('-')[2]
+        _, max_continous_chars, max_len_substring = evaluate_word(word,
+                                                                  dictionary)
+        ranks.append((max_len_substring, max_continous_chars,
+                      sum(1 for char in word if char.isalpha())))
+    return vanity_numbers, ranks
+
+
+def iter_candidates(phone_number, max_results=None, beam_width=None,
+                    time_budget_ms=None, dictionary=None):
+    """generate words from phone number as they are found
+
+    Candidates come from the best first search, so they are yielded in
+    ranking order and the first one is a best answer. With a time budget
+    the search stops when it runs out and the most promising partial
+    candidates are finished with the remaining digits, so there is still
+    a good answer to give.
+
+    Args:
+        phone_number (str): string of numbers
+        max_results (int, optional): maximum number of words, unlimited
+            by default
+        beam_width (int, optional): best_first frontier size
+        time_budget_ms (int, optional): wall clock budget
+        dictionary (str, optional): dictionary name, see get_dictionary
+
+    Returns:
+        generator: (vanity_number, rank) tuples where rank is
+            (max_len_substring, max_continous_chars,
+            number_of_chars_in_word)
+
+    """
+    dictionary = get_dictionary(dictionary)
+    deadline = None
+    if time_budget_ms:
+        deadline = time.monotonic() + time_budget_ms / 1000.0
+    country_code, fixed_prefix, national_number, region = \
+        parse_number(phone_number)
+    dictionary = dictionary.with_keypad(region.keypad)
+    prefix = '%s-%s' % (country_code, fixed_prefix)
+    candidates = _best_first_candidates(national_number, beam_width,
+                                        deadline, dictionary)
+    for node in itertools.islice(candidates, max_results):
+        yield prefix + node.wordified_so_far, node.rank
+
+
+async def aiter_candidates(phone_number, max_results=None, beam_width=None,
+                           time_budget_ms=None, executor=None,
+                           dictionary=None):
+    """iter_candidates for asyncio
+
+    The search runs in an executor between candidates, so the event loop
+    stays responsive.
+
+    Args:
+        phone_number (str): string of numbers
+        max_results (int, optional): maximum number of words
+        beam_width (int, optional): best_first frontier size
+        time_budget_ms (int, optional): wall clock budget
+        executor (Executor, optional): defaults to the loop's executor
+        dictionary (str, optional): dictionary name, see get_dictionary
+
+    Returns:
+        async generator: (vanity_number, rank) tuples
+
+    """
+    import asyncio  # only the async API needs it, keep it off cold starts
+
+    loop = asyncio.get_event_loop()
+    candidates = iter_candidates(phone_number, max_results, beam_width,
+                                 time_budget_ms, dictionary)
+    while True:
+        candidate = await loop.run_in_executor(executor, next, candidates,
+                                               None)
+        if candidate is None:
+            return
+        yield candidate
+
+
+def _generate_one(args):
+    phone_number, max_results, strategy, dictionary = args
+    result = {'phoneNumber': phone_number}
+    try:
+        result['vanityNumbers'] = generate(phone_number, max_results,
+                                           strategy, dictionary=dictionary)
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+
+def generate_batch(phone_numbers, workers=None, max_results=5,
+                   strategy=None, chunksize=64, dictionary=None):
+    """generate words for many phone numbers
+
+    The dictionary is loaded before the worker processes are forked, so
+    they share its read only pages instead of loading one each.
+
+    Args:
+        phone_numbers (iterable): phone numbers, consumed lazily
+        workers (int, optional): worker processes, defaults to CPU count;
+            1 generates in the calling process
+        max_results (str): maximum number of words
+        strategy (str, optional): one of SEARCH_STRATEGIES
+        chunksize (int, optional): numbers sent to a worker at a time
+        dictionary (str, optional): dictionary name, see get_dictionary
+
+    Returns:
+        generator: dicts with phoneNumber and either vanityNumbers or
+            error, in input order
+
+    """
+    import multiprocessing  # only batch jobs fork workers
+    populate_dictionary_trie()
+    tasks = ((phone_number, max_results, strategy, dictionary)
+             for phone_number in phone_numbers)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        for task in tasks:
+            yield _generate_one(task)
+        return
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    with context.Pool(workers, initializer=populate_dictionary_trie) as pool:
+        for result in pool.imap(_generate_one, tasks, chunksize):
+            yield result
@@ -0,0 +1,255 @@
+"""Precomputed vanity numbers of a phone number range
+
+A table holds the ranked candidates of every national number of a range
+as candidate_codec records, so a number of the range is looked up
+instead of searched. precompute.py writes tables. Numbers are stored in
+order, in zlib compressed pages of up to page size numbers, and a lookup
+decompresses one page.
+
+    header  magic, version, country code, national digits, first
+            national number, count, page size, candidates per number,
+            dictionary name
+    pages   zlib compressed: record offsets, then the records
+    index   offsets of the pages, and of the index itself
+    footer  offset of the index
+
+Tables listed in VANITY_TABLE_PATHS (comma separated) are memory mapped
+once and searched by lookup().
+
+"""
+import mmap
+import struct
+import zlib
+
+import common
+
+
+MAGIC = b'VNTB'
+VERSION = 1
+PAGE_SIZE = 256
+MAX_NAME_LENGTH = 16
+
+# magic, version, country code, national digits, first national number,
+# count, page size, candidates per number, dictionary name
+HEADER = struct.Struct('<4sHHBQQHH16s')
+# offset of a page, or of a record in a page
+OFFSET = struct.Struct('<Q')
+RECORD_OFFSET = struct.Struct('<I')
+
+TABLES = None
+
+
+def pack_header(country_code, digits, first, count, page_size, candidates,
+                dictionary):
+    """Packs a table header
+
+    Args:
+        country_code (int): country calling code
+        digits (int): number of national digits
+        first (int): first national number
+        count (int): number of national numbers
+        page_size (int): numbers per page
+        candidates (int): candidates per number
+        dictionary (str): dictionary name
+
+    Returns:
+        bytes: header
+
+    """
+    name = dictionary.encode('ascii')
+    if len(name) > MAX_NAME_LENGTH:
+        raise ValueError('dictionary name too long: %s' % dictionary)
+    return HEADER.pack(MAGIC, VERSION, country_code, digits, first, count,
+                       page_size, candidates, name)
+
+
+def pack_page(records):
+    """Compresses the records of consecutive numbers into a page
+
+    Args:
+        records (list): candidate_codec.encode() output per number
+
+    Returns:
+        bytes: page
+
+    """
+    offsets = [0]
+    for record in records:
+        offsets.append(offsets[-1] + len(record))
+    return zlib.compress(b''.join(
+        [RECORD_OFFSET.pack(offset) for offset in offsets] + records
+    ))
+
+
+def pack_index(offsets):
+    """Packs the page index and footer
+
+    Args:
+        offsets (iterable): offsets of the pages, then of the index
+
+    Returns:
+        bytes: index and footer
+
+    """
+    offsets = list(offsets)
+    return b''.join(OFFSET.pack(offset) for offset in offsets) + \
+        OFFSET.pack(offsets[-1])
+
+
+class VanityTable(object):
+    def __init__(self, buffer):
+        """Precomputed candidates of a phone number range
+
+        Args:
+            buffer (bytes or mmap): table
+
+        Raises:
+            ValueError: when the buffer is not a compatible table
+
+        """
+        if len(buffer) < HEADER.size + OFFSET.size:
+            raise ValueError('vanity table is truncated')
+        (magic, version, self.country_code, self.digits, self.first,
+         self.count, self.page_size, self.candidates,
+         name) = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('unsupported vanity table %s v%s' % (
+                magic, version
+            ))
+        self.dictionary = name.rstrip(b'\x00').decode('ascii')
+        self.pages = -(-self.count // self.page_size)
+        self.index_offset, = OFFSET.unpack_from(buffer,
+                                                len(buffer) - OFFSET.size)
+        if self.index_offset + OFFSET.size * (self.pages + 2) != len(buffer):
+            raise ValueError('vanity table is truncated')
+        self.buffer = buffer
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, national_number):
+        return self._position(national_number) is not None
+
+    def _position(self, national_number):
+        if len(national_number) != self.digits or \
+                not national_number.isdigit():
+            return None
+        position = int(national_number) - self.first
+        if not 0 <= position < self.count:
+            return None
+        return position
+
+    def get(self, national_number):
+        """Returns the candidates of a national number
+
+        Args:
+            national_number (str): national significant number
+
+        Returns:
+            bytes: candidate_codec encoded candidates, None when the
+                number is not in the table
+
+        """
+        position = self._position(national_number)
+        if position is None:
+            return None
+        page, index = divmod(position, self.page_size)
+        start, end = struct.unpack_from(
+            '<QQ', self.buffer, self.index_offset + OFFSET.size * page
+        )
+        data = zlib.decompress(self.buffer[start:end])
+        record_start, record_end = struct.unpack_from(
+            '<II', data, RECORD_OFFSET.size * index
+        )
+        records_offset = RECORD_OFFSET.size * (
+            min(self.page_size, self.count - page * self.page_size) + 1
+        )
+        return data[records_offset + record_start:
+                    records_offset + record_end]
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+
+def load(path):
+    """Memory maps a vanity table
+
+    Args:
+        path (str): table file
+
+    Returns:
+        VanityTable: table
+
+    Raises:
+        ValueError: when the file is not a compatible table
+
+    """
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return VanityTable(buffer)
+    except ValueError:
+        buffer.close()
+        raise
+
+
+def load_tables(paths=None):
+    """Loads the tables lookup() searches
+
+    Unreadable tables are logged and left out.
+
+    Args:
+        paths (str, optional): comma separated table files, from
+            VANITY_TABLE_PATHS by default
+
+    Returns:
+        list: VanityTable objects
+
+    """
+    global TABLES
+    if paths is None:
+        paths = common.get_envvar('VANITY_TABLE_PATHS', '')
+    tables = []
+    for path in paths.split(','):
+        path = path.strip()
+        if not path:
+            continue
+        try:
+            tables.append(load(path))
+        except (OSError, ValueError) as e:
+            common.error('Unable to load vanity table %s: %s' % (path, e))
+    TABLES = tables
+    return tables
+
+
+def lookup(phone_number, dictionary, candidates=1):
+    """Returns the precomputed candidates of a phone number
+
+    Args:
+        phone_number (str): phone number with country code
+        dictionary (str): name of the dictionary the candidates must
+            come from
+        candidates (int, optional): candidates needed, tables holding
+            fewer are skipped
+
+    Returns:
+        bytes: candidate_codec encoded candidates, None when no table
+            holds the number
+
+    """
+    tables = TABLES if TABLES is not None else load_tables()
+    if not tables:
+        return None
+    import vanity_number
+    country_code, fixed_prefix, national_number, _ = \
+        vanity_number.parse_number(phone_number)
+    national_number = fixed_prefix + national_number
+    for table in tables:
+        if (table.country_code == country_code and
+                table.dictionary == dictionary and
+                table.candidates >= candidates):
+            record = table.get(national_number)
+            if record is not None:
+                return record
+    return None
@@ -0,0 +1,177 @@
+"""Batch scoring of candidate words with NumPy
+
+Scores whole frontiers of candidates at once with the same results as
+vanity_number.evaluate_word, which stays the reference. Candidates are
+encoded as uint8 arrays, one row per candidate. Every span of letters up
+to the longest dictionary word is packed into an integer (5 bits a
+letter) and looked up in the sorted keys of the dictionary index, which
+gives the dictionary hits of a frontier in a few array operations.
+
+Spans are keyed by their letters rather than their keypad digits. A
+digit key is shared by every word spelled by the same keys, e.g. 2273
+is both CARE and BARD, so each digit hit would still have to be checked
+against the letters. The letter key of a dictionary word, up to 12
+letters of 5 bits, fits a uint64 and is exact, so one lookup decides a
+span.
+
+NumPy is not needed by the Lambda function, only by batch jobs that
+import this module.
+
+"""
+import numpy as np
+
+import vanity_number
+
+
+LETTER_BITS = 5
+# keys of dictionary words made of A-Z, sorted, built on first use
+_dictionary_keys = None
+
+
+def dictionary_keys():
+    """Returns the packed keys of the dictionary words
+
+    Returns:
+        numpy.ndarray: sorted uint64 keys
+
+    """
+    global _dictionary_keys
+    if _dictionary_keys is not None:
+        return _dictionary_keys
+    index = vanity_number.populate_dictionary_trie()
+    store = index.store
+    records = np.frombuffer(
+        index.buffer, np.uint8, len(store.records) * index.width,
+        store.records.offset
+    ).reshape(len(store.records), index.width)
+    if index.positions is None:
+        records = records[:len(index.words)]
+    else:
+        records = records[np.frombuffer(
+            index.buffer, '<u4', len(index.positions),
+            index.positions.offset
+        )]
+    keys = np.zeros(len(records), np.uint64)
+    valid = np.ones(len(records), bool)
+    # Records are padded with zeros, which leave the key unchanged
+    for column in records.T:
+        is_char = column != 0
+        valid &= ~is_char | ((column >= 65) & (column <= 90))
+        keys = np.where(
+            is_char,
+            (keys << np.uint64(LETTER_BITS)) |
+            (column.astype(np.uint64) - np.uint64(64)),
+            keys
+        )
+    _dictionary_keys = np.sort(keys[valid])
+    return _dictionary_keys
+
+
+def _span_words(codes, is_letter, max_word_length):
+    """Marks the spans of letters that are dictionary words
+
+    Args:
+        codes (numpy.ndarray): letter codes (1 to 26), one row a word
+        is_letter (numpy.ndarray): letter mask of codes
+        max_word_length (int): longest span to look up
+
+    Returns:
+        numpy.ndarray: is_word[n, start, end] for the span start:end
+
+    """
+    keys = dictionary_keys()
+    count, length = codes.shape
+    is_word = np.zeros((count, length + 1, length + 1), bool)
+    letters = np.zeros((count, length + 1), np.int32)
+    np.cumsum(is_letter, axis=1, out=letters[:, 1:])
+    span_keys = np.zeros((count, length + 1), np.uint64)
+    for span in range(1, min(max_word_length, length) + 1):
+        width = length - span + 1
+        span_keys = (span_keys[:, :width] << np.uint64(LETTER_BITS)) | \
+            codes[:, span - 1:]
+        only_letters = letters[:, span:] - letters[:, :width] == span
+        found = np.searchsorted(keys, span_keys)
+        np.minimum(found, len(keys) - 1, out=found)
+        starts = np.arange(width)
+        is_word[:, starts, starts + span] = \
+            only_letters & (keys[found] == span_keys)
+    return is_word
+
+
+def _evaluate_same_length(words):
+    count = len(words)
+    length = len(words[0])
+    chars = np.frombuffer(''.join(words).encode('ascii'), np.uint8) \
+        .reshape(count, length)
+    is_letter = chars >= 65
+    codes = np.where(is_letter, chars - 64, 0).astype(np.uint64)
+    positions = np.arange(length)
+
+    # Start of the run of letters at each position
+    run_start = np.maximum.accumulate(
+        np.where(is_letter, -1, positions), axis=1
+    ) + 1
+    run_length = positions + 1 - run_start
+    # evaluate_word scores the prefixes of a run that are followed by a
+    # letter or end the word
+    next_is_letter = np.ones_like(is_letter)
+    next_is_letter[:, :-1] = is_letter[:, 1:]
+    scored = is_letter & next_is_letter
+
+    is_valid = scored.any(axis=1)
+    max_continous_chars = np.where(scored, run_length, 0).max(axis=1)
+
+    is_word = _span_words(codes, is_letter,
+                          vanity_number.DICTIONARY_TRIE.width)
+    # best[n, start, end]: longest word of a split of the span into
+    # dictionary words, 0 when it does not split, built up by span length
+    best = np.where(
+        is_word, np.arange(length + 1)[None, None, :] -
+        np.arange(length + 1)[None, :, None], 0
+    )
+    for span in range(2, length + 1):
+        starts = np.arange(length - span + 1)
+        ends = starts + span
+        longest = best[:, starts, ends]
+        for split in range(1, span):
+            rest = best[:, starts + split, ends]
+            longest = np.where(
+                is_word[:, starts, starts + split] & (rest > 0),
+                np.maximum(longest, np.maximum(split, rest)), longest
+            )
+        best[:, starts, ends] = longest
+    rows = np.arange(count)[:, None]
+    substring_length = best[rows, run_start, positions + 1]
+    max_len_substring = np.where(scored, substring_length, 0).max(axis=1)
+    return is_valid, max_continous_chars, max_len_substring
+
+
+def evaluate_words(words):
+    """Batch evaluate_word
+
+    Args:
+        words (list): strings of chars (A-Z and digits)
+
+    Returns:
+        is_valid (numpy.ndarray): validity of each word
+        max_continous_chars (numpy.ndarray): maximum number of continuous
+            chars of each word
+        max_len_substring (numpy.ndarray): maximum length of substring of
+            each word
+
+    """
+    vanity_number.populate_dictionary_trie()
+    is_valid = np.zeros(len(words), bool)
+    max_continous_chars = np.zeros(len(words), np.int64)
+    max_len_substring = np.zeros(len(words), np.int64)
+    by_length = {}
+    for position, word in enumerate(words):
+        by_length.setdefault(len(word), []).append(position)
+    for length, positions in by_length.items():
+        if length == 0:
+            continue
+        scores = _evaluate_same_length([words[p] for p in positions])
+        is_valid[positions] = scores[0]
+        max_continous_chars[positions] = scores[1]
+        max_len_substring[positions] = scores[2]
+    return is_valid, max_continous_chars, max_len_substring
@@ -1,9 +1,16 @@
+import asyncio
 import boto3
+from boto3.dynamodb.types import Binary
+import gzip
 import json
 import os
+import random
 import sys
+import threading
+import time
 
 from moto import mock_dynamodb2
+import pytest
 
 
 FUNC_DIR = os.path.join(
@@ -14,7 +21,14 @@ print(FUNC_DIR)
 
 sys.path.append(FUNC_DIR)
 
+import index  # noqa E402
+import candidate_codec  # noqa E402
+import common  # noqa E402
 from index import handler  # noqa E402
+import metrics  # noqa E402
+import repository  # noqa E402
+from repository import Repository  # noqa E402
+import vanity_number  # noqa E402
 
 
 class LambdaContext(object):
@@ -65,4 +79,825 @@ def test_vanity_generator():
         }
     }
     output = handler(event, LambdaContext())
-    assert output['result'] == 'Here are your 5 vanity numbers: 1-86MANNJADE,  1-866COOLBED,  1-866AMOKADD,  1-866COOLBEE,  1-866AMOKBEE'
+    assert output['result'] == 'Here are your 5 vanity numbers: 1-VONCOOLBED,  1-TOMAMOKADD,  1-VONCOOLBEE,  1-TOMAMOKBED,  1-TOMANNJADE'
+
+
+def contact_event(phone_number):
+    return {
+        'Details': {
+            'ContactData': {
+                'CustomerEndpoint': {
+                    'Address': phone_number, 'Type': 'TELEPHONE_NUMBER'
+                }
+            }
+        }
+    }
+
+
+@mock_dynamodb2
+def test_warm_container_cache(monkeypatch):
+    create_dynamodb_table('contacts_store')
+    index.CONTACTS_CACHE.clear()
+    calls = []
+    _call = Repository._call
+
+    def record_call(self, operation, hk, **kwargs):
+        calls.append((operation, sorted(kwargs.get('vals', {}))))
+        return _call(self, operation, hk, **kwargs)
+
+    monkeypatch.setattr(Repository, '_call', record_call)
+    event = contact_event('+1-866-266-5233')
+    expected = handler(event, LambdaContext())
+    assert calls == [('touch', []),
+                     ('write', ['lastModified', 'vanityNumbers'])]
+    del calls[:]
+    assert handler(event, LambdaContext()) == expected
+    assert calls == [('write', ['lastModified'])]
+    del calls[:]
+    monkeypatch.setenv('CONTACTS_WRITE_BACK', 'skip')
+    assert handler(event, LambdaContext()) == expected
+    assert calls == []
+    # A cold container reads the stored numbers back
+    index.CONTACTS_CACHE.clear()
+    assert handler(event, LambdaContext()) == expected
+    assert calls == [('get', [])]
+    assert index.CONTACTS_CACHE.info()['size'] == 1
+    # or reads them and writes the caller back in one call
+    del calls[:]
+    index.CONTACTS_CACHE.clear()
+    monkeypatch.setenv('CONTACTS_WRITE_BACK', 'update')
+    assert handler(event, LambdaContext()) == expected
+    assert calls == [('touch', [])]
+
+
+@mock_dynamodb2
+def test_dynamodb_round_trips(monkeypatch):
+    from botocore.client import BaseClient
+
+    create_dynamodb_table('contacts_store')
+    index.CONTACTS_CACHE.clear()
+    operations = []
+    make_api_call = BaseClient._make_api_call
+
+    def record_api_call(client, operation_name, api_params):
+        operations.append(operation_name)
+        return make_api_call(client, operation_name, api_params)
+
+    monkeypatch.setattr(BaseClient, '_make_api_call', record_api_call)
+    event = contact_event('+1-866-266-5233')
+    expected = handler(event, LambdaContext())
+    # A new caller's touch creates the item holding its lease
+    assert operations == ['UpdateItem', 'PutItem']
+    # A repeat caller on a cold container: one round trip
+    for mode in ('touch', 'update'):
+        monkeypatch.setenv('CONTACTS_WRITE_BACK', mode)
+        index.CONTACTS_CACHE.clear()
+        del operations[:]
+        assert handler(event, LambdaContext()) == expected
+        assert operations == ['UpdateItem']
+    item = Repository('contacts_store', 'phoneNumber').get('+1-866-266-5233')
+    assert sorted(item) == ['lastModified', 'phoneNumber', 'vanityNumbers']
+    # and without the lease, the touch of a new caller creates nothing
+    monkeypatch.setenv('CONTACTS_LEASE_SECONDS', '0')
+    del operations[:]
+    handler(contact_event('+1-866-266-5234'), LambdaContext())
+    assert operations == ['UpdateItem', 'PutItem']
+
+
+@mock_dynamodb2
+def test_request_coalescing(monkeypatch):
+    create_dynamodb_table('contacts_store')
+    index.CONTACTS_CACHE.clear()
+    monkeypatch.setenv('CONTACTS_LEASE_POLL_MS', '10')
+    contacts = Repository('contacts_store', 'phoneNumber')
+    generated = []
+
+    def generate_vals(phone_number, dictionary=None):
+        generated.append(phone_number)
+        return index.stored_vals(phone_number, dictionary)
+
+    def call_concurrently(phone_number, callers):
+        shared = index.CONTACT_FLIGHTS.shared
+
+        def generate_when_shared(phone_number, dictionary=None):
+            # Hold the flight until the other callers wait for it
+            deadline = time.monotonic() + 5
+            while index.CONTACT_FLIGHTS.shared < shared + callers - 1 and \
+                    time.monotonic() < deadline:
+                time.sleep(0.001)
+            return generate_vals(phone_number, dictionary)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            index.process_contact(contact_event(phone_number),
+                                  generate_when_shared)
+        )) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    # Threads of a container share one generation and write
+    results = call_concurrently('+1-866-266-5233', 4)
+    assert generated == ['+1-866-266-5233']
+    assert len(results) == 4 and all(r == results[0] for r in results)
+    assert 'vanity numbers' in results[0]['result']
+    assert 'leaseOwner' not in contacts.get('+1-866-266-5233')
+    assert len(index.CONTACT_FLIGHTS) == 0
+
+    # Another container holds the lease: wait for what it writes
+    phone_number = '+1-866-266-5234'
+    assert contacts.acquire_lease(phone_number, 'other', 5) == {}
+    assert contacts.acquire_lease(phone_number, 'mine', 5) is None
+    del generated[:]
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        index.process_contact(contact_event(phone_number), generate_vals)
+    ))
+    thread.start()
+    time.sleep(0.05)
+    vals = {'vanityNumbers': ['1-866-266-LEAD']}
+    contacts.write(phone_number, vals=dict(vals))
+    thread.join()
+    assert generated == []
+    assert results[0]['result'].endswith('1-866-266-LEAD')
+    assert contacts.release_lease(phone_number, 'other') is False
+
+    # The touch of another container created the item: wait for it too
+    index.CONTACTS_CACHE.clear()
+    phone_number = '+1-866-266-5236'
+    assert contacts.touch(phone_number, create=True) == {}
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        index.process_contact(contact_event(phone_number), generate_vals)
+    ))
+    thread.start()
+    time.sleep(0.05)
+    contacts.write(phone_number, vals=dict(vals))
+    thread.join()
+    assert generated == []
+    assert results[0]['result'].endswith('1-866-266-LEAD')
+
+    # An expired lease is taken over
+    index.CONTACTS_CACHE.clear()
+    phone_number = '+1-866-266-5235'
+    contacts.acquire_lease(phone_number, 'crashed', 0.001)
+    time.sleep(0.01)
+    index.process_contact(contact_event(phone_number), generate_vals)
+    assert generated == [phone_number]
+    item = contacts.get(phone_number)
+    assert 'vanityNumbers' in item and 'leaseOwner' not in item
+
+
+@mock_dynamodb2
+def test_failed_generation_leaves_no_item(monkeypatch):
+    create_dynamodb_table('contacts_store')
+    index.CONTACTS_CACHE.clear()
+    contacts = Repository('contacts_store', 'phoneNumber')
+
+    def failing_generate_vals(phone_number, dictionary=None):
+        raise RuntimeError('generation failed')
+
+    assert contacts.touch('+1-866-266-5233') is False
+    for seconds in ('5', '0'):
+        monkeypatch.setenv('CONTACTS_LEASE_SECONDS', seconds)
+        with pytest.raises(RuntimeError):
+            index.process_contact(contact_event('+1-866-266-5233'),
+                                  failing_generate_vals)
+        assert contacts.exists('+1-866-266-5233') is False
+
+
+@mock_dynamodb2
+def test_dynamodb_resource_reused(monkeypatch):
+    create_dynamodb_table('contacts_store')
+    repository.reset_dynamodb_resources()
+    index.CONTACTS_CACHE.clear()
+    built = []
+    session_resource = boto3.session.Session.resource
+    session_client = boto3.session.Session.client
+
+    def record_resource(self, *args, **kwargs):
+        built.append(('resource',) + args)
+        return session_resource(self, *args, **kwargs)
+
+    def record_client(self, *args, **kwargs):
+        built.append(('client',) + args)
+        return session_client(self, *args, **kwargs)
+
+    monkeypatch.setattr(boto3.session.Session, 'resource', record_resource)
+    monkeypatch.setattr(boto3.session.Session, 'client', record_client)
+    for phone_number in ('+1-866-266-5233', '+1-866-266-5234'):
+        handler(contact_event(phone_number), LambdaContext())
+        handler(contact_event(phone_number), LambdaContext())
+    # Contacts only go through the thread safe client
+    assert built == [('client', 'dynamodb')]
+    table = repository.get_dynamodb_table('contacts_store')
+    assert table is Repository('contacts_store', 'phoneNumber') \
+        ._get_dynamodb_table()
+    assert table.meta.client.meta.config.max_pool_connections == 10
+    # Older botocore has no tcp_keepalive option
+    from botocore.config import Config
+    options = dict(Config.OPTION_DEFAULTS)
+    del options['tcp_keepalive']
+    monkeypatch.setattr(Config, 'OPTION_DEFAULTS', options)
+    assert repository._dynamodb_config().max_pool_connections == 10
+
+
+@mock_dynamodb2
+def test_repository_batch_operations(monkeypatch):
+    create_dynamodb_table('contacts_store')
+    repository.reset_dynamodb_resources()
+    contact_repository = Repository('contacts_store', 'phoneNumber')
+    client = repository.get_dynamodb_client()
+    calls = []
+    batch_write_item = client.batch_write_item
+
+    # Leave the first item of every chunk unprocessed once
+    def partial_batch_write_item(RequestItems):
+        calls.append(len(RequestItems['contacts_store']))
+        requests = RequestItems['contacts_store']
+        if len(requests) > 1:
+            batch_write_item(RequestItems={'contacts_store': requests[1:]})
+            return {'UnprocessedItems': {'contacts_store': requests[:1]}}
+        return batch_write_item(RequestItems=RequestItems)
+
+    monkeypatch.setattr(client, 'batch_write_item', partial_batch_write_item)
+    monkeypatch.setattr(repository.random, 'uniform', lambda a, b: 0)
+    items = {
+        '+1-866-266-%04d' % i: {'vanityNumbers': ['1-866COOL%03d' % i]}
+        for i in range(60)
+    }
+    assert contact_repository.write_many(items) == 60
+    assert sorted(calls) == [1, 1, 1, 10, 25, 25]
+    hks = ['+1-866-266-%04d' % i for i in range(150)]
+    stored = contact_repository.get_many(hks + hks[:10])
+    assert sorted(stored) == sorted(items)
+    assert stored['+1-866-266-0042']['vanityNumbers'] == ['1-866COOL042']
+    assert 'lastModified' in stored['+1-866-266-0042']
+    assert contact_repository.get('+1-866-266-0007') == \
+        stored['+1-866-266-0007']
+
+
+@mock_dynamodb2
+def test_item_conversion_matches_json_round_trip():
+    create_dynamodb_table('contacts_store')
+    repository.reset_dynamodb_resources()
+    candidates = gzip.compress(json.dumps(['1-866COOLBED']).encode())
+    item = {
+        'phoneNumber': '+1-866-266-5233',
+        'vanityNumbers': ['1-866COOLBED', '1-866AMOKADD'],
+        'scores': {'max': common.Decimal('7'), 'ratio': common.Decimal('0.5')},
+        'counts': [common.Decimal('-3'), common.Decimal('2.0')],
+        'tags': {'cool', 'bed'},
+        'flags': [True, None],
+        'candidates': Binary(candidates),
+        'other': Binary(candidates)
+    }
+    table = repository.get_dynamodb_table('contacts_store')
+    table.put_item(Item=item)
+    stored = table.get_item(Key={'phoneNumber': item['phoneNumber']})['Item']
+    expected = json.loads(json.dumps(stored, default=common.json_serial))
+    contact_repository = Repository('contacts_store', 'phoneNumber')
+    contact = contact_repository.get(item['phoneNumber'])
+    contact['tags'].sort()
+    expected['tags'].sort()
+    assert contact == expected
+    contact = contact_repository.get(item['phoneNumber'],
+                                     decompress=['candidates'])
+    assert contact['candidates'] == ['1-866COOLBED']
+    assert contact['other'] == candidates
+    assert contact_repository.get_many([item['phoneNumber']], False)[
+        item['phoneNumber']]['candidates'] == candidates
+
+
+def test_candidate_codec_round_trip():
+    vanity_numbers, scores = vanity_number.generate_ranked(
+        '+1-866-266-5233', 100
+    )
+    assert len(vanity_numbers) == 100
+    for compress in (False, True):
+        data = candidate_codec.encode(vanity_numbers, scores, compress)
+        assert len(data) < 1024
+        candidates = candidate_codec.decode(data)
+        assert len(candidates) == 100
+        assert candidates[:] == vanity_numbers
+        assert candidates[-1] == vanity_numbers[-1]
+        assert [candidates.score(i) for i in range(100)] == scores
+    candidates = candidate_codec.decode(
+        candidate_codec.encode(['44-20COOL1', '44-2026651']))
+    assert candidates[:] == ['44-20COOL1', '44-2026651']
+    assert candidates.score(0) is None
+    assert len(candidate_codec.decode(candidate_codec.encode([]))) == 0
+    for vanity_numbers in (['1-866COOL', '1-866COOK1'],
+                           ['1-866COOL', '1-867COOL'],
+                           ['1-866COOL', '44-866COOL']):
+        with pytest.raises(ValueError):
+            candidate_codec.encode(vanity_numbers)
+    with pytest.raises(ValueError):
+        candidate_codec.decode(data[:20])
+
+
+@mock_dynamodb2
+def test_binary_storage_format(monkeypatch):
+    create_dynamodb_table('contacts_store')
+    repository.reset_dynamodb_resources()
+    index.CONTACTS_CACHE.clear()
+    monkeypatch.setenv('CONTACTS_STORAGE_FORMAT', 'binary')
+    monkeypatch.setenv('CONTACTS_WRITE_BACK', 'update')
+    event = contact_event('+1-866-266-5233')
+    vanity_numbers = vanity_number.generate_ranked('+1-866-266-5233')[0]
+    expected = 'Here are your 5 vanity numbers: %s' % ',  '.join(
+        vanity_numbers[:5])
+    assert handler(event, LambdaContext())['result'] == expected
+    index.CONTACTS_CACHE.clear()
+    assert handler(event, LambdaContext())['result'] == expected
+    contact = Repository('contacts_store', 'phoneNumber').get(
+        '+1-866-266-5233', decompress=False)
+    assert 'vanityNumbers' not in contact
+    assert candidate_codec.decode(contact['candidates'])[:] == vanity_numbers
+    # Encoded candidates are not gzipped JSON, default reads keep them
+    contacts = Repository('contacts_store', 'phoneNumber')
+    assert contacts.get('+1-866-266-5233') == contact
+    assert contacts.exists('+1-866-266-5233') == contact
+    assert contacts.get_many(['+1-866-266-5233']) == {
+        '+1-866-266-5233': contact
+    }
+
+
+@mock_dynamodb2
+def test_handler_metrics(monkeypatch, capsys):
+    create_dynamodb_table('contacts_store')
+    repository.reset_dynamodb_resources()
+    index.CONTACTS_CACHE.clear()
+    event = contact_event('+1-866-266-5233')
+    handler(event, LambdaContext())
+    assert '_aws' not in capsys.readouterr().out
+    assert metrics.span('search') is metrics.span('handler')
+
+    monkeypatch.setenv('METRICS_ENABLED', 'TRUE')
+    index.CONTACTS_CACHE.clear()
+    vanity_number.DIGIT_RUNS_CACHE.clear()
+    repository.get_dynamodb_table('contacts_store').delete_item(
+        Key={'phoneNumber': '+1-866-266-5233'})
+    handler(event, LambdaContext())
+    handler(event, LambdaContext())
+    lines = capsys.readouterr().out.splitlines()
+    documents = [json.loads(line) for line in lines if '_aws' in line]
+    assert len(documents) == 2
+    generated, cached = documents
+    assert generated['requestId'] == 'abc123'
+    assert (generated['path'], cached['path']) == ('generated', 'cache')
+    assert generated['nodes_expanded'] > 0
+    assert generated['heap_pushes'] >= 5
+    assert generated['substring_scores'] > 0
+    assert generated['digits'] == 10
+    for name in ('handler', 'search', 'dynamodb_touch_item',
+                 'dynamodb_write_item'):
+        assert 0 < generated[name] <= generated['handler']
+    assert 'search' not in cached
+    names = [m['Name'] for m in
+             generated['_aws']['CloudWatchMetrics'][0]['Metrics']]
+    assert 'search' in names and 'heap_pushes' in names
+    assert metrics.enabled() is False
+
+
+def random_numbers(count, seed=5233):
+    rand = random.Random(seed)
+    numbers = ['8662665233', '7979797979', '6666666666', '2222222222']
+    for _ in range(count):
+        digits = '23456789' if rand.random() < 0.5 else '0123456789'
+        length = rand.choice([7, 10, 11])
+        numbers.append(''.join(rand.choice(digits) for _ in range(length)))
+    return numbers
+
+
+def test_segment_strategy_matches_bfs():
+    for number in random_numbers(20):
+        assert vanity_number._frame_words_from_number(
+            number, 5, strategy='segment'
+        ) == vanity_number._frame_words_from_number(
+            number, 5, strategy='bfs'
+        ), number
+
+
+def score(word):
+    _, max_continous_chars, max_len_substring = \
+        vanity_number.evaluate_word(word)
+    return (max_len_substring, max_continous_chars,
+            sum(1 for char in word if char.isalpha()))
+
+
+def test_best_first_strategy_finds_top_scores():
+    for number in random_numbers(100):
+        expected = vanity_number._frame_words_from_number(
+            number, 5, strategy='segment'
+        )
+        words = vanity_number._frame_words_from_number(
+            number, 5, strategy='best_first'
+        )
+        assert sorted(map(score, words)) == sorted(map(score, expected)), \
+            number
+
+
+def test_incremental_scores_match_evaluate_word(monkeypatch):
+    candidates = []
+    push_candidate = vanity_number._push_candidate
+
+    def record_candidate(priority_queue, node, max_results):
+        candidates.append(node)
+        push_candidate(priority_queue, node, max_results)
+
+    monkeypatch.setattr(vanity_number, '_push_candidate', record_candidate)
+    for number in random_numbers(30, seed=2665):
+        for strategy in ('bfs', 'segment'):
+            vanity_number._frame_words_from_number(number, 5, strategy)
+    assert len(candidates) > 1000
+    for node in candidates:
+        (is_valid, max_continous_chars, max_len_substring) = \
+            vanity_number.evaluate_word(node.wordified_so_far)
+        assert is_valid
+        assert max_continous_chars == node.max_continous_chars
+        assert max_len_substring == node.max_len_substring
+
+
+def test_iter_candidates():
+    candidates = list(vanity_number.iter_candidates('+1-866-266-5233'))
+    assert [candidate for candidate, _ in candidates[:5]] == \
+        vanity_number.generate('+1-866-266-5233', strategy='best_first')
+    ranks = [rank for _, rank in candidates]
+    assert ranks == sorted(ranks, reverse=True)
+    assert ranks[0] == score('VONCOOLBED')
+
+    async def collect():
+        return [candidate async for candidate in
+                vanity_number.aiter_candidates('+1-866-266-5233', 3)]
+
+    loop = asyncio.get_event_loop()
+    assert loop.run_until_complete(collect()) == candidates[:3]
+    # Out of time after one expansion, the best partial candidates are
+    # finished with the remaining digits and ranked
+    for number in random_numbers(20, seed=2665) + ['2958847739']:
+        candidates = list(vanity_number.iter_candidates(
+            '+1-%s' % number, 5, time_budget_ms=1e-6
+        ))
+        if vanity_number.generate('+1-%s' % number):
+            assert candidates
+        for candidate, rank in candidates:
+            assert rank == score(candidate.partition('-')[2])
+        ranks = [rank for _, rank in candidates]
+        assert ranks == sorted(ranks, reverse=True)
+
+
+def test_vector_scoring_matches_evaluate_word():
+    pytest.importorskip('numpy')
+    import vector_scoring
+
+    rand = random.Random(2665)
+    words = ['COOLBED', 'COOL1BED', '1COOLBED', 'MANNJADE', 'A1', '1', '']
+    for number in random_numbers(40, seed=2665):
+        words.extend(vanity_number._frame_words_from_number(number, 20))
+        for _ in range(20):
+            words.append(''.join(
+                rand.choice(vanity_number.DIGIT_TO_CHARS[digit] + [digit])
+                for digit in number
+            ))
+    is_valid, max_continous_chars, max_len_substring = \
+        vector_scoring.evaluate_words(words)
+    assert (max_len_substring >= 4).sum() > 100
+    for position, word in enumerate(words):
+        assert (is_valid[position], max_continous_chars[position],
+                max_len_substring[position]) == \
+            vanity_number.evaluate_word(word), word
+
+
+def test_generate_batch():
+    phone_numbers = ['+1-866-266-5233', 'invalid', '+1-797-979-7979']
+    results = list(vanity_number.generate_batch(phone_numbers, workers=2,
+                                                chunksize=1))
+    assert [result['phoneNumber'] for result in results] == phone_numbers
+    assert results[0]['vanityNumbers'] == \
+        vanity_number.generate(phone_numbers[0])
+    assert 'error' in results[1]
+    assert results == list(vanity_number.generate_batch(phone_numbers,
+                                                        workers=1))
+
+
+def test_digit_runs_cache_reused_across_numbers():
+    vanity_number.DIGIT_RUNS_CACHE.clear()
+    expected = vanity_number.generate('+1-866-266-5233')
+    misses = vanity_number.cache_info()['misses']
+    assert vanity_number.generate('+1-866-266-5233') == expected
+    vanity_number.generate('+1-866-266-5234')
+    info = vanity_number.cache_info()
+    assert info['hits'] > 0
+    # Only substrings ending in the changed digit are new
+    assert info['misses'] - misses < 20
+
+
+def test_digit_automaton_matches_every_word():
+    import dictionary_index
+
+    dictionary = vanity_number.populate_dictionary_trie()
+    bell = dictionary.with_keypad(dictionary_index.KEYPADS['bell'])
+    for keypad_dictionary in (dictionary, bell):
+        automaton = keypad_dictionary.digit_automaton()
+        for number in random_numbers(20, seed=2665):
+            word_ends, state = automaton.match(number)
+            assert word_ends == [
+                [end for end in range(start + 1, len(number) + 1)
+                 if keypad_dictionary.words_for_digits(number[start:end])]
+                for start in range(len(number))
+            ], number
+            assert number.endswith(state)
+    # Compounds of any number of words are scored by their longest word
+    assert vanity_number.find_valid_word_substrings('VONCOOLBED') == \
+        ['VON', 'COOL', 'BED']
+    assert vanity_number.evaluate_word('VONCOOLBED') == (True, 10, 4)
+    assert vanity_number.is_valid_word_or_prefix('VONCOOLBE')
+    assert not vanity_number.is_valid_word_or_prefix('VONCOOLBEDQX')
+
+
+def use_dictionary_store(tmp_path, monkeypatch):
+    # english, english with AMOK preferred and brands (a weighted word
+    # list less a blocklist) in one store
+    import dictionary_index
+
+    (tmp_path / 'brands.txt').write_text('# brand terms\nCOOL 5\nBED\nMANN\n')
+    (tmp_path / 'blocked.txt').write_text('MANN\n')
+    english = dictionary_index.english_words()
+    weighted = dict.fromkeys(english, 1)
+    weighted['amok'] = 10
+    name, brands = dictionary_index.parse_dictionary('brands=%s,-%s' % (
+        tmp_path / 'brands.txt', tmp_path / 'blocked.txt'))
+    path = dictionary_index.write_index(
+        str(tmp_path / 'dictionary.idx'),
+        dictionaries={'english': english, 'weighted': weighted, name: brands}
+    )
+    monkeypatch.setenv('DICTIONARY_INDEX_PATH', path)
+    monkeypatch.setattr(vanity_number, 'is_dictionary_trie_populated', False)
+    monkeypatch.setattr(vanity_number, 'DICTIONARY_TRIE', None)
+    monkeypatch.setattr(vanity_number, 'DICTIONARY_STORE', None)
+    monkeypatch.setattr(vanity_number, 'DIGIT_RUNS_CACHE',
+                        common.LRUCache(1000))
+
+
+def test_weighted_dictionaries(tmp_path, monkeypatch):
+    expected = vanity_number.generate('+1-866-266-5233')
+    use_dictionary_store(tmp_path, monkeypatch)
+    store = vanity_number.populate_dictionary_trie().store
+    assert store.names() == ['brands', 'english', 'weighted']
+    assert vanity_number.get_dictionary('english').positions is None
+    brands = vanity_number.get_dictionary('brands')
+    assert (len(brands), brands.weight('COOL'), brands.weight('BED'),
+            'MANN' in brands) == (2, 5, 1, False)
+    assert brands.words_for_digits('2665') == ['COOL']
+    assert vanity_number.get_dictionary('missing').name == 'english'
+
+    assert vanity_number.generate('+1-866-266-5233') == expected
+    # AMOK wins the ties between equally ranked words
+    weighted = vanity_number.generate('+1-866-266-5233',
+                                      dictionary='weighted')
+    assert expected[0] == '1-VONCOOLBED'
+    assert weighted[0] == '1-VONAMOKBED'
+    assert [number[5:9] for number in weighted[:4]] == ['AMOK'] * 4
+    assert vanity_number.generate('+1-866-266-5233', 1,
+                                  dictionary='brands') == ['1-866COOLBED']
+
+    dictionary = vanity_number.get_dictionary('weighted')
+    candidates = []
+    push_candidate = vanity_number._push_candidate
+
+    def record_candidate(priority_queue, node, max_results):
+        candidates.append(node)
+        push_candidate(priority_queue, node, max_results)
+
+    monkeypatch.setattr(vanity_number, '_push_candidate', record_candidate)
+    for number in random_numbers(10, seed=2665):
+        words = vanity_number._frame_words_from_number(
+            number, 5, 'segment', dictionary=dictionary)
+        assert words == vanity_number._frame_words_from_number(
+            number, 5, 'bfs', dictionary=dictionary), number
+        best_first = vanity_number._frame_words_from_number(
+            number, 5, 'best_first', dictionary=dictionary)
+        assert sorted((score(word), vanity_number.word_weight(
+            word, dictionary)) for word in best_first) == \
+            sorted((score(word), vanity_number.word_weight(
+                word, dictionary)) for word in words), number
+    for node in candidates:
+        assert node.weight == vanity_number.word_weight(
+            node.wordified_so_far, dictionary)
+
+
+@mock_dynamodb2
+def test_handler_dictionary_attribute(tmp_path, monkeypatch):
+    create_dynamodb_table('contacts_store')
+    repository.reset_dynamodb_resources()
+    index.CONTACTS_CACHE.clear()
+    use_dictionary_store(tmp_path, monkeypatch)
+    event = contact_event('+1-866-266-5233')
+    default = handler(event, LambdaContext())['result']
+    event['Details']['ContactData']['Attributes'] = {'dictionary': 'brands'}
+    assert handler(event, LambdaContext())['result'] == \
+        'Here are your 3 vanity numbers: 1-866COOLBED,  1-8662665BED,  ' \
+        '1-866COOL233'
+    contact_repository = Repository('contacts_store', 'phoneNumber')
+    assert contact_repository.get('+1-866-266-5233')['dictionary'] == \
+        'brands'
+    index.CONTACTS_CACHE.clear()
+    event['Details']['Parameters'] = {'dictionary': 'english'}
+    assert handler(event, LambdaContext())['result'] == default
+    assert 'dictionary' not in contact_repository.get('+1-866-266-5233')
+
+
+def test_region_settings(monkeypatch):
+    import dictionary_index
+    import regions
+
+    # Leading zeros of national numbers are kept
+    assert vanity_number.parse_number('+39 06 1234 5678')[:3] == \
+        (39, '', '0612345678')
+    monkeypatch.setattr(regions, 'REGIONS', regions.compile_regions(
+        'US=bell,XX=missing', 'US=3,GB=area,*=ndc,DE=x'))
+    assert regions.get_region('US').keypad.name == 'bell'
+    assert regions.get_region('DE').keypad.name == 'E.161'
+    assert regions.get_region('DE').fixed_prefix == 'ndc'
+    assert vanity_number.parse_number('+1-866-266-5233')[:3] == \
+        (1, '866', '2665233')
+    assert vanity_number.parse_number('+44 20 7946 0000')[:3] == \
+        (44, '20', '79460000')
+    assert vanity_number.parse_number('+49 30 7876 5533')[:3] == \
+        (49, '30', '78765533')
+
+    dictionary = vanity_number.get_dictionary().with_keypad(
+        dictionary_index.KEYPADS['bell'])
+    assert vanity_number.get_dictionary().words_for_digits('966') == \
+        ['WON', 'WOO', 'YON', 'ZOO']
+    assert dictionary.words_for_digits('966') == ['WON', 'WOO', 'YON']
+    # Only the digits after the fixed prefix are searched
+    assert vanity_number.generate('+1-866-266-5233') == [
+        '1-866' + word for word in
+        vanity_number._frame_words_from_number('2665233', 5,
+                                               dictionary=dictionary)
+    ]
+    for number in random_numbers(10, seed=7979):
+        words = vanity_number._frame_words_from_number(
+            number, 5, 'segment', dictionary=dictionary)
+        assert words == vanity_number._frame_words_from_number(
+            number, 5, 'bfs', dictionary=dictionary), number
+        assert not any(char in word for word in words for char in 'QZ')
+
+
+@mock_dynamodb2
+def test_precomputed_vanity_table(tmp_path, monkeypatch):
+    import precompute
+    import vanity_table
+
+    output = str(tmp_path / 'block.vtb')
+    compute_page = precompute.compute_page
+    pages = []
+
+    def interrupted_page(task):
+        if len(pages) == 3:
+            raise KeyboardInterrupt()
+        pages.append(task)
+        return compute_page(task)
+
+    monkeypatch.setattr(precompute, 'compute_page', interrupted_page)
+    with pytest.raises(KeyboardInterrupt):
+        precompute.run('+1-866-266-52XX', output, workers=1, page_size=16,
+                       checkpoint_pages=1)
+    monkeypatch.setattr(precompute, 'compute_page', compute_page)
+    stats = precompute.run('+1-866-266-52XX', output, workers=2,
+                           page_size=16, checkpoint_pages=1)
+    assert stats['numbers'] == 100 and stats['pages'] == 7
+    assert stats['resumed'] == 3
+    assert sorted(os.listdir(str(tmp_path))) == ['block.vtb']
+    assert precompute.run('+18662665200:+18662665299',
+                          str(tmp_path / 'again.vtb'), workers=1,
+                          page_size=16)['bytes'] == stats['bytes']
+    with pytest.raises(ValueError):
+        precompute.parse_range('+1-866-266-X2XX')
+
+    table = vanity_table.load(output)
+    monkeypatch.setattr(vanity_table, 'TABLES', [table])
+    assert (table.country_code, table.digits, table.first, len(table),
+            table.dictionary) == (1, 10, 8662665200, 100, 'english')
+    assert '8662665300' not in table
+    for phone_number in ('+1-866-266-5200', '+1-866-266-5233',
+                         '+1-866-266-5299'):
+        vanity_numbers, ranks = vanity_number.generate_ranked(phone_number,
+                                                              5)
+        candidates = candidate_codec.decode(vanity_table.lookup(
+            phone_number, 'english'))
+        assert candidates[:] == vanity_numbers
+        assert [candidates.score(i) for i in range(5)] == ranks
+    assert vanity_table.lookup('+1-866-266-5233', 'brands') is None
+    assert vanity_table.lookup('+1-866-266-5233', 'english', 6) is None
+
+    # The handler looks numbers of the table up instead of searching
+    create_dynamodb_table('contacts_store')
+    repository.reset_dynamodb_resources()
+    index.CONTACTS_CACHE.clear()
+    monkeypatch.setenv('METRICS_ENABLED', 'TRUE')
+    monkeypatch.setattr(vanity_number, 'generate', None)
+    document = {}
+    flush = metrics.flush
+    monkeypatch.setattr(metrics, 'flush',
+                        lambda: document.update(flush() or {}))
+    assert handler(contact_event('+1-866-266-5233'),
+                   LambdaContext())['result'] == \
+        'Here are your 5 vanity numbers: 1-VONCOOLBED,  1-TOMAMOKADD,  ' \
+        '1-VONCOOLBEE,  1-TOMAMOKBED,  1-TOMANNJADE'
+    assert document['path'] == 'table'
+
+    dynamodb_output = str(tmp_path / 'block.json.gz')
+    monkeypatch.undo()
+    precompute.run('+1-866-266-520X', dynamodb_output, 'dynamodb', workers=1)
+    with gzip.open(dynamodb_output) as f:
+        items = [json.loads(line)['Item'] for line in f]
+    assert [item['phoneNumber']['S'] for item in items] == [
+        '+186626652%02d' % n for n in range(10)]
+    assert [v['S'] for v in items[0]['vanityNumbers']['L']] == \
+        vanity_number.generate('+1-866-266-5200')
+
+
+async def http_request(port, method, path, document=None):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    body = b'' if document is None else json.dumps(document).encode()
+    writer.write(('%s %s HTTP/1.1\r\nContent-Length: %s\r\n'
+                  'Connection: close\r\n\r\n' % (method, path, len(body))
+                  ).encode() + body)
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    lines = head.decode().split('\r\n')
+    headers = dict(line.lower().split(': ', 1) for line in lines[1:])
+    return int(lines[0].split()[1]), json.loads(body), headers
+
+
+@mock_dynamodb2
+def test_service(monkeypatch):
+    import threading
+    import service
+
+    create_dynamodb_table('contacts_store')
+    repository.reset_dynamodb_resources()
+    index.CONTACTS_CACHE.clear()
+    vanity_service = service.VanityService(workers=1, threads=2,
+                                           max_pending=1)
+    release = threading.Event()
+    generate_vals = vanity_service.generate_vals
+
+    def blocked_generate_vals(phone_number, dictionary=None):
+        release.wait(10)
+        return generate_vals(phone_number, dictionary)
+
+    async def run():
+        server = await vanity_service.start('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            status, document, _ = await http_request(
+                port, 'POST', '/', contact_event('+1-866-266-5233'))
+            assert status == 200
+            assert document == handler(contact_event('+1-866-266-5233'),
+                                       LambdaContext())
+            assert Repository('contacts_store', 'phoneNumber').exists(
+                '+1-866-266-5233')
+
+            monkeypatch.setattr(vanity_service, 'generate_vals',
+                                blocked_generate_vals)
+            first = asyncio.ensure_future(http_request(
+                port, 'POST', '/', contact_event('+1-866-266-5234')))
+            while vanity_service.pending == 0:
+                await asyncio.sleep(0.01)
+            status, document, headers = await http_request(
+                port, 'POST', '/', contact_event('+1-866-266-5235'))
+            assert (status, headers['retry-after']) == (503, '1')
+            status, document, _ = await http_request(port, 'GET', '/health')
+            assert (document['pending'], document['rejected']) == (1, 1)
+            release.set()
+            status, document, _ = await first
+            assert status == 200
+            assert document['result'].startswith('Here are your 5')
+
+            for method, path, body, expected in (
+                    ('GET', '/', None, 405), ('POST', '/health', {}, 405),
+                    ('POST', '/missing', {}, 404)):
+                status, _, _ = await http_request(port, method, path, body)
+                assert status == expected
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'POST / HTTP/1.1\r\nContent-Length: 3\r\n\r\n{{{'
+                         b'GET /health HTTP/1.1\r\n\r\n')
+            first_response = await reader.readuntil(b'}')
+            assert first_response.startswith(b'HTTP/1.1 400')
+            assert b'"served": 2' in await reader.readuntil(b'}')
+            writer.close()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    try:
+        asyncio.get_event_loop().run_until_complete(run())
+    finally:
+        vanity_service.close()